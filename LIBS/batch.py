@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Functions to run the processing chain for several countries concurrently.
+
+Each country has its own configuration file (a copy of config.py with its own paths, EPSG code
+and outputdir). Each country is run by a separate process of the processing chain, with its own
+working dir, GRASSDATA and GISRC file, so the GRASS GIS sessions are fully isolated.
+The countries are started biggest first (according to the size of their input files), as long as
+their cores ('njobs') and memory fit in the global budget. The cores and memory given to each
+country are passed to the chain with the SHEDECIDES_NJOBS and SHEDECIDES_MEMORY environment variables.
+"""
+
+import os
+import csv
+import imp
+import sys
+import json
+import time
+import subprocess
+
+
+def load_country_config(config_file):
+    """Load a configuration file of a country as a separate module and return the module"""
+    name = os.path.splitext(os.path.basename(config_file))[0]
+    return imp.load_source("config_%s" % name, config_file)
+
+def input_size(config):
+    """Return the total size (in bytes) of the input files of a configuration, used as the size of the country"""
+    paths = []
+    for value in config.data.values():
+        if isinstance(value, tuple):
+            value = value[1]
+        if isinstance(value, basestring) and os.path.isfile(value):
+            paths.append(value)
+    return sum(os.path.getsize(path) for path in paths)
+
+def country_jobs(config_files, cores, memory):
+    """Return the list of countries to run (dictionaries), biggest first.
+
+    The cores and memory (MB) requested by a country are the 'njobs' and 'memory' of its
+    configuration, limited to the global budget.
+    """
+    jobs = []
+    for config_file in config_files:
+        config = load_country_config(config_file)
+        job = {}
+        job['country'] = os.path.splitext(os.path.basename(config_file))[0]
+        job['config'] = os.path.abspath(config_file)
+        job['size'] = input_size(config)
+        job['njobs'] = max(1, min(int(config.config_parameters['njobs']), cores))
+        job['memory'] = max(1, min(int(config.config_parameters['memory']), memory))
+        job['workingdir'] = config.config_parameters['workingdir']
+        job['outputdir'] = config.config_parameters['outputdir']
+        jobs.append(job)
+    jobs.sort(key=lambda job: job['size'], reverse=True)
+    return jobs
+
+def _start(job, chain_script, chain_args):
+    """Start the processing chain for a country in a new process"""
+    if not os.path.exists(job['outputdir']):
+        os.makedirs(job['outputdir'])
+    env = dict(os.environ)
+    env['SHEDECIDES_CONFIG'] = job['config']
+    env['SHEDECIDES_NJOBS'] = str(job['njobs'])
+    env['SHEDECIDES_MEMORY'] = str(job['memory'])
+    # Own GISRC file, in the working dir of the country
+    env['GISRC'] = os.path.join(job['workingdir'], '.grass7', 'rc')
+    job['log'] = os.path.join(job['outputdir'], 'shedecides.log')
+    job['start'] = time.time()
+    log = open(job['log'], 'w')
+    job['process'] = subprocess.Popen([sys.executable, chain_script] + list(chain_args), env=env,
+                                      stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    print "Country '%s' started (%s cores, %s MB)" % (job['country'],job['njobs'],job['memory'])
+
+def run_batch(jobs, chain_script, cores, memory, chain_args=(), poll_interval=5):
+    """Run the processing chain for all the countries, within a global budget of cores and memory (MB).
+
+    The countries are started in the order of 'jobs' (biggest first); smaller countries fill the
+    remaining budget while a bigger one waits. Return the list of jobs with their status and timings.
+    """
+    pending = list(jobs)
+    running = []
+    free_cores, free_memory = cores, memory
+    while pending or running:
+        for job in list(pending):
+            # Always start a country when nothing runs, even if it asks more than the budget
+            if (job['njobs'] <= free_cores and job['memory'] <= free_memory) or not running:
+                _start(job, chain_script, chain_args)
+                pending.remove(job)
+                running.append(job)
+                free_cores -= job['njobs']
+                free_memory -= job['memory']
+        time.sleep(poll_interval)
+        for job in list(running):
+            returncode = job['process'].poll()
+            if returncode is None:
+                continue
+            job['end'] = time.time()
+            job['duration'] = job['end'] - job['start']
+            job['returncode'] = returncode
+            job['status'] = 'done' if returncode == 0 else 'failed'
+            running.remove(job)
+            free_cores += job['njobs']
+            free_memory += job['memory']
+            print "Country '%s' %s in %.0f s" % (job['country'],job['status'],job['duration'])
+    return jobs
+
+def output_files(outputdir):
+    """Return the list of files in an output folder (relative paths)"""
+    files = []
+    for root, dirs, names in os.walk(outputdir):
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), outputdir))
+    return sorted(files)
+
+def write_summary(jobs, summary_file):
+    """Write the summary of a batch run as json (with the list of outputs) and as csv"""
+    columns = ['country','status','returncode','start','end','duration','size','njobs','memory','config','outputdir','log']
+    summary = []
+    for job in jobs:
+        item = dict((column, job.get(column)) for column in columns)
+        item['outputs'] = output_files(job['outputdir']) if os.path.exists(job['outputdir']) else []
+        summary.append(item)
+    with open(summary_file, 'w') as fout:
+        json.dump(summary, fout, indent=2)
+    with open("%s.csv" % os.path.splitext(summary_file)[0], 'wb') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(columns + ['nb_outputs'])
+        for item in summary:
+            writer.writerow([item[column] for column in columns] + [len(item['outputs'])])
@@ -1,5 +1,4 @@
 import os
-import random, string
 
 # Initialize dictionnaries
 config_parameters = {}
@@ -10,17 +9,26 @@ rule_file = {}
 roads_veloc = {}
 streams_veloc = {}
 
-# Define temporary working dir and output dir
-workingdirbase = '/tmp/SHE_DECIDES' # directory in which to create the temporary working dir
-tempdirname = "".join(random.choice(string.ascii_letters) for _ in range(20))
-config_parameters['workingdir'] = os.path.join(workingdirbase, tempdirname)
+# Define working dir and output dir
+# The working dir holds the GRASS GIS database and the completion markers of the stages: its path
+# is stable (one per country), so an interrupted run can be resumed with --resume. It is erased at
+# the end of a complete run, unless the temporary files are kept
+workingdirbase = '/tmp/SHE_DECIDES' # directory in which to create the working dir
+config_parameters['workingdir'] = os.path.join(workingdirbase, 'SEN')
 
 outputdirbase ='/home/shedecides/data/output'
 config_parameters['outputdir'] = os.path.join(outputdirbase, 'SEN')
 
+# Define the directory of the persistent cache of stage outputs (reused between runs, see stage_cache.py)
+config_parameters['cachedir'] = '/home/shedecides/data/cache'
+config_parameters['cache_size'] = 20000 # maximum size of the cache in MB (least recently used entries are removed)
+
 # Define desired outputs
-outputs['csv_per_healthfacility'] = True
-outputs['isochrone_maps'] = False
+outputs['results_table'] = 'parquet' # table of the population per health facility of all the scenarios: 'parquet', 'arrow', 'csv' or None
+outputs['results_gpkg'] = False # also write the results in a GeoPackage (one point layer per scenario)
+outputs['isochrone_maps'] = False # polygons of the isochrone bands in GeoPackage files: True for all the scenarios, or a list of scenarios (ex: ['HCall_NC_WS'])
+outputs['isochrone_simplify'] = 0 # tolerance of the simplification of the polygons (in meters, 0 to keep the edges of the cells)
+outputs['isochrone_dissolve'] = False # write one multipolygon per isochrone band
 
 # Should temporary files be kept ?
 outputs['keep_temporary_files'] = False
@@ -35,8 +43,6 @@ datadir = '/home/shedecides/data/input'
 data['admin'] = ('admin1',os.path.join(datadir, 'Admin/gadm36_SEN_0.shp'))
 data['WOCBA_PPP'] = ('WOCBA_PPP',os.path.join(datadir, 'Population/ppp_prj_2014_SEN_WOCBA.tif'))
 data['POP_PPP'] = ('POP_PPP',os.path.join(datadir, 'Population/ppp_prj_2014_SEN.tif'))
-data['WOCBA_PPH'] = 'WOCBA'
-data['POP_PPH'] = 'POP'
 data['LULC'] = ('LULC',os.path.join(datadir, 'LandCover/esacci.tif'))
 data['HC'] = ('HC',os.path.join(datadir, 'Health/metadata_senegal.json'))
 data['GROUPS'] = os.path.join(datadir, 'Health/Senegal_Groups.json')
@@ -46,6 +52,10 @@ data['ROADS'] = ('OSM', os.path.join(datadir, 'Roads/OSM/osm_roads.shp'))
 data['STREAMS'] = 'STREAMS'
 
 # RULES CONCERNING THE CLASSIFICATION OF HEALTH FACILITIES
+# SQL 'where' conditions on the columns id, name, shortName, groupid, groupname, groupsetid,
+# groupsetname, x and y. The conditions "column = value", "column <> value" (or !=) and
+# "column [NOT] IN (values)", combined with AND, OR, NOT and parentheses, are evaluated in memory;
+# other conditions (ex: LIKE, <, IS NULL) are evaluated by the database (slower)
 hc_rules[1] = "groupid = 'elD2xyvPUxh'"
 hc_rules[2] = "groupid = 'Wx1Z05p1qwW' OR groupid = 'QDZvyQQZZN5'"
 
@@ -59,6 +69,11 @@ roads_veloc["NC"] = "1.2"
 streams_veloc["WS"] = "15.0"
 config_parameters['resolution'] = '100' # Resolution of cost surface in meters
 config_parameters['time_limits'] = ('30','60','120','240','360','480','9999999')  # time limits for isochrones (in minutes)
+config_parameters['stream_threshold'] = 1000 # minimum flow accumulation of the streams (in cells, see r.stream.extract)
+config_parameters['stream_length'] = 10 # minimum length of the first order streams (in cells)
+config_parameters['stream_grow_radius'] = 1.01 # radius used to enlarge the streams (in cells, see r.grow)
+config_parameters['stream_buffer'] = 10000 # hydrological buffer around the study area for the extraction of the streams (in meters)
+config_parameters['band_index_maps'] = True # Create band index rasters (CELL, 1 for the first band) used by the zonal statistics
 
 # RULES FILES (notably translation from land cover to friction cost)
 rule_file['Velocity_LULC'] = os.path.join(datadir, 'Velocity_LULC')
@@ -69,6 +84,9 @@ rule_file['Recode_streams'] = os.path.join(datadir, 'Recode_streams')
 # COMPUTATIONAL PARAMETERS
 config_parameters['njobs'] = 4 # Adapt according to the number of cores you want to use
 config_parameters['memory'] = 8000 # available RAM in MB
+config_parameters['tile_size'] = 0 # rows and columns of the tiles processed in parallel for the cell-local stages (0 to disable, ex: 4096 for continental regions)
+config_parameters['cost_backend'] = 'grass' # 'grass' (r.cost) or 'numpy' (in-memory engine, needs SciPy and RAM for ~16 edges per cell)
+config_parameters['walking_slope'] = None # slope penalty of the walking time of the no car scenarios: None (isotropic cost, 'cost_backend'), 'tobler' or 'naismith'; uses the in-memory engine, which needs RAM for ~16 edges per cell (see cost_engine.engine_memory)
 
 # GRASS GIS INSTALLATION INFORMATION
 
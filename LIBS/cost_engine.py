@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""
+In-memory multi-source cost distance engine, used as an alternative backend to 'r.cost -k'.
+
+The friction raster is turned into a sparse graph where each cell is linked to its 16 neighbours
+(8 adjacent cells and 8 Knight's moves), with the same edge costs than r.cost. A virtual node
+linked to all the start points with a zero cost allows to compute the accumulated cost from the
+nearest start point with a single Dijkstra run (scipy.sparse.csgraph), and the tree of predecessors
+gives the nearest start point (allocation) of each cell.
+
+With an elevation raster, the cost is anisotropic (walking): the cost of each move is multiplied by
+a slope factor (Tobler's hiking function or Naismith's rule, see slope_factor), for a walk towards
+the start points (the health facilities). The accumulated cost and the nearest start point are
+still computed together in one run, which r.walk can not do (it has no allocation output).
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+import grass.script as gscript
+from raster_io import read_raster, new_raster, write_raster
+
+# Slope models of the walking cost (see slope_factor)
+SLOPE_MODELS = ('tobler', 'naismith')
+# Walking time on flat terrain of Naismith's rule (minutes per meter, 5 km/h)
+NAISMITH_FLAT = 12.0/1000
+# Approximate memory of the engine: per edge (weight, indices and temporary arrays of the construction
+# of the graph) and per cell (friction, elevation, node ids, costs, predecessors, outputs), in bytes
+BYTES_PER_EDGE = 40
+BYTES_PER_CELL = 64
+
+
+def stencil(ns_res=1.0, ew_res=1.0, knight=True):
+    """Return the list of moves (drow, dcol, intermediate cells, distance factor) used by r.cost.
+
+    The distance factor is expressed in east-west cell units and already divided by the number
+    of cells averaged for the move, as in r.cost.
+    """
+    ew_fac = 1.0
+    ns_fac = float(ns_res)/float(ew_res)
+    diag_fac = np.sqrt(ew_fac**2 + ns_fac**2)
+    moves = []
+    for drow, dcol in ((0,1),(0,-1),(1,0),(-1,0)):
+        moves.append((drow, dcol, (), (ns_fac if drow else ew_fac)/2.0))
+    for drow, dcol in ((1,1),(1,-1),(-1,1),(-1,-1)):
+        moves.append((drow, dcol, (), diag_fac/2.0))
+    if knight:
+        v_diag_fac = np.sqrt(ew_fac**2 + 4*ns_fac**2)
+        h_diag_fac = np.sqrt(4*ew_fac**2 + ns_fac**2)
+        for drow, dcol in ((2,1),(2,-1),(-2,1),(-2,-1)):
+            moves.append((drow, dcol, ((drow//2,0),(drow//2,dcol)), v_diag_fac/4.0))
+        for drow, dcol in ((1,2),(-1,2),(1,-2),(-1,-2)):
+            moves.append((drow, dcol, ((0,dcol//2),(drow,dcol//2)), h_diag_fac/4.0))
+    return moves
+
+def engine_memory(cells, knight=True):
+    """Return the approximate peak memory (MB) of the engine for a region of 'cells' cells"""
+    edges = 16 if knight else 8
+    return cells*(edges*BYTES_PER_EDGE + BYTES_PER_CELL)/(1024.0*1024.0)
+
+def slope_factor(slope, model='tobler'):
+    """Return the walking time on a slope (rise over run, positive uphill) relative to flat terrain.
+
+    tobler --- Tobler's hiking function (speed of 6*exp(-3.5*|slope + 0.05|) km/h, the fastest on
+    a gentle descent).
+    naismith --- Naismith's rule (12 minutes per km plus 1 minute per 10 m of ascent), with
+    Langmuir's corrections for the descents (10 minutes per 300 m less on descents between 5 and
+    12 degrees and more on steeper descents).
+    """
+    slope = np.asarray(slope, dtype=np.float64)
+    if model == 'tobler':
+        return np.exp(3.5*(np.abs(slope + 0.05) - 0.05))
+    if model == 'naismith':
+        descent = -slope
+        gentle = (descent > np.tan(np.radians(5))) & (descent <= np.tan(np.radians(12)))
+        steep = descent > np.tan(np.radians(12))
+        return (1 + np.maximum(slope, 0)*(1/10.0)/NAISMITH_FLAT
+                + (steep.astype(np.float64) - gentle)*descent*(10/300.0)/NAISMITH_FLAT)
+    raise ValueError("Unknown slope model '%s' (%s)" % (model, ', '.join(SLOPE_MODELS)))
+
+def _window(array, drow, dcol, orow=0, ocol=0):
+    """Return the view of the cells at offset (orow, ocol) of all the cells having a neighbour at (drow, dcol)"""
+    rows, cols = array.shape
+    row0, row1 = max(0,-drow), rows-max(0,drow)
+    col0, col1 = max(0,-dcol), cols-max(0,dcol)
+    return array[row0+orow:row1+orow, col0+ocol:col1+ocol]
+
+def build_graph(friction, ns_res=1.0, ew_res=1.0, knight=True, elevation=None, slope_model='tobler'):
+    """Build the sparse graph of moves between the non-null cells of a friction array.
+
+    Null (NaN) and negative friction cells are barriers. Return the graph (one row per cell and
+    one more column for the virtual start node) and the array of node ids of the cells (-1 for barriers).
+    The graph only depends on the friction (and elevation) and can be reused for several sets of start points.
+    elevation --- optional elevation array (in the map units of the resolution, ex: meters): the cost
+    of each move is multiplied by the slope factor of the walk (see slope_factor), walking in the
+    reverse direction of the move, i.e. towards the start points (null elevation: no slope).
+    """
+    valid = np.isfinite(friction)
+    valid[valid] = friction[valid] >= 0
+    node_id = np.full(friction.shape, -1, dtype=np.int32)
+    nb_nodes = int(valid.sum())
+    node_id[valid] = np.arange(nb_nodes, dtype=np.int32)
+    friction = np.where(valid, friction, 0)
+    tails, heads, weights = [], [], []
+    for drow, dcol, intermediate, fac in stencil(ns_res, ew_res, knight):
+        src_id = _window(node_id, drow, dcol)
+        dst_id = _window(node_id, drow, dcol, drow, dcol)
+        ok = (src_id >= 0) & (dst_id >= 0)
+        cost = _window(friction, drow, dcol) + _window(friction, drow, dcol, drow, dcol)
+        for irow, icol in intermediate:
+            ok &= _window(node_id, drow, dcol, irow, icol) >= 0
+            cost = cost + _window(friction, drow, dcol, irow, icol)
+        weight = cost[ok]*fac
+        if elevation is not None:
+            # The graph is searched from the start points: the move is walked from its head to its tail
+            run = fac*(2 + len(intermediate))*ew_res
+            rise = _window(elevation, drow, dcol)[ok] - _window(elevation, drow, dcol, drow, dcol)[ok]
+            factor = slope_factor(rise/run, slope_model)
+            weight = weight*np.where(np.isnan(factor), 1, factor)
+        tails.append(src_id[ok])
+        heads.append(dst_id[ok])
+        weights.append(weight)
+    graph = sparse.csr_matrix((np.concatenate(weights),(np.concatenate(tails),np.concatenate(heads))),
+                              shape=(nb_nodes,nb_nodes+1))
+    return graph, node_id
+
+def cost_distance(friction, start_rows, start_cols, start_cats, ns_res=1.0, ew_res=1.0, knight=True, graph=None,
+                  start_costs=None, limit=np.inf, elevation=None, slope_model='tobler'):
+    """Compute the accumulated cost from the nearest start point and the category of that start point.
+
+    friction --- 2D array of cost per cell (NaN for null cells).
+    start_rows, start_cols --- row and column indices of the start points.
+    start_cats --- category of the start points, used for the allocation.
+    graph --- optional result of build_graph() for the same friction array.
+    start_costs --- optional initial cost of the start points (default: 0).
+    limit --- cells with a cost larger than this value are not reached.
+    elevation, slope_model --- optional elevation array for a walking cost (see build_graph).
+
+    Return a tuple of arrays (cost, nearest). Cells that cannot be reached have a NaN cost and a
+    nearest value of 0.
+    """
+    if graph is None:
+        graph = build_graph(friction, ns_res, ew_res, knight, elevation, slope_model)
+    graph, node_id = graph
+    start_rows = np.asarray(start_rows, dtype=np.int64)
+    start_cols = np.asarray(start_cols, dtype=np.int64)
+    start_cats = np.asarray(start_cats, dtype=np.int32)
+    if start_costs is None:
+        start_costs = np.zeros(len(start_cats))
+    start_costs = np.asarray(start_costs, dtype=np.float64)
+    start_nodes = node_id[start_rows, start_cols]
+    start_cats = start_cats[start_nodes >= 0]
+    start_costs = start_costs[start_nodes >= 0]
+    start_nodes = start_nodes[start_nodes >= 0]
+    # Link the virtual node to all the start points (explicit zeros are edges for csgraph)
+    nb_nodes = graph.shape[0]
+    virtual = nb_nodes
+    links, first = np.unique(start_nodes, return_index=True)
+    graph = sparse.csr_matrix((np.concatenate([graph.data, start_costs[first]]),
+                               np.concatenate([graph.indices, links]),
+                               np.append(graph.indptr, graph.indptr[-1]+len(links))),
+                              shape=(nb_nodes+1,nb_nodes+1))
+    distances, predecessors = dijkstra(graph, directed=True, indices=virtual, return_predecessors=True, limit=limit)
+    # Follow the tree of predecessors up to the start points (pointer jumping)
+    root = predecessors.astype(np.int64)
+    from_virtual = root == virtual
+    root[from_virtual] = np.nonzero(from_virtual)[0]
+    root[virtual] = virtual
+    reached = root >= 0
+    root[~reached] = virtual
+    while True:
+        next_root = root[root]
+        if np.array_equal(next_root, root):
+            break
+        root = next_root
+    node_cat = np.zeros(nb_nodes+1, dtype=np.int32)
+    node_cat[links] = start_cats[first]
+    node_cat = node_cat[root]
+    node_cat[~reached] = 0
+    cost = np.full(friction.shape, np.nan)
+    nearest = np.zeros(friction.shape, dtype=np.int32)
+    valid = node_id >= 0
+    cost[valid] = np.where(reached[:-1], distances[:-1], np.nan)
+    nearest[valid] = node_cat[:-1]
+    return cost, nearest
+
+def read_start_points(start_points):
+    """Return the row and column indices (in the current region) and the category of the points of a vector map"""
+    region = gscript.region()
+    rows, cols, cats = [], [], []
+    ascii = gscript.read_command('v.out.ascii', input=start_points, format='point', separator='comma', quiet=True)
+    for line in ascii.splitlines():
+        if not line.strip():
+            continue
+        values = line.split(',')
+        x, y, cat = float(values[0]), float(values[1]), int(values[-1])
+        row = int((region['n'] - y)/region['nsres'])
+        col = int((x - region['w'])/region['ewres'])
+        if 0 <= row < region['rows'] and 0 <= col < region['cols']:
+            rows.append(row)
+            cols.append(col)
+            cats.append(cat)
+    return rows, cols, cats
+
+def r_cost(input, start_points, output, nearest, knight=True, overwrite=False, elevation=None, slope_model='tobler'):
+    """Same as 'r.cost input= start_points= output= nearest=', with the in-memory engine, in the current region.
+
+    With an 'elevation' raster, the cost is the time of walking towards the start points, with the
+    slope penalties of 'slope_model' (see slope_factor), and the nearest start point of the walk.
+    """
+    region = gscript.region()
+    friction = read_raster(input)
+    heights = read_raster(elevation) if elevation else None
+    rows, cols, cats = read_start_points(start_points)
+    cost, allocation = cost_distance(friction, rows, cols, cats,
+                                     ns_res=region['nsres'], ew_res=region['ewres'], knight=knight,
+                                     elevation=heights, slope_model=slope_model)
+    del friction, heights
+    out = new_raster()
+    out[...] = np.where(np.isnan(cost), -1, cost)
+    write_raster(out, output, null=-1, overwrite=overwrite)
+    write_raster(allocation.astype(np.int32, copy=False), nearest, null=0, overwrite=overwrite)
@@ -1,85 +1,113 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Wed Apr  3 17:17:08 2019
-
-@author: tais
-"""
-
-# Import libs
-import os
-import pandas as pd
-import numpy as np
-
-def GetCatchmentCumulPopByISO(in_file, in_sep=';', out_file='', out_sep='', col_prefix="ISO", df_return=False):
-    """Get one line per health facility with cumulative population per isochrone"""
-    # Parameters for outputfile (path and sep)
-    if out_file == '':
-        path, ext = os.path.splitext(in_file)
-        out_file = "%s_clean%s"%(path,ext)
-    if out_sep == '':
-        out_sep = in_sep
-    # Import input csv
-    df = pd.read_csv(in_file, sep=in_sep)
-    # Create two new columns with the ID of health facility and isochrone value
-    df['HF_cat'] = df.apply (lambda row: int(row['label'].split(';')[0].split(" ")[-1]), axis=1)
-    df['ISO_cat'] = df.apply (lambda row: int(row['label'].split(';')[1].split(" ")[-1]), axis=1)
-    # Keep only required columns and sort by HF id and Isochrone value
-    df = df[['HF_cat','ISO_cat','sum']]
-    df.sort_values(['HF_cat','ISO_cat'],inplace=True)
-    # Compute cumulated population by increasing isochrone for each HF
-    cumul_by_HF = pd.Series([])
-    list_of_HF = list(set(df['HF_cat'].values))
-    for HF in list_of_HF:
-        df_HF = df.loc[df['HF_cat'] == HF]
-        a = df_HF['sum'].cumsum(axis=0)
-        cumul_by_HF = cumul_by_HF.add(a, fill_value=0)
-    df['cumul_sum'] = cumul_by_HF
-    # Pivot the table
-    df_pivot = pd.pivot_table(df, values='cumul_sum', index='HF_cat', columns='ISO_cat', aggfunc=np.min, fill_value=0)
-    df_pivot.rename(columns=lambda x: '%s_%s'%(col_prefix,x), inplace=True)
-    # Add column with total population
-    ISO_column_name = [ x for x in list(df_pivot)]
-    df_pivot['%s_TOT'%col_prefix] = df_pivot.iloc[:,-1]
-    ISO_column_name.append('%s_TOT'%col_prefix)
-    # Add percentage of population
-    for name in ISO_column_name:
-        iso_value = name[len(col_prefix)+1:]
-        df_pivot['%s_prct%s'%(col_prefix,iso_value)] = (df_pivot['%s'%name]/df_pivot['%s_TOT'%col_prefix])*100
-    # Export table as csv
-    df_pivot.to_csv(out_file, sep=out_sep)
-    # Return
-    if df_return:
-        return df_pivot
-
-def GetCatchmentPopByISO(in_file, in_sep=';', out_file='', out_sep='', col_prefix="ISO", df_return=False):
-    """Get one line per health facility with population per isochrone"""
-    # Parameters for outputfile (path and sep)
-    if out_file == '':
-        path, ext = os.path.splitext(in_file)
-        out_file = "%s_clean%s"%(path,ext)
-    if out_sep == '':
-        out_sep = in_sep
-    # Import input csv
-    df = pd.read_csv(in_file, sep=in_sep)
-    # Create two new columns with the ID of health facility and isochrone value
-    df['HF_cat'] = df.apply (lambda row: int(row['label'].split(';')[0].split(" ")[-1]), axis=1)
-    df['ISO_cat'] = df.apply (lambda row: int(row['label'].split(';')[1].split(" ")[-1]), axis=1)
-    # Keep only required columns and sort by HF id and Isochrone value
-    df = df[['HF_cat','ISO_cat','sum']]
-    df.sort_values(['HF_cat','ISO_cat'],inplace=True)
-    # Pivot the table
-    df_pivot = pd.pivot_table(df, values='sum', index='HF_cat', columns='ISO_cat', aggfunc=np.min, fill_value=0)
-    df_pivot.rename(columns=lambda x: '%s_%s'%(col_prefix,x), inplace=True)
-    # Add column with total population
-    ISO_column_name = [ x for x in list(df_pivot)]
-    df_pivot['%s_TOT'%col_prefix] = sum([df_pivot['%s'%name] for name in ISO_column_name])
-    ISO_column_name.append('%s_TOT'%col_prefix)
-    # Add percentage of population
-    for name in ISO_column_name:
-        iso_value = name[len(col_prefix)+1:]
-        df_pivot['%s_prct%s'%(col_prefix,iso_value)] = (df_pivot['%s'%name]/df_pivot['%s_TOT'%col_prefix])*100
-    # Export table as csv
-    df_pivot.to_csv(out_file, sep=out_sep)
-    # Return
-    if df_return:
-        return df_pivot
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Apr  3 17:17:08 2019
+
+@author: tais
+"""
+
+# Import libs
+import os
+import re
+import itertools
+import pandas as pd
+import numpy as np
+
+# Regular expression extracting the ID of health facility and the isochrone value from the
+# labels of r.cross (ex: 'category 12; category 60'): last word before and after the ';'.
+# It is applied once on all the labels joined by newlines (one match per line).
+LABEL_REGEX = re.compile(r'(-?\d+);[^;\n]*?(-?\d+)[ \t]*$', re.MULTILINE)
+
+def _read_catchment_table(in_data, in_sep=';'):
+    """Return a table with the columns 'HF_cat', 'ISO_cat' and 'sum', sorted by HF id and Isochrone value.
+
+    in_data --- path of the csv of r.univar -t on the r.cross map (with a 'label' column),
+    or an in-memory pandas DataFrame (with either a 'label' column or 'HF_cat' and 'ISO_cat' columns),
+    or a numpy array with three columns (HF_cat, ISO_cat, sum) or the corresponding fields.
+    """
+    if isinstance(in_data, pd.DataFrame):
+        df = in_data
+    elif isinstance(in_data, np.ndarray):
+        if in_data.dtype.names:
+            df = pd.DataFrame(in_data)
+        else:
+            df = pd.DataFrame(in_data, columns=['HF_cat','ISO_cat','sum'])
+    else:
+        df = pd.read_csv(in_data, sep=in_sep)
+    if 'HF_cat' not in df.columns or 'ISO_cat' not in df.columns:
+        # Create two new columns with the ID of health facility and isochrone value
+        cats = LABEL_REGEX.findall('\n'.join(df['label'].astype(str)))
+        if len(cats) != len(df):
+            raise ValueError("%s labels can not be parsed" % (len(df)-len(cats)))
+        cats = np.fromstring(' '.join(itertools.chain.from_iterable(cats)), dtype=np.int64, sep=' ').reshape(len(df), 2)
+        df = pd.DataFrame({'HF_cat': cats[:,0], 'ISO_cat': cats[:,1], 'sum': df['sum'].values})
+    else:
+        df = df.copy()
+        df['HF_cat'] = df['HF_cat'].astype(int)
+        df['ISO_cat'] = df['ISO_cat'].astype(int)
+    # Keep only required columns and sort by HF id and Isochrone value
+    df = df[['HF_cat','ISO_cat','sum']]
+    df.sort_values(['HF_cat','ISO_cat'],inplace=True)
+    return df
+
+def _output_file(in_data, out_file):
+    """Return the path of the output csv (default: input path with '_clean' suffix, none for in-memory input)"""
+    if out_file == '' and isinstance(in_data, basestring):
+        path, ext = os.path.splitext(in_data)
+        out_file = "%s_clean%s"%(path,ext)
+    return out_file
+
+def _add_percentages(df_pivot, ISO_column_name, col_prefix):
+    """Add the percentage of population of each column compared to the total"""
+    total = df_pivot['%s_TOT'%col_prefix]
+    prct = pd.DataFrame(dict(('%s_prct%s'%(col_prefix,name[len(col_prefix)+1:]), (df_pivot[name]/total)*100)
+                             for name in ISO_column_name), index=df_pivot.index)
+    prct = prct[['%s_prct%s'%(col_prefix,name[len(col_prefix)+1:]) for name in ISO_column_name]]
+    return pd.concat([df_pivot, prct], axis=1)
+
+def GetCatchmentCumulPopByISO(in_file, in_sep=';', out_file='', out_sep='', col_prefix="ISO", df_return=False):
+    """Get one line per health facility with cumulative population per isochrone"""
+    # Parameters for outputfile (path and sep)
+    out_file = _output_file(in_file, out_file)
+    if out_sep == '':
+        out_sep = in_sep
+    df = _read_catchment_table(in_file, in_sep)
+    # Compute cumulated population by increasing isochrone for each HF
+    df['cumul_sum'] = df.groupby('HF_cat')['sum'].cumsum().astype(np.float64)
+    # Pivot the table
+    df_pivot = pd.pivot_table(df, values='cumul_sum', index='HF_cat', columns='ISO_cat', aggfunc=np.min, fill_value=0)
+    df_pivot.rename(columns=lambda x: '%s_%s'%(col_prefix,x), inplace=True)
+    # Add column with total population
+    ISO_column_name = [ x for x in list(df_pivot)]
+    df_pivot['%s_TOT'%col_prefix] = df_pivot.iloc[:,-1]
+    ISO_column_name.append('%s_TOT'%col_prefix)
+    # Add percentage of population
+    df_pivot = _add_percentages(df_pivot, ISO_column_name, col_prefix)
+    # Export table as csv
+    if out_file:
+        df_pivot.to_csv(out_file, sep=out_sep)
+    # Return
+    if df_return:
+        return df_pivot
+
+def GetCatchmentPopByISO(in_file, in_sep=';', out_file='', out_sep='', col_prefix="ISO", df_return=False):
+    """Get one line per health facility with population per isochrone"""
+    # Parameters for outputfile (path and sep)
+    out_file = _output_file(in_file, out_file)
+    if out_sep == '':
+        out_sep = in_sep
+    df = _read_catchment_table(in_file, in_sep)
+    # Pivot the table
+    df_pivot = pd.pivot_table(df, values='sum', index='HF_cat', columns='ISO_cat', aggfunc=np.min, fill_value=0)
+    df_pivot.rename(columns=lambda x: '%s_%s'%(col_prefix,x), inplace=True)
+    # Add column with total population (summed column by column, in increasing isochrone order)
+    ISO_column_name = [ x for x in list(df_pivot)]
+    df_pivot['%s_TOT'%col_prefix] = sum([df_pivot['%s'%name] for name in ISO_column_name])
+    ISO_column_name.append('%s_TOT'%col_prefix)
+    # Add percentage of population
+    df_pivot = _add_percentages(df_pivot, ISO_column_name, col_prefix)
+    # Export table as csv
+    if out_file:
+        df_pivot.to_csv(out_file, sep=out_sep)
+    # Return
+    if df_return:
+        return df_pivot
@@ -30,7 +30,8 @@ def setup_environmental_variables():
     os.environ['PYTHONPATH'] += os.pathsep + os.path.join(os.environ['GISBASE'],'etc','python','grass','script')
     os.environ['PYTHONLIB'] = config_parameters['PYTHONLIB']
     os.environ['LD_LIBRARY_PATH'] += os.pathsep + os.path.join(os.environ['GISBASE'],'lib')
-    os.environ['GIS_LOCK'] = '$$'
+    # Lock of the session, unique per process (several chains can run concurrently, see batch.py)
+    os.environ['GIS_LOCK'] = str(os.getpid())
     os.environ['GISRC'] = os.path.join(config_parameters['workingdir'], '.grass7', 'rc')
     # The following should only be necessary on MS Windows or for custom GDAL
     # installations
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+Functions exporting the population per health facility of all the scenarios in one table.
+
+The statistics computed from the rasters (see zonal_stats.py) are assembled in memory in a single
+long-format table, with one row per health facility, scenario (health facility level, car, season),
+population layer and isochrone band. The table is written in one bulk operation, in a columnar file
+(Parquet or Arrow, with pyarrow) or in csv, and optionally in a GeoPackage with one point
+layer per scenario. The attributes of the health facilities are read from the json files, so the
+attribute tables of the GRASS GIS vector maps are not used.
+"""
+
+import numpy as np
+import pandas as pd
+from zonal_stats import band_values
+from import_json import facility_table, facility_levels, rules_need_sql
+
+# Columns of the results table
+RESULT_COLUMNS = ['facility', 'facility_id', 'facility_name', 'facility_level', 'level', 'car', 'season',
+                  'population', 'band', 'sum', 'share']
+
+
+def _vector_levels(vector, nb_units):
+    """Return the level of each health facility from the attribute table of their point map (0 if absent)"""
+    import grass.script as gscript
+    level = np.zeros(nb_units, dtype=np.int32)
+    for cat, values in gscript.vector_db_select(vector, columns='level')['values'].items():
+        if values[0]:
+            level[int(cat)-1] = int(values[0])
+    return level
+
+def facility_attributes(units, groups, groupsets, hc_rules, vector=None):
+    """Return the attributes of the health facilities (see import_json.py) as a DataFrame indexed by
+    category (the order of the units in the json file, starting at 1).
+
+    vector --- point map of the health facilities (see import_json.create_facility_map), whose
+    levels are used when the rules have to be evaluated by the database (see rules_need_sql).
+    """
+    table = facility_table(units, groups, groupsets)
+    if vector and rules_need_sql(hc_rules):
+        level = _vector_levels(vector, len(table['id']))
+    else:
+        level = facility_levels(table, hc_rules)
+    facilities = pd.DataFrame({'id': table['id'], 'name': table['name'], 'x': table['x'], 'y': table['y'],
+                               'level': level},
+                              index=pd.Index(np.arange(1, len(table['id'])+1), name='cat'))
+    return facilities[['id', 'name', 'level', 'x', 'y']]
+
+def results_table(facility_stats, scenarios, layers_stats, time_limits, facilities, start_points):
+    """Return the long-format table of the population per health facility of all the scenarios.
+
+    facility_stats --- list (one item per scenario) of the tables of each population layer (see
+    zonal_stats.facility_population_stats).
+    scenarios --- names of the scenarios ('HC<level>_<car>_<season>', ex: 'HCall_WC_DS').
+    layers_stats --- list of population rasters.
+    time_limits --- time limits of the isochrones bands.
+    facilities --- attributes of the health facilities (see facility_attributes).
+    start_points --- dictionary level of the scenario (ex: 'all', 'L2') -> categories of its health
+    facilities; the facilities without population get rows with zeros.
+
+    The 'sum' is the population of the facility catchment in the band and 'share' the proportion
+    (0 to 1) of the population of the catchment of the facility which is in the band.
+    """
+    bands = band_values(time_limits)
+    columns = dict((name, []) for name in RESULT_COLUMNS)
+    for scenario, scenario_stats in zip(scenarios, facility_stats):
+        hc_level, car, season = scenario.split('_')
+        level = hc_level[2:]
+        cats = np.asarray(sorted(start_points[level]), dtype=np.int64)
+        attributes = facilities.reindex(cats)
+        for layer in layers_stats:
+            stats = scenario_stats[layer]
+            sums = pd.pivot_table(stats, values='sum', index='HF_cat', columns='ISO_cat', aggfunc=np.sum)
+            sums = sums.reindex(index=cats, columns=bands).fillna(0).values
+            totals = sums.sum(axis=1)
+            shares = np.divide(sums, totals[:, np.newaxis], out=np.zeros_like(sums), where=totals[:, np.newaxis] > 0)
+            nb_rows = sums.size
+            columns['facility'].append(np.repeat(cats, len(bands)))
+            columns['facility_id'].append(np.repeat(attributes['id'].values, len(bands)))
+            columns['facility_name'].append(np.repeat(attributes['name'].values, len(bands)))
+            columns['facility_level'].append(np.repeat(attributes['level'].fillna(0).values.astype(np.int32), len(bands)))
+            columns['level'].append(np.repeat(level, nb_rows))
+            columns['car'].append(np.repeat(car, nb_rows))
+            columns['season'].append(np.repeat(season, nb_rows))
+            columns['population'].append(np.repeat(layer, nb_rows))
+            columns['band'].append(np.tile(bands, len(cats)))
+            columns['sum'].append(sums.ravel())
+            columns['share'].append(shares.ravel())
+    table = pd.DataFrame(dict((name, np.concatenate(values) if values else []) for name, values in columns.items()))
+    return table[RESULT_COLUMNS]
+
+def write_results(table, output_file, file_format='parquet'):
+    """Write the results table in a single file ('parquet', 'arrow' (IPC file format) or 'csv').
+
+    The Parquet and Arrow formats need pyarrow. Return the path of the file.
+    """
+    if file_format == 'csv':
+        table.to_csv(output_file, sep=',', index=False)
+        return output_file
+    import pyarrow as pa
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(arrow_table, output_file)
+    elif file_format == 'arrow':
+        sink = pa.OSFile(output_file, 'wb')
+        try:
+            writer = pa.RecordBatchFileWriter(sink, arrow_table.schema)
+            writer.write_table(arrow_table)
+            writer.close()
+        finally:
+            sink.close()
+    else:
+        raise ValueError("Unknown format of the results table '%s'" % file_format)
+    return output_file
+
+def write_results_gpkg(table, facilities, gpkg_file):
+    """Write the results in a GeoPackage with one point layer per scenario (WGS84 coordinates of
+    the health facilities), with one column per population layer and band ('<prefix>_<band>',
+    prefix = first part of the name of the population layer) and the total ('<prefix>_TOT').
+
+    Each layer is written in a single transaction.
+    """
+    from osgeo import ogr, osr
+    ogr.UseExceptions()
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    datasource = ogr.GetDriverByName('GPKG').CreateDataSource(gpkg_file)
+    for (level, car, season), scenario in table.groupby(['level', 'car', 'season'], sort=False):
+        wide = pd.pivot_table(scenario, values='sum', index='facility', columns=['population', 'band'], aggfunc=np.sum)
+        fields = []
+        for population in scenario['population'].unique():
+            prefix = population.split('_')[0]
+            for band in wide[population].columns:
+                fields.append(('%s_%s' % (prefix, band), wide[(population, band)].values))
+            fields.append(('%s_TOT' % prefix, wide[population].sum(axis=1).values))
+        attributes = facilities.reindex(wide.index)
+        layer = datasource.CreateLayer('HC%s_%s_%s' % (level, car, season), srs, ogr.wkbPoint)
+        layer.CreateField(ogr.FieldDefn('cat', ogr.OFTInteger))
+        layer.CreateField(ogr.FieldDefn('id', ogr.OFTString))
+        layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+        layer.CreateField(ogr.FieldDefn('level', ogr.OFTInteger))
+        for name, values in fields:
+            layer.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+        definition = layer.GetLayerDefn()
+        layer.StartTransaction()
+        for i, cat in enumerate(wide.index):
+            feature = ogr.Feature(definition)
+            feature.SetField('cat', int(cat))
+            feature.SetField('id', attributes['id'].iat[i])
+            feature.SetField('name', attributes['name'].iat[i])
+            feature.SetField('level', int(attributes['level'].fillna(0).iat[i]))
+            for name, values in fields:
+                feature.SetField(name, float(values[i]))
+            point = ogr.Geometry(ogr.wkbPoint)
+            point.AddPoint_2D(float(attributes['x'].iat[i]), float(attributes['y'].iat[i]))
+            feature.SetGeometry(point)
+            layer.CreateFeature(feature)
+        layer.CommitTransaction()
+    datasource = None
+    return gpkg_file
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Functions reducing the overhead of the GRASS GIS commands of the processing chain.
+
+Each GRASS GIS command is a new process, which reads the environment, the location and the region
+before doing any work. For the trivial commands (setting the region, removing or renaming layers,
+updating attributes), this start-up is most of the cost. Within a command session (see
+command_session(), or start_session() and stop_session()), the functions of grass.script are
+wrapped so that:
+- the region of the session is memorized: 'g.region -d' is skipped when the current region is
+  already the default one, and gscript.region() is answered from memory until the region changes
+  (any g.region call or change of GISRC invalidates it);
+- the commands are counted and timed, and the start-up time of a module is measured once with a
+  command doing no work, so session_report() gives the estimated time spent on process spawning
+  versus actual work (for the commands of the main process).
+The original functions are restored at the end of the session. Independently of the session,
+remove_layers(), rename_layers() and update_columns() do the metadata operations of several layers
+or rows in a single command (the updates in a single SQL transaction).
+"""
+
+import os
+import time
+import contextlib
+import grass.script as gscript
+import grass.script.core as gcore
+
+# State of the session of the current process
+_session = {'gisrc': None, 'default_region': False, 'region': None, 'spawn': None,
+            'commands': 0, 'skipped': 0, 'wall': 0.0}
+_grass_functions = {}
+
+
+def _region_changed(args, kwargs):
+    """Return True if a command can change the region of the mapset (g.region without 'u' flag)"""
+    if not args or args[0] != 'g.region' or 'u' in kwargs.get('flags', ''):
+        return False
+    env = kwargs.get('env')
+    return env is None or env.get('GISRC') == os.environ.get('GISRC')
+
+def _check_gisrc():
+    """Forget the region if the session changed (ex: other mapset, see working_mapset)"""
+    if _session['gisrc'] != os.environ.get('GISRC'):
+        _session['gisrc'] = os.environ.get('GISRC')
+        _session['default_region'] = False
+        _session['region'] = None
+
+def _session_start_command(*args, **kwargs):
+    """gcore.start_command() forgetting the region when it can be changed by the command"""
+    if _region_changed(args, kwargs):
+        _session['default_region'] = False
+        _session['region'] = None
+    return _grass_functions['start_command'](*args, **kwargs)
+
+def _session_run_command(*args, **kwargs):
+    """gscript.run_command() skipping the redundant 'g.region -d' and timing the commands"""
+    _check_gisrc()
+    default = (args and args[0] == 'g.region' and kwargs.get('flags') == 'd' and
+               len(kwargs) == 1 and 'GRASS_REGION' not in os.environ and 'WIND_OVERRIDE' not in os.environ)
+    if default and _session['default_region']:
+        _session['skipped'] += 1
+        return 0
+    begin = time.time()
+    result = _grass_functions['run_command'](*args, **kwargs)
+    _session['commands'] += 1
+    _session['wall'] += time.time() - begin
+    if default or (args[0] == 'g.region' and 's' in kwargs.get('flags', '')):
+        # The current region is the default one ('-s' saves the current region as default)
+        _session['default_region'] = True
+    return result
+
+def _session_region(region3d=False, complete=False, env=None):
+    """gscript.region() answered from memory while the region does not change"""
+    _check_gisrc()
+    if region3d or complete or env is not None or 'GRASS_REGION' in os.environ or 'WIND_OVERRIDE' in os.environ:
+        return _grass_functions['region'](region3d=region3d, complete=complete, env=env)
+    if _session['region'] is None:
+        _session['region'] = _grass_functions['region']()
+    return dict(_session['region'])
+
+def start_session(calibration_runs=5):
+    """Start the command layer in the current GRASS GIS session (see the module documentation).
+
+    The start-up time of a module is measured as the median wall time of 'calibration_runs'
+    runs of g.gisenv (which only reads the session file).
+    """
+    if not _grass_functions:
+        _grass_functions['start_command'] = gcore.start_command
+        _grass_functions['script_start_command'] = gscript.start_command
+        _grass_functions['run_command'] = gscript.run_command
+        _grass_functions['region'] = gscript.region
+        gcore.start_command = _session_start_command
+        gscript.start_command = _session_start_command
+        gscript.run_command = _session_run_command
+        gscript.region = _session_region
+    _check_gisrc()
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for run in range(calibration_runs):
+            begin = time.time()
+            _grass_functions['run_command']('g.gisenv', quiet=True, stdout=devnull)
+            times.append(time.time() - begin)
+    _session['spawn'] = sorted(times)[len(times)//2] if times else 0.0
+
+def stop_session():
+    """Stop the command layer: restore the original functions of grass.script"""
+    if _grass_functions:
+        gcore.start_command = _grass_functions['start_command']
+        gscript.start_command = _grass_functions['script_start_command']
+        gscript.run_command = _grass_functions['run_command']
+        gscript.region = _grass_functions['region']
+        _grass_functions.clear()
+
+@contextlib.contextmanager
+def command_session(calibration_runs=5):
+    """Context manager delimiting a command session (see start_session and stop_session)"""
+    start_session(calibration_runs)
+    try:
+        yield
+    finally:
+        stop_session()
+
+def _chunks(names, size=200):
+    """Split a list of names in lists of at most 'size' names (length of the command lines)"""
+    return [names[i:i+size] for i in range(0, len(names), size)]
+
+def remove_layers(layer_type, names):
+    """Remove several layers of the same type ('raster' or 'vector') with a single g.remove"""
+    for chunk in _chunks(list(names)):
+        gscript.run_command('g.remove', flags='f', quiet=True, type=layer_type, name=','.join(chunk))
+
+def rename_layers(layer_type, pairs, overwrite=True):
+    """Rename several layers of the same type with a single g.rename ('pairs' = list of (old, new) names)"""
+    for chunk in _chunks(list(pairs)):
+        gscript.run_command('g.rename', overwrite=overwrite, quiet=True,
+                            **{layer_type: ','.join('%s,%s' % pair for pair in chunk)})
+
+def _sql_value(value):
+    """Return a value as a SQL literal"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, basestring):
+        return "'%s'" % value.replace("'", "''")
+    return repr(value)
+
+def update_columns(vector, updates, layer=1):
+    """Update columns of the attribute table of a vector map in a single SQL transaction (instead of
+    one v.db.update per condition).
+
+    updates --- list of (SQL 'where' condition, dictionary column -> new value), applied in order
+    (ex: [("groupid = 'elD2xyvPUxh'", {'level': 1})]).
+    """
+    if not updates:
+        return
+    db = gscript.vector_db(vector)[int(layer)]
+    statements = ['BEGIN TRANSACTION;']
+    for where, columns in updates:
+        assignments = ', '.join('%s = %s' % (column, _sql_value(value)) for column, value in sorted(columns.items()))
+        statements.append('UPDATE %s SET %s WHERE %s;' % (db['table'], assignments, where))
+    statements.append('COMMIT;')
+    sql_file = gscript.tempfile()
+    with open(sql_file, 'w') as fout:
+        fout.write('\n'.join(statements) + '\n')
+    gscript.run_command('db.execute', input=sql_file, database=db['database'], driver=db['driver'])
+    os.remove(sql_file)
+
+def session_report():
+    """Print and return the number of commands, the commands skipped and the estimated time spent
+    on process spawning versus actual work (for the commands of the current process)"""
+    spawn = _session['commands'] * (_session['spawn'] or 0.0)
+    report = {'commands': _session['commands'], 'skipped': _session['skipped'], 'wall': _session['wall'],
+              'spawn_per_command': _session['spawn'], 'spawn': spawn, 'work': max(0.0, _session['wall'] - spawn)}
+    print "GRASS GIS commands: %d run, %d skipped" % (report['commands'], report['skipped'])
+    print "  %.1f s in total, ~%.1f s of process spawning (%.3f s per command), ~%.1f s of work" % (
+        report['wall'], report['spawn'], report['spawn_per_command'] or 0.0, report['work'])
+    return report
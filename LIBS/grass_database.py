@@ -48,3 +48,27 @@ def working_mapset(gisdb_path,location_name,mapset_name):
         print "You are now working in mapset '%s'"%mapset_name
     else: 
         print "'%s' mapset doesn't exists in '%s'"%(mapset_name, gisdb_path)
+
+def create_temp_mapset(gisdb_path,location_name,mapset_name):
+    """Create an isolated mapset holding a copy of the default region and return the path of its GISRC file.
+
+    The mapset can be used by a worker process (by pointing the 'GISRC' environment variable
+    to the returned file) without interfering with the region or the MASK of other sessions.
+    """
+    mapset_path = os.path.join(gisdb_path,location_name,mapset_name)
+    if not os.path.exists(mapset_path):
+        os.makedirs(mapset_path)
+    shutil.copy(os.path.join(gisdb_path,location_name,'PERMANENT','DEFAULT_WIND'),os.path.join(mapset_path,'WIND'))
+    gisrc = os.path.join(mapset_path,'.gisrc')
+    with open(gisrc, 'w') as fout:
+        fout.write("GISDBASE: %s\n"%gisdb_path)
+        fout.write("LOCATION_NAME: %s\n"%location_name)
+        fout.write("MAPSET: %s\n"%mapset_name)
+        fout.write("GUI: text\n")
+    return gisrc
+
+def remove_temp_mapset(gisdb_path,location_name,mapset_name):
+    """Delete a mapset created with create_temp_mapset()"""
+    mapset_path = os.path.join(gisdb_path,location_name,mapset_name)
+    if os.path.exists(mapset_path):
+        shutil.rmtree(mapset_path)
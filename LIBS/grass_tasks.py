@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Functions running independent GRASS GIS commands in parallel.
+
+Each task is a GRASS GIS module with its parameters, and optionally its own region and MASK:
+- the region is given to the module with the GRASS_REGION environment variable, which overrides the
+  region of the mapset for this command only, so the tasks share the mapset without changing its region;
+- a task with a MASK runs in its own temporary mapset (see grass_database.py), in which the raster
+  is used as MASK, and its output rasters are copied back in the current mapset.
+The tasks are run by a bounded pool of worker processes and their results are returned in the
+order of the tasks. The first failed task stops the pool and raises a GrassTaskError with the
+error message of the module.
+
+The same pool (run_parallel) runs the other independent units of work of the chain, which are
+python functions calling GRASS GIS or GDAL: the cost distance scenarios (parallel_cost.py), the
+tiles (tiling.py), the warped layers (reproject.py) and the isochrone maps (isochrone_maps.py).
+"""
+
+import os
+import traceback
+from multiprocessing import Pool
+import grass.script as gscript
+from grass_database import create_temp_mapset, remove_temp_mapset
+
+
+class GrassTaskError(RuntimeError):
+    """Error raised when a task fails (the message gives the command and the error of the module)"""
+    pass
+
+
+def grass_task(module, region=None, mask=None, outputs=(), read=False, **kwargs):
+    """Return a task running a GRASS GIS module with the parameters 'kwargs'.
+
+    region --- dictionary of g.region parameters (ex: {'raster': 'Study_area'} or n, s, e, w, res),
+    the region of the mapset is used if None.
+    mask --- raster used as MASK for this task only.
+    outputs --- output rasters of the task, copied back in the current mapset if 'mask' is given.
+    read --- True to return the standard output of the module (ex: r.univar -g).
+    """
+    return {'module': module, 'kwargs': kwargs, 'region': region, 'mask': mask, 'outputs': list(outputs),
+            'read': read}
+
+def _task_command(task):
+    """Return the command line of a task (for the messages)"""
+    return ' '.join([task['module']] + ['%s=%s' % item for item in sorted(task['kwargs'].items())])
+
+def _run_masked(task, env):
+    """Run a task in a temporary mapset with its own MASK, and copy its outputs back"""
+    gisenv = gscript.gisenv()
+    # One task at a time per process (the random temporary names are the same in forked workers)
+    temp_mapset = "tmp_task_%s" % os.getpid()
+    gisrc = create_temp_mapset(gisenv['GISDBASE'], gisenv['LOCATION_NAME'], temp_mapset)
+    temp_env = dict(env)
+    temp_env['GISRC'] = gisrc
+    try:
+        gscript.run_command('g.mapsets', operation='add', mapset=gisenv['MAPSET'], quiet=True, env=temp_env)
+        gscript.run_command('r.mask', overwrite=True, quiet=True, raster='%s@%s' % (task['mask'], gisenv['MAPSET']),
+                            env=temp_env)
+        gscript.run_command(task['module'], env=temp_env, **task['kwargs'])
+        for output in task['outputs']:
+            gscript.run_command('g.copy', overwrite=True, quiet=True, raster='%s@%s,%s' % (output, temp_mapset, output),
+                                env=env)
+    finally:
+        remove_temp_mapset(gisenv['GISDBASE'], gisenv['LOCATION_NAME'], temp_mapset)
+
+def run_task(task):
+    """Run a task in the current process. Return the standard output of the module if the task
+    is created with 'read', None otherwise. Raise GrassTaskError if the task fails."""
+    env = dict(os.environ)
+    try:
+        if task['region'] is not None:
+            env['GRASS_REGION'] = gscript.region_env(**task['region'])
+        if task['mask'] is not None:
+            _run_masked(task, env)
+            return None
+        if task['read']:
+            return gscript.read_command(task['module'], env=env, **task['kwargs'])
+        gscript.run_command(task['module'], env=env, **task['kwargs'])
+        return None
+    except Exception as error:
+        # The module errors are converted in a GrassTaskError, which (unlike CalledModuleError)
+        # can be sent back from a worker process
+        raise GrassTaskError("Task '%s' failed: %s\n%s" % (_task_command(task), error, traceback.format_exc()))
+
+def _call(task):
+    """Call a function in a worker process, its errors are converted in GrassTaskError (worker function)"""
+    function, item = task
+    try:
+        return function(item)
+    except GrassTaskError:
+        raise
+    except Exception as error:
+        raise GrassTaskError("%s failed: %s\n%s" % (function.__name__, error, traceback.format_exc()))
+
+def run_parallel(function, items, n_jobs=1):
+    """Call 'function(item)' for each item in a pool of at most 'n_jobs' processes ('function' must
+    be defined at the top level of a module). The items are run in the current process if
+    'n_jobs' is 1 or if there is a single item.
+
+    Return the list of the results, in the order of the items. In the pool, the first error
+    raises a GrassTaskError (with the traceback of the worker) and the remaining items are cancelled.
+    """
+    if n_jobs <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    p = Pool(min(n_jobs, len(items)))
+    try:
+        results = list(p.imap(_call, [(function, item) for item in items], chunksize=1))
+        p.close()
+        p.join()
+    finally:
+        p.terminate()
+    return results
+
+def run_tasks(tasks, n_jobs=1):
+    """Run independent tasks (see grass_task) in a pool of at most 'n_jobs' processes.
+
+    Return the list of the results of the tasks (see run_task), in the order of the tasks.
+    The first failed task raises a GrassTaskError and the remaining tasks are cancelled.
+    """
+    return run_parallel(run_task, tasks, n_jobs)
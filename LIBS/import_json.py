@@ -1,118 +1,426 @@
+import io
+import re
 import sys
 import json
+import numpy as np
 import grass.script as grass
+from grass_commands import update_columns
+
+# Size of the blocks read from the json files
+CHUNK_SIZE = 1024*1024
+# Tokens used to skip the values that are not needed: strings (complete or not) and brackets
+SKIP_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|"|[\[\]{}]')
+WHITESPACES = re.compile(r'[ \t\n\r]*')
+
+
+class _JSONStream(object):
+    """Incremental reader of the arrays of the top level object of a json file.
+
+    Only one item of the array is held in memory at a time and the other values of the
+    top level object are skipped without being decoded.
+    """
+
+    def __init__(self, fin):
+        self.fin = fin
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _more(self, size=CHUNK_SIZE):
+        """Read the next block of the file, return False at the end of the file"""
+        if self.eof:
+            return False
+        chunk = self.fin.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Return the next non whitespace character (without consuming it)"""
+        while True:
+            self.pos = WHITESPACES.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Unexpected end of json file")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("Expected '%s' at position %s of the json buffer" % (char, self.pos))
+        self.pos += 1
+
+    def _decode(self):
+        """Decode the next value, reading more data while the value is incomplete"""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number could continue in the next block
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Double the size of the buffer, so that large values are not decoded too many times
+            self._more(max(CHUNK_SIZE, len(self.buf)-self.pos))
+
+    def _skip(self):
+        """Skip the next value without decoding it"""
+        if self._peek() not in '[{':
+            self._decode()
+            return
+        depth = 0
+        while True:
+            for match in SKIP_TOKENS.finditer(self.buf, self.pos):
+                token = match.group()
+                if token == '"':
+                    # Incomplete string, read more and continue from its beginning
+                    self.pos = match.start()
+                    break
+                self.pos = match.end()
+                if token in '[{':
+                    depth += 1
+                elif token in ']}':
+                    depth -= 1
+                    if depth == 0:
+                        return
+            else:
+                self.pos = len(self.buf)
+            if not self._more():
+                raise ValueError("Unexpected end of json file")
+
+    def iter_array(self, key):
+        """Yield the items of the array 'key' of the top level object"""
+        self._expect('{')
+        while self._peek() != '}':
+            if self.buf[self.pos] == ',':
+                self.pos += 1
+            name = self._decode()
+            self._expect(':')
+            if name != key:
+                self._skip()
+                continue
+            self._expect('[')
+            while self._peek() != ']':
+                if self.buf[self.pos] == ',':
+                    self.pos += 1
+                yield self._decode()
+            self.pos += 1
+
+def iter_json_array(json_file, key):
+    """Yield the items of the array 'key' of a json file (ex: 'organisationUnits' of a DHIS2 export),
+    without loading the whole file in memory"""
+    with io.open(json_file, 'r', encoding='utf-8') as fin:
+        for item in _JSONStream(fin).iter_array(key):
+            yield item
+
+# Tokens of the 'where' conditions of the rules classifying the health facilities
+RULE_TOKENS = re.compile(r"\s*(?:(?P<string>'(?:[^']|'')*')|(?P<number>-?\d+(?:\.\d*)?)|(?P<op><>|!=|=|\(|\)|,)|(?P<word>\w+))")
+# Columns of the table of the health facilities (see facility_table), usable in the rules
+RULE_COLUMNS = {'id': np.bytes_, 'x': np.float64, 'y': np.float64, 'name': np.bytes_, 'shortName': np.bytes_,
+                'groupid': np.bytes_, 'groupname': np.bytes_, 'groupsetid': np.bytes_, 'groupsetname': np.bytes_}
+
+
+class RuleSyntaxError(ValueError):
+    """Error raised when a rule is outside of the grammar evaluated in memory (see evaluate_rule)"""
+    pass
+
+
+def _group_index(memberships, ids):
+    """Return the index of the group of each id in the memberships of get_groups()/get_groupsets()
+    (-1 if the id is not a member of any group)"""
+    member = memberships['member']
+    if not len(member):
+        return np.full(len(ids), -1, dtype=np.int32)
+    position = np.minimum(np.searchsorted(member, ids), len(member)-1)
+    return np.where(member[position] == ids, memberships['index'][position], -1)
+
+def facility_table(units, groups, groupsets):
+    """Return the attributes of the health facilities as a dictionary of arrays.
+
+    The arrays of get_units() are completed with the arrays 'groupid', 'groupname', 'groupsetid'
+    and 'groupsetname' (empty strings if not found).
+    """
+    table = dict(units)
+    group = _group_index(groups, units['id'])
+    # The index -1 selects the empty string appended to the values
+    table['groupid'] = np.append(groups['id'], b'')[group]
+    table['groupname'] = np.append(groups['name'], b'')[group]
+    groupset = _group_index(groupsets, table['groupid'])
+    table['groupsetid'] = np.append(groupsets['id'], b'')[groupset]
+    table['groupsetname'] = np.append(groupsets['name'], b'')[groupset]
+    return table
+
+def evaluate_rule(table, rule):
+    """Evaluate a SQL 'where' condition on a table of arrays and return the boolean mask of the matching rows.
+
+    Supported conditions: column = value, column <> value (or !=), column [NOT] IN (values),
+    combined with AND, OR, NOT and parentheses (ex: "groupid = 'Wx1Z05p1qwW' OR groupid = 'QDZvyQQZZN5'").
+    Other conditions (ex: LIKE, <, IS NULL) raise a RuleSyntaxError (see rules_need_sql).
+    """
+    tokens = []
+    pos = 0
+    rule = rule.strip()
+    while pos < len(rule):
+        match = RULE_TOKENS.match(rule, pos)
+        if not match:
+            raise RuleSyntaxError("Can not parse the rule '%s' at position %s" % (rule, pos))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = value[1:-1].replace("''", "'")
+        elif kind == 'word':
+            if value.upper() in ('AND', 'OR', 'NOT', 'IN'):
+                kind, value = 'op', value.upper()
+        tokens.append((kind, value))
+    tokens.append(('end', None))
+    position = [0]
+
+    def peek():
+        return tokens[position[0]]
+
+    def take(expected=None):
+        token = tokens[position[0]]
+        if expected is not None and token != ('op', expected):
+            raise RuleSyntaxError("Expected '%s' in the rule '%s'" % (expected, rule))
+        position[0] += 1
+        return token
+
+    def value():
+        kind, value = take()
+        if kind not in ('string', 'number'):
+            raise RuleSyntaxError("Expected a value in the rule '%s'" % rule)
+        return value
+
+    def column_values(name):
+        if name not in table:
+            raise ValueError("Unknown column '%s' in the rule '%s'" % (name, rule))
+        return table[name]
+
+    def compare(column, values):
+        if column.dtype.kind == 'f':
+            return np.in1d(column, [float(v) for v in values])
+        return np.in1d(column, [v.encode('utf-8') if isinstance(v, unicode) else v for v in values])
+
+    def factor():
+        if peek() == ('op', 'NOT'):
+            take()
+            return ~factor()
+        if peek() == ('op', '('):
+            take()
+            mask = expression()
+            take(')')
+            return mask
+        kind, name = take()
+        if kind != 'word':
+            raise RuleSyntaxError("Expected a column name in the rule '%s'" % rule)
+        column = column_values(name)
+        kind, op = take()
+        negate = False
+        if op == 'NOT':
+            negate = True
+            kind, op = take()
+        if op == 'IN':
+            take('(')
+            values = [value()]
+            while peek() == ('op', ','):
+                take()
+                values.append(value())
+            take(')')
+            mask = compare(column, values)
+        elif op == '=':
+            mask = compare(column, [value()])
+        elif op in ('<>', '!='):
+            mask = ~compare(column, [value()])
+        else:
+            raise RuleSyntaxError("Unsupported operator '%s' in the rule '%s'" % (op, rule))
+        return ~mask if negate else mask
+
+    def term():
+        mask = factor()
+        while peek() == ('op', 'AND'):
+            take()
+            mask = mask & factor()
+        return mask
+
+    def expression():
+        mask = term()
+        while peek() == ('op', 'OR'):
+            take()
+            mask = mask | term()
+        return mask
+
+    mask = expression()
+    if peek()[0] != 'end':
+        raise RuleSyntaxError("Can not parse the end of the rule '%s'" % rule)
+    return mask
+
+def rules_need_sql(hc_rules):
+    """Check the rules of 'hc_rules' (level: SQL 'where' condition) and return True if some of them
+    are outside of the grammar of evaluate_rule, so they have to be evaluated by the database. Raise a ValueError if a rule uses an unknown column."""
+    empty = dict((name, np.array([], dtype=dtype)) for name, dtype in RULE_COLUMNS.items())
+    need_sql = False
+    for hc_level, rule in hc_rules.iteritems():
+        try:
+            evaluate_rule(empty, rule)
+        except RuleSyntaxError:
+            need_sql = True
+        except ValueError as error:
+            raise ValueError("Rule of the level %s of the health facilities: %s (columns: %s)" % (
+                hc_level, error, ', '.join(sorted(RULE_COLUMNS))))
+    return need_sql
+
+def facility_levels(table, hc_rules):
+    """Return the hierarchical level of each health facility of a table (0 if no rule matches),
+    from the rules of 'hc_rules' (level: SQL 'where' condition, see evaluate_rule)"""
+    level = np.zeros(len(table['id']), dtype=np.int32)
+    for hc_level, rule in hc_rules.iteritems():
+        level[evaluate_rule(table, rule)] = hc_level
+    return level
+
+def _quote(text):
+    """Quote a text field for v.in.ascii (text=doublequote)"""
+    return '"%s"' % text.replace('"', "'")
+
+def create_facility_map(units, groups, groupsets, hc_rules, pointmapname, region, error_file, overwrite=True,
+                        transform=None):
+    """Create the point map of the health facilities falling in the region, with their hierarchical level.
+
+    The points are filtered against the bounding box of the region and the rules of 'hc_rules'
+    (level: SQL 'where' condition) are evaluated in memory, so that the attributed point map is
+    created with a single v.in.ascii. If some rules are outside of the grammar of evaluate_rule,
+    all the rules are applied in the database, in their order, in a single SQL transaction (see
+    grass_commands.update_columns). The categories are the order of the units in the json file
+    (starting at 1). The points outside the region are written in 'error_file' (csv).
+    'transform' is an optional function converting the arrays of coordinates (WGS84) in the
+    coordinates of the location (see reproject.py); the 'x' and 'y' columns keep the WGS84 coordinates.
+    Return the number of points outside the region.
+    """
+    table = facility_table(units, groups, groupsets)
+    sql_rules = rules_need_sql(hc_rules)
+    if sql_rules:
+        level = np.zeros(len(table['id']), dtype=np.int32)
+    else:
+        level = facility_levels(table, hc_rules)
+    if transform is None:
+        xs, ys = table['x'], table['y']
+    else:
+        xs, ys = transform(table['x'], table['y'])
+    inside = ((xs >= region['w']) & (xs <= region['e']) &
+              (ys >= region['s']) & (ys <= region['n']))
+    text_columns = ('id', 'name', 'shortName', 'groupid', 'groupname', 'groupsetid', 'groupsetname')
+
+    def lines(rows, with_level):
+        for i in rows:
+            fields = [str(i+1), _quote(table['id'][i]), repr(table['x'][i]), repr(table['y'][i])]
+            fields += [_quote(table[name][i]) for name in text_columns[1:]]
+            if with_level:
+                fields.append(str(level[i]) if level[i] else '')
+                if transform is not None:
+                    fields += [repr(xs[i]), repr(ys[i])]
+            yield ','.join(fields)
 
-def create_pointmap(units, groups, groupsets, pointmapname, overwrite=True):
-    """Transform info from json files into a GRASS GIS point map."""
     tempfile = grass.tempfile()
-    groupsnotfound = []
-    groupsetsnotfound = []
     with open(tempfile, 'w') as fout:
-        for unit in units.keys():
-            output = []
-            output.append(str(unit))
-            for v in units[unit]:
-                output.append(str(v))
-            if unit in groups:
-                groupid = groups[unit]['groupid']
-                groupname = groups[unit]['groupname'] 
-            else:
-                # if groupid not in groupsnotfound:
-                #     groupsnotfound.append(groupid)
-                groupid = ''
-                groupname = ''
-            output.append(str(groupid))
-            output.append(str(groupname))
-
-            if groupid in groupsets:
-                groupsetid = groupsets[groupid]['groupsetid']
-                groupsetname = groupsets[groupid]['groupsetname']
-            else:
-                # if groupsetid not in groupsetsnotfound:
-                #     groupsetsnotfound.append(groupsetid)
-                groupsetid = ''
-                groupsetname = ''
-            output.append(str(groupsetid))
-            output.append(str(groupsetname))
-
-            output_string = ','.join(output)
-            fout.write(output_string)
-            fout.write('\n')
-
-    if groupsnotfound:
-        warning_message = "Could not find the following groups:\n"
-        for group in groupsnotfound:
-            warning_message += "%s\n" % group
-        grass.warning(warning_message)
-    if groupsetsnotfound:
-        warning_message = "Could not find the following groupsets:\n"
-        for groupset in groupsetsnotfound:
-            warning_message += "%s\n" % groupset
-        grass.warning(warning_message)
-
-    columns = 'id varchar, x double precision, y double precision, name varchar, shortName varchar, groupid varchar, groupname varchar, groupsetid varchar, groupsetname varchar'
+        for line in lines(np.nonzero(inside)[0], True):
+            fout.write(line + '\n')
+    columns = 'cat integer, id varchar, x double precision, y double precision, name varchar, shortName varchar, groupid varchar, groupname varchar, groupsetid varchar, groupsetname varchar, level integer'
+    if transform is not None:
+        # The coordinates of the location are in two extra columns, removed after the import
+        columns += ', x_location double precision, y_location double precision'
     grass.run_command('v.in.ascii',
                       output=pointmapname,
                       input_=tempfile,
-                      x=2,
-                      y=3,
+                      cat=1,
+                      x=3 if transform is None else 12,
+                      y=4 if transform is None else 13,
                       columns=columns,
                       separator='comma',
+                      text='doublequote',
                       overwrite=overwrite,
                       quiet=True)
+    if transform is not None:
+        grass.run_command('v.db.dropcolumn', map=pointmapname, columns='x_location,y_location', quiet=True)
+    if sql_rules:
+        update_columns(pointmapname, [(rule, {'level': hc_level}) for hc_level, rule in hc_rules.iteritems()])
 
-def get_groupsets(json_file):
-    """Load groupset info from json file and return as a dictionary."""
-    with open(json_file, 'r') as fin:
-        datas = json.load(fin)
+    outside = np.nonzero(~inside)[0]
+    if len(outside):
+        with open(error_file, 'w') as fout:
+            fout.write('cat,id,x,y,name,shortName,groupid,groupname,groupsetid,groupsetname\n')
+            for line in lines(outside, False):
+                fout.write(line + '\n')
+    return len(outside)
 
-    groupsets = {}
+def _memberships(json_file, key, members_key):
+    """Load the groups of the array 'key' of a json file and their members (array 'members_key' of each group).
 
-    for line in datas['organisationUnitGroupSets']:
-        if not line['organisationUnitGroups']:
+    Return a dictionary of arrays: 'id' and 'name' of the groups, 'member' (sorted ids of the members)
+    and 'index' (index of the group of each member). A member of several groups is kept in the last one.
+    """
+    ids, names = [], []
+    members, indexes = [], []
+    for line in iter_json_array(json_file, key):
+        if not line[members_key]:
             continue
-        for group in line['organisationUnitGroups']:
-            groupdict = {}
-            groupdict['groupsetid'] = line['id']
-            groupdict['groupsetname'] = line['name'].encode('utf-8')
-            groupsets[group['id']] = groupdict
+        for member in line[members_key]:
+            members.append(member['id'].encode('utf-8'))
+            indexes.append(len(ids))
+        ids.append(line['id'].encode('utf-8'))
+        names.append(line['name'].encode('utf-8'))
 
-    return groupsets
+    # Sorted members (for the lookups with np.searchsorted), the last group of a member is kept
+    member, last = np.unique(np.array(members[::-1], dtype=np.bytes_), return_index=True)
+    memberships = {}
+    memberships['id'] = np.array(ids, dtype=np.bytes_)
+    memberships['name'] = np.array(names, dtype=np.bytes_)
+    memberships['member'] = member
+    memberships['index'] = np.array(indexes[::-1], dtype=np.int32)[last]
+    return memberships
 
-def get_groups(json_file):
-    """Load group info from json file and return as a dictionary."""
-    with open(json_file, 'r') as fin:
-        datas = json.load(fin)
+def get_groupsets(json_file):
+    """Load groupset info from json file and return as a dictionary of arrays.
 
-    groups = {}
+    The arrays 'id' and 'name' have one item per groupset, 'member' is the sorted ids of the
+    groups and 'index' the index of the groupset of each group.
+    """
+    return _memberships(json_file, 'organisationUnitGroupSets', 'organisationUnitGroups')
 
-    for line in datas['organisationUnitGroups']:
-        if not line['organisationUnits']:
-            continue
-        for unit in line['organisationUnits']:
-            unitdict = {}
-            unitdict['groupid'] = line['id']
-            unitdict['groupname'] = line['name'].encode('utf-8')
-            groups[unit['id']] = unitdict
+def get_groups(json_file):
+    """Load group info from json file and return as a dictionary of arrays.
 
-    return groups
+    The arrays 'id' and 'name' have one item per group, 'member' is the sorted ids of the units
+    and 'index' the index of the group of each unit.
+    """
+    return _memberships(json_file, 'organisationUnitGroups', 'organisationUnits')
 
 def get_units(json_file):
-    """Load health facility info from json file and return as a list.
-    
-    We use a list, here, in order to ensure a specific order of the data.
-    """
-    with open(json_file, 'r') as fin:
-        datas = json.load(fin)
+    """Load health facility info (POINT units only) from json file and return as a dictionary of arrays.
 
-    units = {}
-    for line in datas['organisationUnits']:
+    The arrays 'id', 'x', 'y', 'name' and 'shortName' have one item per health facility,
+    in the order of the json file.
+    """
+    ids, names, shortnames = [], [], []
+    x, y = [], []
+    for line in iter_json_array(json_file, 'organisationUnits'):
         if 'coordinates' in line and line['featureType'] == 'POINT':
-            unitinfo = []
-            unitinfo.append(json.loads(line['coordinates'])[0])
-            unitinfo.append(json.loads(line['coordinates'])[1])
-            unitinfo.append(line['name'].encode('utf-8'))
-            unitinfo.append(line['shortName'].encode('utf-8'))
-            units[line['id']] = unitinfo
+            coordinates = json.loads(line['coordinates'])
+            ids.append(line['id'].encode('utf-8'))
+            x.append(coordinates[0])
+            y.append(coordinates[1])
+            names.append(line['name'].encode('utf-8'))
+            shortnames.append(line['shortName'].encode('utf-8'))
 
+    units = {}
+    units['id'] = np.array(ids, dtype=np.bytes_)
+    units['x'] = np.array(x, dtype=np.float64)
+    units['y'] = np.array(y, dtype=np.float64)
+    units['name'] = np.array(names, dtype=np.bytes_)
+    units['shortName'] = np.array(shortnames, dtype=np.bytes_)
     return units
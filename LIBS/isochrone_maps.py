@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Functions writing the isochrone maps (polygons of the isochrone bands) in GeoPackage files.
+
+The polygons are only built when the isochrone maps are requested, and only for the requested
+scenarios. Each isochrone raster is read from the mapset (see raster_io.py), written in a temporary
+GeoTIFF file and vectorized by GDAL (gdal.Polygonize) directly in a GeoPackage layer, in a single
+transaction, without vector map (and its topology) nor attribute table in GRASS GIS. The scenarios
+are independent, so they are processed in parallel worker processes, each one writing its own file.
+
+On fragmented landscapes, the number of features and vertices can be capped: the polygons can be
+simplified (Douglas-Peucker, preserving the validity of each polygon, so neighbouring bands may
+slightly overlap) and dissolved per band (one multipolygon per band). The statistics of the bands
+(see zonal_stats.isochrone_population_stats) are written as attributes.
+"""
+
+import os
+import numpy as np
+from osgeo import gdal, ogr
+import grass.script as gscript
+from raster_io import read_raster, blocks
+from reproject import location_srs
+from grass_tasks import run_parallel
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+
+def requested_isochrones(isochrone_layers, requested):
+    """Return the isochrone rasters whose maps are requested.
+
+    requested --- True for all the scenarios, False or None for none, or a list of scenarios
+    (ex: ['HCall_NC_WS'], the names of the isochrone rasters are also accepted).
+    """
+    if requested is True:
+        return list(isochrone_layers)
+    if not requested:
+        return []
+    if isinstance(requested, basestring):
+        requested = [requested]
+    names = set(name if name.startswith("Isochrones_") else "Isochrones_%s" % name for name in requested)
+    unknown = names - set(isochrone_layers)
+    if unknown:
+        raise ValueError("Unknown scenarios of the isochrone maps: %s" % ', '.join(sorted(unknown)))
+    return [isochrone for isochrone in isochrone_layers if isochrone in names]
+
+def _write_geotiff(isochrone, raster_file):
+    """Write an isochrone raster of the current region in a GeoTIFF file (Int32, 0 for null cells)"""
+    region = gscript.region()
+    array = read_raster(isochrone, np.int32, null=0)
+    dataset = gdal.GetDriverByName('GTiff').Create(raster_file, region['cols'], region['rows'], 1, gdal.GDT_Int32,
+                                                   ['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    dataset.SetGeoTransform((region['w'], region['ewres'], 0, region['n'], 0, -region['nsres']))
+    dataset.SetProjection(location_srs().ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    for row, block in blocks(array):
+        band.WriteArray(np.asarray(block), 0, row)
+    dataset = None
+    del array
+
+def _stats_fields(layer, stats):
+    """Create the fields of the statistics of the bands, return their names"""
+    names = [] if stats is None else list(stats.columns)
+    for name in names:
+        layer.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+    return names
+
+def _generalize(source, layer, fields, stats, simplify, dissolve):
+    """Copy the polygons of a layer (field 'zone') in another layer, simplified and/or dissolved per band"""
+    zones = {}
+    source.ResetReading()
+    for feature in source:
+        geometry = feature.GetGeometryRef()
+        if simplify:
+            geometry = geometry.SimplifyPreserveTopology(simplify)
+        if geometry is None or geometry.IsEmpty():
+            continue
+        zone = feature.GetField('zone')
+        if dissolve:
+            if zone not in zones:
+                zones[zone] = ogr.Geometry(ogr.wkbMultiPolygon)
+            # The polygons of a band do not share edges (they would have been merged)
+            if geometry.GetGeometryType() == ogr.wkbMultiPolygon:
+                for i in range(geometry.GetGeometryCount()):
+                    zones[zone].AddGeometry(geometry.GetGeometryRef(i))
+            else:
+                zones[zone].AddGeometry(geometry)
+        else:
+            zones.setdefault(zone, []).append(geometry.Clone())
+    definition = layer.GetLayerDefn()
+    for zone, geometries in sorted(zones.items()):
+        for geometry in ([geometries] if dissolve else geometries):
+            feature = ogr.Feature(definition)
+            feature.SetField('zone', zone)
+            if stats is not None and zone in stats.index:
+                for name in fields:
+                    feature.SetField(name, float(stats.at[zone, name]))
+            feature.SetGeometry(geometry)
+            layer.CreateFeature(feature)
+
+def _sql_value(value):
+    """Return a statistic as a SQL literal (NULL if not finite)"""
+    value = float(value)
+    return repr(value) if np.isfinite(value) else 'NULL'
+
+def isochrone_polygons(isochrone, gpkg_file, tmpdir, stats=None, simplify=0, dissolve=False):
+    """Vectorize an isochrone raster of the current region in a GeoPackage file (layer named as the raster).
+
+    Each polygon has the value of its band in the field 'zone' (the time limit, as 'r.to.vect -v'),
+    and the statistics of the band as attributes.
+    stats --- optional table of the statistics of the bands, indexed by the time limit.
+    simplify --- tolerance of the simplification of the polygons (map units), 0 to keep the edges of the cells.
+    dissolve --- True to write one multipolygon per band.
+    """
+    raster_file = os.path.join(tmpdir, "%s.tif" % isochrone)
+    _write_geotiff(isochrone, raster_file)
+    if os.path.exists(gpkg_file):
+        os.remove(gpkg_file)
+    datasource = ogr.GetDriverByName('GPKG').CreateDataSource(gpkg_file)
+    geometry_type = ogr.wkbMultiPolygon if dissolve else ogr.wkbPolygon
+    layer = datasource.CreateLayer(isochrone, location_srs(), geometry_type)
+    layer.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+    fields = _stats_fields(layer, stats)
+    raster = gdal.Open(raster_file)
+    band = raster.GetRasterBand(1)
+    layer.StartTransaction()
+    if simplify or dissolve:
+        memory = ogr.GetDriverByName('Memory').CreateDataSource('')
+        polygons = memory.CreateLayer(isochrone, location_srs(), ogr.wkbPolygon)
+        polygons.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+        gdal.Polygonize(band, band.GetMaskBand(), polygons, 0)
+        _generalize(polygons, layer, fields, stats, simplify, dissolve)
+        memory = None
+    else:
+        gdal.Polygonize(band, band.GetMaskBand(), layer, 0)
+    layer.CommitTransaction()
+    raster = None
+    if fields and not (simplify or dissolve):
+        # One update per band for the attributes of all its polygons
+        datasource.StartTransaction()
+        for zone, row in stats.iterrows():
+            datasource.ExecuteSQL('UPDATE "%s" SET %s WHERE zone = %d' % (
+                isochrone, ', '.join('"%s" = %s' % (name, _sql_value(row[name])) for name in fields), zone))
+        datasource.CommitTransaction()
+    datasource = None
+    os.remove(raster_file)
+    return gpkg_file
+
+def _polygons_task(task):
+    """Vectorize an isochrone raster (worker function)"""
+    return isochrone_polygons(*task)
+
+def write_isochrone_maps(isochrone_layers, outputdir, tmpdir, stats=None, simplify=0, dissolve=False, n_jobs=1):
+    """Write the isochrone maps '<outputdir>/<isochrone>.gpkg' of the isochrone rasters, in a pool of
+    'n_jobs' processes (see isochrone_polygons).
+
+    stats --- optional dictionary with the table of the statistics of each isochrone raster.
+    Return the list of GeoPackage files.
+    """
+    for folder in (outputdir, tmpdir):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    tasks = [(isochrone, os.path.join(outputdir, "%s.gpkg" % isochrone), tmpdir,
+              stats.get(isochrone) if stats else None, simplify, dissolve) for isochrone in isochrone_layers]
+    return run_parallel(_polygons_task, tasks, n_jobs)
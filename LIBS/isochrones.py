@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""
+Functions classifying the cost distance rasters in isochrone bands.
+
+Each cell is classified against the time limits with a balanced tree of if() (a binary search),
+so the number of comparisons per cell grows with the logarithm of the number of time limits
+instead of linearly. All the cost rasters are classified by a single r.mapcalc invocation with
+one expression per output, so each input is read once and all the outputs are written together.
+"""
+
+from tiling import tiled_mapcalc
+
+
+def band_expression(cost_raster, time_limits, values):
+    """Return the r.mapcalc expression giving, for each cell, the value of the first band whose
+    time limit is larger than or equal to the cost (null if the cost exceeds all the time limits).
+
+    time_limits --- time limits of the bands, sorted in ascending order.
+    values --- value of each band in the output (ex: the time limit, or the band index).
+    """
+    def subtree(low, high):
+        # The band of the cell is between 'low' and 'high' ('high' = beyond all the time limits)
+        if low == high:
+            return str(values[low]) if low < len(time_limits) else "null()"
+        middle = (low + high) // 2
+        return "if(%s<=%s,%s,%s)" % (cost_raster, time_limits[middle], subtree(low, middle), subtree(middle+1, high))
+    return subtree(0, len(time_limits))
+
+def isochrone_bands(cost_rasters, time_limits, isochrone_layers, band_layers=None, tile_size=0, n_jobs=1):
+    """Create the isochrone rasters of all the cost rasters in one r.mapcalc invocation.
+
+    cost_rasters --- list of cost distance rasters.
+    time_limits --- time limits of the isochrone bands (in minutes).
+    isochrone_layers --- names of the isochrone rasters (value of the time limit of the band of each cell).
+    band_layers --- optional names of band index rasters (CELL, 1 for the first band), e.g. for the
+    zonal statistics (see zonal_stats.py).
+    tile_size, n_jobs --- tiled processing of the region (see tiling.py), disabled if tile_size is 0.
+    """
+    limits = sorted(time_limits, key=float)
+    expressions = []
+    for i, cost_raster in enumerate(cost_rasters):
+        expressions.append("%s = %s" % (isochrone_layers[i], band_expression(cost_raster, limits, limits)))
+        if band_layers:
+            indices = range(1, len(limits)+1)
+            expressions.append("%s = %s" % (band_layers[i], band_expression(cost_raster, limits, indices)))
+    tiled_mapcalc('\n'.join(expressions), tile_size=tile_size, n_jobs=n_jobs)
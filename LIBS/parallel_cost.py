@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+Functions to compute the cost distance scenarios (velocity raster x health facility level) in parallel.
+Each scenario is computed by a worker process in its own temporary mapset, with its own copy of the
+default region, so that concurrent runs do not compete for the WIND file or the MASK of the main mapset.
+The outputs are copied back to the main mapset once the worker has finished.
+The no car scenarios can use a walking cost (slope penalties from the elevation), computed with
+the nearest health facility in one pass by the in-memory engine (see cost_engine.py).
+"""
+
+import os
+import grass.script as gscript
+from grass_database import create_temp_mapset, remove_temp_mapset
+from grass_tasks import run_parallel
+
+
+def cost_scenarios(veloc_raster, hc_levels, hc_prefix):
+    """Return the list of cost distance scenarios, one per velocity raster and health facility level.
+
+    veloc_raster --- list of velocity rasters, named 'velocity_<car>_<season>'.
+    hc_levels --- list of health facility levels (ex: ("all","L2")).
+    hc_prefix --- prefix of the health facility point maps (ex: 'HC' for 'HCall').
+    """
+    scenarios = []
+    for veloc_rast in veloc_raster:
+        for hclevel in hc_levels:
+            scenario = {}
+            scenario['name'] = "HC%s_%s" % (hclevel,veloc_rast[-5:])
+            scenario['car'] = veloc_rast[-5:-3]
+            scenario['input'] = veloc_rast
+            scenario['start_points'] = "%s%s" % (hc_prefix,hclevel)
+            scenario['output'] = "CostDist_%s" % scenario['name']
+            scenario['nearest'] = "Nearest_%s" % scenario['name']
+            scenarios.append(scenario)
+    return scenarios
+
+def run_cost_scenario(scenario):
+    """Compute one cost distance scenario in its own temporary mapset (worker function)"""
+    gisdb, location, mapset = scenario['gisenv']
+    temp_mapset = "tmp_cost_%s" % scenario['name']
+    gisrc = create_temp_mapset(gisdb, location, temp_mapset)
+    main_gisrc = os.environ['GISRC']
+    os.environ['GISRC'] = gisrc
+    try:
+        if scenario.get('elevation'):
+            # Walking cost with the in-memory engine (see cost_engine.py), with Knight's move
+            from cost_engine import r_cost
+            r_cost("%s@%s" % (scenario['input'],mapset), "%s@%s" % (scenario['start_points'],mapset),
+                   scenario['output'], scenario['nearest'], knight=True, overwrite=True,
+                   elevation="%s@%s" % (scenario['elevation'],mapset), slope_model=scenario['slope_model'])
+        elif scenario['backend'] == 'numpy':
+            # In-memory engine (see cost_engine.py), with Knight's move
+            from cost_engine import r_cost
+            r_cost("%s@%s" % (scenario['input'],mapset), "%s@%s" % (scenario['start_points'],mapset),
+                   scenario['output'], scenario['nearest'], knight=True, overwrite=True)
+        else:
+            # Compute cost distance raster -'k' for Knight's move
+            gscript.run_command('r.cost', flags='k', overwrite=True, quiet=True,
+                                input="%s@%s" % (scenario['input'],mapset),
+                                start_points="%s@%s" % (scenario['start_points'],mapset),
+                                output=scenario['output'], nearest=scenario['nearest'],
+                                memory=scenario['memory'])
+    finally:
+        os.environ['GISRC'] = main_gisrc
+    return temp_mapset
+
+def _in_memory(scenario):
+    """Return True if a scenario is computed by the in-memory engine"""
+    return bool(scenario.get('elevation')) or scenario['backend'] == 'numpy'
+
+def run_cost_scenarios(scenarios, n_jobs=2, memory=300, backend='grass', elevation=None, slope_model=None):
+    """Compute all the cost distance scenarios in a pool of 'n_jobs' worker processes.
+
+    The available memory (in MB) is split between the workers of r.cost. The workers of the
+    in-memory engine are capped so their graphs fit in the memory (see cost_engine.engine_memory),
+    down to one scenario at a time. The cost and nearest rasters are copied in the current mapset
+    and the temporary mapsets are removed.
+    backend --- 'grass' to use r.cost, 'numpy' to use the in-memory engine of cost_engine.py.
+    elevation, slope_model --- elevation raster and slope model ('tobler' or 'naismith', see
+    cost_engine.slope_factor) of the walking cost of the no car ('NC') scenarios, which then use the
+    in-memory engine whatever the backend. The cost is isotropic if they are None.
+    """
+    env = gscript.gisenv()
+    gisenv = (env['GISDBASE'], env['LOCATION_NAME'], env['MAPSET'])
+    for scenario in scenarios:
+        scenario['gisenv'] = gisenv
+        scenario['backend'] = backend
+        if elevation and slope_model and scenario['car'] == 'NC':
+            scenario['elevation'] = elevation
+            scenario['slope_model'] = slope_model
+    in_memory = [scenario for scenario in scenarios if _in_memory(scenario)]
+    grass_scenarios = [scenario for scenario in scenarios if not _in_memory(scenario)]
+    try:
+        temp_mapsets = {}
+        if grass_scenarios:
+            grass_jobs = max(1, min(n_jobs, len(grass_scenarios)))
+            for scenario in grass_scenarios:
+                scenario['memory'] = max(1, int(memory/grass_jobs))
+            temp_mapsets.update(zip([s['name'] for s in grass_scenarios],
+                                    run_parallel(run_cost_scenario, grass_scenarios, grass_jobs)))
+        if in_memory:
+            from cost_engine import engine_memory
+            scenario_memory = engine_memory(gscript.region()['cells'])
+            engine_jobs = max(1, min(n_jobs, len(in_memory), int(memory // scenario_memory)))
+            if scenario_memory > memory:
+                gscript.warning("The in-memory cost engine needs ~%d MB per scenario, more than the available "
+                                "memory (%d MB): use 'cost_backend' = 'grass' and 'walking_slope' = None, "
+                                "or a larger 'memory'" % (scenario_memory, memory))
+            print "In-memory cost engine: ~%d MB per scenario, %d scenario(s) at a time" % (scenario_memory, engine_jobs)
+            temp_mapsets.update(zip([s['name'] for s in in_memory],
+                                    run_parallel(run_cost_scenario, in_memory, engine_jobs)))
+        for scenario in scenarios:
+            for layer in (scenario['output'], scenario['nearest']):
+                gscript.run_command('g.copy', overwrite=True, quiet=True,
+                                    raster='%s@%s,%s' % (layer,temp_mapsets[scenario['name']],layer))
+            print "Layers created: %s,%s" % (scenario['output'],scenario['nearest'])
+    finally:
+        for scenario in scenarios:
+            remove_temp_mapset(gisenv[0], gisenv[1], "tmp_cost_%s" % scenario['name'])
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Functions running the processing chain as a graph of named stages, with checkpoints.
+
+Each stage declares the stages whose results it requires, the configuration values it depends on
+and the GRASS GIS layers and files it produces. The function of a stage receives the results of
+the previous stages (one dictionary) and returns its own results (ex: names of layers, statistics
+tables). When a stage is completed, its results are saved with pickle in a completion marker
+'<statedir>/<stage>.done', written atomically, so a marker is never partial.
+
+The markers are kept in the working directory, next to the GRASS GIS database, so a run that
+failed or was interrupted (ex: preempted machine) can be resumed from the first incomplete stage:
+the results of the completed stages are read from their markers, as long as their parameters did
+not change and their outputs still exist. A part of the stages can also be run again (from a
+stage, until a stage). Running a stage removes the markers of the stages depending on it.
+"""
+
+import os
+import time
+import cPickle as pickle
+import grass.script as gscript
+from profiling import start_stage, end_stage
+
+
+class PipelineError(RuntimeError):
+    """Error raised when the stages can not be run (unknown stage, stage not completed before)"""
+    pass
+
+
+def pipeline_stage(name, function, requires=(), params=None, rasters=(), vectors=(), files=()):
+    """Return a stage of the pipeline.
+
+    function --- function of the stage, called with the dictionary of the results of the previous
+    stages, returning the dictionary of its own results (or None).
+    requires --- names of the previous stages whose outputs are used by the stage.
+    params --- configuration values used by the stage (a marker saved with other values is ignored),
+    or a function returning them, only called when the marker is checked or saved (ex: the key of a
+    cached stage, which hashes its input files).
+    rasters, vectors, files --- outputs of the stage (checked before reusing a marker), or a function
+    returning them from the results of the stage.
+    """
+    return {'name': name, 'function': function, 'requires': list(requires), 'params': params,
+            'rasters': rasters, 'vectors': vectors, 'files': files}
+
+def _marker_file(statedir, name):
+    """Return the path of the completion marker of a stage"""
+    return os.path.join(statedir, "%s.done" % name.replace(' ', '_'))
+
+def _params(stage):
+    """Return the parameters of a stage (the function returning them is called once)"""
+    if callable(stage['params']):
+        stage['params'] = stage['params']()
+    return stage['params']
+
+def _outputs(stage, key, results):
+    """Return the list of outputs of a stage (rasters, vectors or files)"""
+    outputs = stage[key]
+    return list(outputs(results) if callable(outputs) else outputs)
+
+def _missing_outputs(stage, results):
+    """Return the outputs of a stage which do not exist anymore"""
+    missing = [name for name in _outputs(stage, 'rasters', results) if not gscript.find_file(name, element='cell')['file']]
+    missing += [name for name in _outputs(stage, 'vectors', results) if not gscript.find_file(name, element='vector')['file']]
+    missing += [path for path in _outputs(stage, 'files', results) if not os.path.exists(path)]
+    return missing
+
+def save_marker(statedir, stage, results, wall):
+    """Write the completion marker of a stage with its results (temporary file renamed when complete)"""
+    marker = _marker_file(statedir, stage['name'])
+    tmp_marker = "%s.tmp%s" % (marker, os.getpid())
+    with open(tmp_marker, 'wb') as fout:
+        pickle.dump({'name': stage['name'], 'params': _params(stage), 'results': results,
+                     'completed': time.time(), 'wall': wall}, fout, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_marker, marker)
+
+def load_marker(statedir, stage):
+    """Return the results of a completed stage, or None if the stage has to be run (no marker,
+    other parameters or missing outputs)"""
+    marker = _marker_file(statedir, stage['name'])
+    if not os.path.exists(marker):
+        return None
+    try:
+        with open(marker, 'rb') as fin:
+            state = pickle.load(fin)
+    except Exception as error:
+        gscript.warning("Completion marker of the stage '%s' can not be read (%s)" % (stage['name'], error))
+        return None
+    if state['params'] != _params(stage):
+        print "Stage '%s': the parameters changed since its completion" % stage['name']
+        return None
+    missing = _missing_outputs(stage, state['results'])
+    if missing:
+        print "Stage '%s': outputs missing since its completion (%s)" % (stage['name'], ', '.join(missing))
+        return None
+    return state['results']
+
+def remove_markers(statedir, names):
+    """Remove the completion markers of stages"""
+    for name in names:
+        marker = _marker_file(statedir, name)
+        if os.path.exists(marker):
+            os.remove(marker)
+
+def dependants(stages, name):
+    """Return the names of the stages depending (directly or not) on a stage"""
+    names = set([name])
+    for stage in stages:
+        if names.intersection(stage['requires']):
+            names.add(stage['name'])
+    names.discard(name)
+    return [stage['name'] for stage in stages if stage['name'] in names]
+
+def stage_index(stages, name):
+    """Return the index of a stage from its name (case insensitive, '_' or '-' accepted for spaces)"""
+    names = [stage['name'].lower() for stage in stages]
+    key = name.replace('_', ' ').replace('-', ' ').lower()
+    if key not in names:
+        raise PipelineError("Unknown stage '%s' (stages: %s)" % (name, ', '.join(stage['name'] for stage in stages)))
+    return names.index(key)
+
+def check_stages(stages):
+    """Check that the names of the stages are unique and that each stage only requires previous stages"""
+    names = []
+    for stage in stages:
+        if stage['name'] in names:
+            raise PipelineError("Stage '%s' is declared twice" % stage['name'])
+        unknown = [name for name in stage['requires'] if name not in names]
+        if unknown:
+            raise PipelineError("Stage '%s' requires stages which are not declared before it: %s" % (
+                stage['name'], ', '.join(unknown)))
+        names.append(stage['name'])
+
+def run_pipeline(stages, statedir, resume=False, first=None, last=None):
+    """Run the stages in their order and return the dictionary of their results.
+
+    resume --- True to reuse the results of the stages completed by a previous run (see load_marker),
+    so the run restarts from the first incomplete stage.
+    first, last --- names of the first and last stages to run (default: all the stages). The
+    results of the stages before 'first' are read from their markers (they must be completed).
+    Each stage is timed as a stage of the profiling (see profiling.py).
+    """
+    check_stages(stages)
+    if not os.path.exists(statedir):
+        os.makedirs(statedir)
+    begin = stage_index(stages, first) if first else 0
+    end = stage_index(stages, last) if last else len(stages) - 1
+    if begin > end:
+        raise PipelineError("Stage '%s' comes after the stage '%s'" % (first, last))
+    context = {}
+    completed = []
+    for i, stage in enumerate(stages[:end+1]):
+        results = None
+        if i < begin or resume:
+            results = load_marker(statedir, stage)
+        if results is not None:
+            if i >= begin:
+                print "Stage '%s' completed by a previous run, skipped" % stage['name']
+            context.update(results)
+            completed.append(stage['name'])
+            continue
+        if i < begin:
+            # Only the stages required by the stages to run have to be completed
+            continue
+        missing = [name for name in stage['requires'] if name not in completed]
+        if missing:
+            raise PipelineError("Stage '%s' requires the stages %s, which are not completed: run them first "
+                                "(or use --resume)" % (stage['name'], ', '.join("'%s'" % name for name in missing)))
+        # The outputs of the stage change, so the stages depending on it are not completed anymore
+        remove_markers(statedir, [stage['name']] + dependants(stages, stage['name']))
+        start_stage(stage['name'])
+        results = stage['function'](context) or {}
+        event = end_stage()
+        save_marker(statedir, stage, results, event['wall'])
+        context.update(results)
+        completed.append(stage['name'])
+    remaining = [stage['name'] for stage in stages[end+1:]]
+    if remaining:
+        print "Stages not run: %s (continue with --resume or --from '%s')" % (', '.join(remaining), remaining[0])
+    return context
+
+def pipeline_status(stages, statedir):
+    """Return the list of (name, date of completion or None) of the stages, from their markers"""
+    status = []
+    for stage in stages:
+        marker = _marker_file(statedir, stage['name'])
+        completed = None
+        if os.path.exists(marker):
+            with open(marker, 'rb') as fin:
+                completed = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(pickle.load(fin)['completed']))
+        status.append((stage['name'], completed))
+    return status
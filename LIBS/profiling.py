@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""
+Functions to profile the stages of the processing chain and each GRASS GIS command.
+
+Once start_profiling() has been called, every GRASS GIS command run by the functions of
+grass.script (run_command(), read_command(), parse_command(), mapcalc()...) is recorded, as well
+as the stages delimited by start_stage()/end_stage() (or the stage() context manager). For each
+event, the following values are recorded:
+- wall time;
+- CPU time of the child processes (the GRASS GIS modules) and, for the stages, of the python process;
+- peak resident memory: for a command, the one of its own process (see os.wait4()); for a stage,
+  the largest one of the commands run by the process during the stage, and the high-water mark of
+  the python process since its start ('python_maxrss_kb', cumulative);
+- bytes read from and written to the storage (by the python process and its child processes);
+- for the stages, the growth of the GRASSDATA folder.
+The events are appended to a json lines file (one event per line, also from worker processes) and
+converted in a trace-event file that can be opened in chrome://tracing or https://ui.perfetto.dev
+by stop_profiling().
+"""
+
+import os
+import json
+import errno
+import time
+import resource
+import contextlib
+
+# State of the profiling of the current process
+_profile = {'jsonl': None, 'gisdb': None, 'stages': []}
+_grass_functions = {}
+
+
+def format_duration(seconds):
+    """Return a duration as a readable string (ex: '2 hours and 3 minutes and 4.0 seconds')"""
+    days, remaining = divmod(seconds, 86400)
+    hours, remaining = divmod(remaining, 3600)
+    minutes, seconds = divmod(remaining, 60)
+    seconds = round(seconds, 1)
+    if days:
+        return "%d days, %d hours and %d minutes and %s seconds" % (days, hours, minutes, seconds)
+    if hours:
+        return "%d hours and %d minutes and %s seconds" % (hours, minutes, seconds)
+    if minutes:
+        return "%d minutes and %s seconds" % (minutes, seconds)
+    return "%s seconds" % seconds
+
+def _io_bytes():
+    """Return the bytes read and written on the storage by the process and its terminated child processes"""
+    values = {}
+    try:
+        with open('/proc/self/io', 'r') as fin:
+            for line in fin:
+                key, value = line.split(':')
+                values[key] = int(value)
+        return values['read_bytes'], values['write_bytes']
+    except (IOError, KeyError):
+        # Fallback on the block counts (512 bytes blocks)
+        usages = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        return sum(u.ru_inblock for u in usages)*512, sum(u.ru_oublock for u in usages)*512
+
+def _dir_size(path):
+    """Return the size (in bytes) of the files of a folder"""
+    size = 0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+def _snapshot():
+    """Return the current counters of the process and its child processes"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    read_bytes, write_bytes = _io_bytes()
+    return {'time': time.time(),
+            'cpu_children': children.ru_utime + children.ru_stime,
+            'cpu_self': own.ru_utime + own.ru_stime,
+            'maxrss_self': own.ru_maxrss,
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes}
+
+def _event(event_type, name, begin, end):
+    """Return the record of an event from the counters at its beginning and its end"""
+    event = {'type': event_type, 'name': name, 'pid': os.getpid(),
+             'start': begin['time'], 'wall': end['time'] - begin['time'],
+             'cpu_children': end['cpu_children'] - begin['cpu_children'],
+             'cpu_self': end['cpu_self'] - begin['cpu_self'],
+             'python_maxrss_kb': end['maxrss_self'],
+             'read_bytes': end['read_bytes'] - begin['read_bytes'],
+             'write_bytes': end['write_bytes'] - begin['write_bytes']}
+    if _profile['stages']:
+        event['stage'] = _profile['stages'][-1]['name']
+    return event
+
+def _write(event):
+    """Append an event to the json lines file (a single write, so concurrent processes do not mix lines)"""
+    if _profile['jsonl'] is None:
+        return
+    line = json.dumps(event) + '\n'
+    fd = os.open(_profile['jsonl'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def _wait4(pid):
+    """os.wait4() retried when interrupted by a signal"""
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except OSError as error:
+            if error.errno != errno.EINTR:
+                raise
+
+def _command_event(argv, start, usage, stdin=None):
+    """Return the record of a terminated command from the resource usage of its own process"""
+    args = {}
+    flags = []
+    for arg in argv[1:]:
+        key, equal, value = arg.partition('=')
+        if equal:
+            args[key] = value[:200]
+        else:
+            flags.append(arg)
+    if flags:
+        args['flags'] = ' '.join(flags)
+    if stdin:
+        args['stdin'] = str(stdin)[:200]
+    event = {'type': 'command', 'name': os.path.basename(argv[0]), 'pid': os.getpid(),
+             'start': start, 'wall': time.time() - start,
+             'cpu_children': usage.ru_utime + usage.ru_stime,
+             'peak_rss_kb': usage.ru_maxrss,
+             'read_bytes': usage.ru_inblock*512,
+             'write_bytes': usage.ru_oublock*512,
+             'args': args}
+    if _profile['stages']:
+        event['stage'] = _profile['stages'][-1]['name']
+    for stage in _profile['stages']:
+        stage['peak_rss_kb'] = max(stage.get('peak_rss_kb', 0), usage.ru_maxrss)
+    return event
+
+def _profiled_popen(popen_class):
+    """Return a subclass of the Popen class of grass.script recording an event for each command
+    when it is waited for (by run_command(), read_command(), parse_command(), mapcalc()...): the
+    process is waited for with os.wait4(), which returns the resource usage of this process only"""
+    class ProfiledPopen(popen_class):
+        def __init__(self, args, **kwargs):
+            self._profile_start = time.time()
+            self._profile_argv = args.split() if isinstance(args, basestring) else list(args)
+            self._profile_stdin = None
+            popen_class.__init__(self, args, **kwargs)
+
+        def communicate(self, input=None):
+            # The expression of r.mapcalc (and the SQL of db.execute) is given on the standard input
+            self._profile_stdin = input
+            return popen_class.communicate(self, input)
+
+        def wait(self):
+            if self.returncode is not None:
+                return self.returncode
+            try:
+                pid, status, usage = _wait4(self.pid)
+            except OSError:
+                # Already waited for (ex: by poll()), so its resource usage is lost
+                return popen_class.wait(self)
+            self._handle_exitstatus(status)
+            _write(_command_event(self._profile_argv, self._profile_start, usage, self._profile_stdin))
+            return self.returncode
+    return ProfiledPopen
+
+def start_profiling(tracedir, gisdb=None, name='profile'):
+    """Start to record the events in 'tracedir'/'name'.jsonl (the file is overwritten).
+
+    gisdb --- GRASSDATA folder, whose growth is recorded for each stage.
+    """
+    if not os.path.exists(tracedir):
+        os.makedirs(tracedir)
+    _profile['jsonl'] = os.path.join(tracedir, "%s.jsonl" % name)
+    _profile['gisdb'] = gisdb
+    if os.path.exists(_profile['jsonl']):
+        os.remove(_profile['jsonl'])
+    if not _grass_functions:
+        # All the functions of grass.script running a command create it with gcore.Popen
+        import grass.script.core as gcore
+        _grass_functions['Popen'] = gcore.Popen
+        gcore.Popen = _profiled_popen(gcore.Popen)
+    return _profile['jsonl']
+
+def start_stage(name):
+    """Start a stage of the processing chain (stages can be nested)"""
+    stage = {'name': name, 'begin': _snapshot()}
+    if _profile['gisdb'] and os.path.exists(_profile['gisdb']):
+        stage['gisdb_size'] = _dir_size(_profile['gisdb'])
+    _profile['stages'].append(stage)
+
+def end_stage():
+    """End the current stage, record it and print its duration. Return the event"""
+    stage = _profile['stages'].pop()
+    event = _event('stage', stage['name'], stage['begin'], _snapshot())
+    event['peak_rss_kb'] = stage.get('peak_rss_kb', 0)
+    if 'gisdb_size' in stage:
+        event['gisdb_growth'] = _dir_size(_profile['gisdb']) - stage['gisdb_size']
+    _write(event)
+    print "%s terminated in %s" % (stage['name'], format_duration(event['wall']))
+    return event
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager delimiting a stage of the processing chain"""
+    start_stage(name)
+    try:
+        yield
+    finally:
+        end_stage()
+
+def read_events(jsonl_file):
+    """Return the list of events of a json lines file"""
+    with open(jsonl_file, 'r') as fin:
+        return [json.loads(line) for line in fin if line.strip()]
+
+def write_chrome_trace(events, trace_file):
+    """Write the events in the trace-event format (complete events, times in microseconds)"""
+    trace = []
+    for event in events:
+        args = dict((key, value) for key, value in event.items() if key not in ('name', 'pid', 'start', 'wall', 'type'))
+        trace.append({'name': event['name'], 'cat': event['type'], 'ph': 'X',
+                      'ts': int(event['start']*1e6), 'dur': int(event['wall']*1e6),
+                      'pid': event['pid'], 'tid': event['pid'], 'args': args})
+    with open(trace_file, 'w') as fout:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, fout)
+
+def stop_profiling(top=10):
+    """End the open stages, write the trace-event file next to the json lines file and print the
+    commands with the largest total wall time. Return the path of the trace-event file"""
+    while _profile['stages']:
+        end_stage()
+    if _grass_functions:
+        import grass.script.core as gcore
+        gcore.Popen = _grass_functions.pop('Popen')
+    if _profile['jsonl'] is None or not os.path.exists(_profile['jsonl']):
+        return None
+    events = read_events(_profile['jsonl'])
+    trace_file = "%s_trace.json" % os.path.splitext(_profile['jsonl'])[0]
+    write_chrome_trace(events, trace_file)
+    totals = {}
+    for event in events:
+        if event['type'] == 'command':
+            wall, cpu, peak, count = totals.get(event['name'], (0, 0, 0, 0))
+            totals[event['name']] = (wall + event['wall'], cpu + event['cpu_children'],
+                                     max(peak, event['peak_rss_kb']), count + 1)
+    print "Commands with the largest total wall time:"
+    for name, (wall, cpu, peak, count) in sorted(totals.items(), key=lambda item: -item[1][0])[:top]:
+        print "  %-16s %6d calls  %10.1f s wall  %10.1f s CPU  %8.1f MB peak" % (name, count, wall, cpu, peak/1024.)
+    print "Profiling trace written in '%s'" % trace_file
+    return trace_file
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Functions exchanging rasters between GRASS GIS and NumPy through memory-mapped files.
+
+A raster of the current region is exported once in a binary file (r.out.bin) which is mapped in
+memory as a NumPy array (np.memmap): the cells are only read from the disk when they are used, so
+rasters larger than the RAM can be processed block of rows by block of rows (see blocks()), and
+no copy of the whole raster is made. The file is unlinked as soon as it is mapped, so it is
+removed by the system when the array is released. New rasters are created the same way: the array
+is a memory-mapped file, filled block by block and imported with r.in.bin.
+
+By default, the arrays have the type of the raster (CELL: int32, FCELL: float32, DCELL: float64).
+"""
+
+import os
+import numpy as np
+import grass.script as gscript
+
+# NumPy type of the GRASS GIS raster types
+RASTER_TYPES = {'CELL': np.int32, 'FCELL': np.float32, 'DCELL': np.float64}
+
+
+def raster_dtype(name):
+    """Return the NumPy type of a raster (see RASTER_TYPES)"""
+    return np.dtype(RASTER_TYPES[gscript.raster_info(name)['datatype']])
+
+def _region_shape():
+    """Return the shape (rows, columns) of the current region"""
+    region = gscript.region()
+    return region['rows'], region['cols']
+
+def read_raster(name, dtype=np.float64, writable=False, null=None):
+    """Return a raster of the current region as a read-only memory-mapped array.
+
+    dtype --- type of the array, or None for the type of the raster.
+    writable --- True for a copy-on-write array: the changes are kept in memory, not in the file.
+    null --- value of the null cells (default: NaN for floating point arrays and 0 for integer arrays).
+    """
+    dtype = raster_dtype(name) if dtype is None else np.dtype(dtype)
+    floating = dtype.kind == 'f'
+    if null is None:
+        null = 'nan' if floating else 0
+    filename = gscript.tempfile(create=False)
+    gscript.run_command('r.out.bin', flags='f' if floating else 'i', input=name, output=filename,
+                        bytes=dtype.itemsize, null=null, quiet=True, overwrite=True)
+    try:
+        array = np.memmap(filename, dtype=dtype.newbyteorder('='), mode='c' if writable else 'r',
+                          shape=_region_shape())
+    finally:
+        # The mapping keeps the content available until the array is released
+        os.remove(filename)
+    return array
+
+def new_raster(dtype=np.float64, fill=None):
+    """Return a new memory-mapped array of the current region, to be written with write_raster().
+
+    fill --- initial value of the cells (the file is sparse and the cells are 0 if None).
+    """
+    filename = gscript.tempfile(create=False)
+    array = np.memmap(filename, dtype=np.dtype(dtype), mode='w+', shape=_region_shape())
+    if fill is not None:
+        for row, block in blocks(array):
+            block[...] = fill
+    return array
+
+def write_raster(array, name, null=None, overwrite=True, title=None):
+    """Write an array of the current region in a raster (r.in.bin).
+
+    The file of a memory-mapped array (see new_raster) is imported directly and removed. Other
+    arrays are written in a temporary file first. 'null' is the value of the null cells.
+    """
+    dtype = np.dtype(array.dtype)
+    if isinstance(array, np.memmap) and array.filename and array.flags['C_CONTIGUOUS']:
+        array.flush()
+        filename = array.filename
+    else:
+        filename = gscript.tempfile(create=False)
+        np.ascontiguousarray(array).tofile(filename)
+    if dtype.kind == 'f':
+        flags = 'f' if dtype.itemsize == 4 else 'd'
+    else:
+        flags = 's' if dtype.kind == 'i' else None
+    region = gscript.region()
+    try:
+        gscript.run_command('r.in.bin', flags=flags, input=filename, output=name, title=title,
+                            bytes=dtype.itemsize, anull=null, overwrite=overwrite, quiet=True,
+                            north=region['n'], south=region['s'], east=region['e'], west=region['w'],
+                            rows=region['rows'], cols=region['cols'])
+    finally:
+        os.remove(filename)
+
+def blocks(array, block_rows=512):
+    """Yield the index of the first row and the view (no copy) of each block of 'block_rows' rows of an array"""
+    for row in range(0, array.shape[0], block_rows):
+        yield row, array[row:row+block_rows]
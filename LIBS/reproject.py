@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Functions importing the input layers directly in the projected location.
+
+Each raster is warped by GDAL from its own CRS to the target grid (extent, resolution and alignment
+of the current region of the projected location) in one step, and imported with r.in.gdal. The
+rasters are independent, so they are warped and imported in parallel worker processes. The cells
+outside of a polygon layer (ex: the study area) can be set to null during the warp.
+
+For the population rasters (people per pixel), the counts are converted to a density (people per
+cell of the target grid, using the true area of the source cells) before the resampling, so the
+population is preserved despite the different cell sizes, without intermediate density rasters
+in GRASS GIS.
+
+The vector layers to rasterize (ex: the roads) are read by OGR with their attribute filter and
+a spatial filter on the bounding box of the target grid, reprojected in memory and burnt directly
+in the target grid, without intermediate vector maps (and their topology) in GRASS GIS.
+"""
+
+import os
+import numpy as np
+from osgeo import gdal, ogr, osr
+import grass.script as gscript
+from grass_tasks import run_parallel
+
+# Authalic radius of the WGS84 ellipsoid (m), for the area of the cells of geographic rasters
+EARTH_RADIUS = 6371007.181
+# No data value of the temporary density rasters
+DENSITY_NODATA = -9999.0
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+
+def location_srs():
+    """Return the spatial reference of the current location (osr.SpatialReference)"""
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(gscript.read_command('g.proj', flags='wf'))
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        # GDAL >= 3: keep the (x, y) = (easting, northing) or (longitude, latitude) order
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+def target_grid():
+    """Return the grid of the current region (bounds, size and spatial reference in WKT)"""
+    region = gscript.region()
+    return {'bounds': (region['w'], region['s'], region['e'], region['n']),
+            'width': region['cols'], 'height': region['rows'],
+            'cell_area': region['nsres']*region['ewres']*location_srs().GetLinearUnits()**2,
+            'srs': location_srs().ExportToWkt()}
+
+def coordinate_transform(epsg=4326):
+    """Return a function converting arrays of x and y coordinates (CRS given by the epsg code)
+    in the coordinates of the current location"""
+    source = osr.SpatialReference()
+    source.ImportFromEPSG(epsg)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transformation = osr.CoordinateTransformation(source, location_srs())
+
+    def transform(xs, ys):
+        if not len(xs):
+            return np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+        points = np.array(transformation.TransformPoints(zip(map(float, xs), map(float, ys))))
+        return points[:, 0], points[:, 1]
+    return transform
+
+def cell_areas(dataset, row, rows):
+    """Return the area (m2) of the cells of 'rows' rows of a raster dataset, from the row 'row'.
+
+    For geographic rasters, the area depends on the latitude (spherical approximation with the
+    authalic radius), otherwise all the cells have the same area.
+    """
+    transform = dataset.GetGeoTransform()
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(dataset.GetProjection())
+    if not srs.IsGeographic():
+        return np.full(rows, abs(transform[1]*transform[5])*srs.GetLinearUnits()**2)
+    top = np.radians(transform[3] + np.arange(row, row+rows)*transform[5])
+    bottom = np.radians(transform[3] + np.arange(row+1, row+rows+1)*transform[5])
+    return EARTH_RADIUS**2 * abs(np.radians(transform[1])) * np.abs(np.sin(top) - np.sin(bottom))
+
+def _density_raster(input_file, output_file, cell_area, block_rows=512):
+    """Write the density of a raster of counts per cell (ex: people per pixel) in a GeoTIFF, as
+    counts per 'cell_area' (m2), in the CRS and grid of the input raster"""
+    source = gdal.Open(input_file)
+    band = source.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    density = gdal.GetDriverByName('GTiff').Create(output_file, source.RasterXSize, source.RasterYSize, 1,
+                                                   gdal.GDT_Float32, ['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    density.SetGeoTransform(source.GetGeoTransform())
+    density.SetProjection(source.GetProjection())
+    density_band = density.GetRasterBand(1)
+    density_band.SetNoDataValue(DENSITY_NODATA)
+    for row in range(0, source.RasterYSize, block_rows):
+        rows = min(block_rows, source.RasterYSize - row)
+        values = band.ReadAsArray(0, row, source.RasterXSize, rows).astype(np.float64)
+        block = values * (cell_area / cell_areas(source, row, rows))[:, np.newaxis]
+        invalid = np.isnan(values)
+        if nodata is not None:
+            invalid |= values == nodata
+        block[invalid] = DENSITY_NODATA
+        density_band.WriteArray(block.astype(np.float32), 0, row)
+    density = None
+
+def warp_raster(layer, grid, tmpdir):
+    """Warp a raster to the target grid and import it in the current mapset.
+
+    layer --- dictionary with the input file ('input'), the name of the output raster ('output'),
+    the GDAL resampling method ('resampling', ex: 'near', 'cubic') and optionally 'population'
+    (True for counts per cell, see _density_raster) and 'cutline' (polygon layer outside of
+    which the cells are null).
+    grid --- target grid (see target_grid).
+    """
+    input_file = layer['input']
+    temp_files = []
+    if layer.get('population'):
+        input_file = os.path.join(tmpdir, "%s_density.tif" % layer['output'])
+        _density_raster(layer['input'], input_file, grid['cell_area'])
+        temp_files.append(input_file)
+    source = gdal.Open(input_file)
+    nodata = source.GetRasterBand(1).GetNoDataValue()
+    if nodata is None:
+        nodata = 0 if source.GetRasterBand(1).DataType == gdal.GDT_Byte else DENSITY_NODATA
+    source = None
+    output_file = os.path.join(tmpdir, "%s.tif" % layer['output'])
+    temp_files.append(output_file)
+    options = gdal.WarpOptions(format='GTiff', outputBounds=grid['bounds'], width=grid['width'],
+                               height=grid['height'], dstSRS=grid['srs'], resampleAlg=layer['resampling'],
+                               dstNodata=nodata, cutlineDSName=layer.get('cutline'),
+                               creationOptions=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    gdal.Warp(output_file, input_file, options=options)
+    # The raster is already in the CRS of the location, the projection check is skipped
+    gscript.run_command('r.in.gdal', flags='o', overwrite=True, quiet=True, input=output_file, output=layer['output'])
+    for temp_file in temp_files:
+        os.remove(temp_file)
+    return layer['output']
+
+def _memory_layer(input_file, srs, where=None, bounds=None):
+    """Read a vector layer in memory, reprojected in the spatial reference 'srs' (WKT).
+
+    Only the features matching the SQL 'where' condition and intersecting 'bounds' (w, s, e, n in
+    the spatial reference 'srs') are read.
+    """
+    options = gdal.VectorTranslateOptions(format='Memory', where=where, dstSRS=srs, reproject=True,
+                                          spatFilter=bounds, spatSRS=srs if bounds else None)
+    return gdal.VectorTranslate('', input_file, options=options)
+
+def rasterize_vector(layer, grid, tmpdir):
+    """Rasterize a vector layer in the target grid and import it in the current mapset.
+
+    layer --- dictionary with the input file ('input'), the name of the output raster ('output')
+    and optionally 'where' (SQL condition selecting the features) and 'cutline' (polygon layer
+    outside of which the cells are null). The cells of the features are 1, the other cells are null.
+    grid --- target grid (see target_grid).
+    """
+    features = _memory_layer(layer['input'], grid['srs'], layer.get('where'), grid['bounds'])
+    output_file = os.path.join(tmpdir, "%s.tif" % layer['output'])
+    w, s, e, n = grid['bounds']
+    raster = gdal.GetDriverByName('GTiff').Create(output_file, grid['width'], grid['height'], 1, gdal.GDT_Byte,
+                                                  ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    raster.SetGeoTransform((w, (e-w)/grid['width'], 0, n, 0, -(n-s)/grid['height']))
+    raster.SetProjection(grid['srs'])
+    raster.GetRasterBand(1).SetNoDataValue(0)
+    raster.GetRasterBand(1).Fill(0)
+    gdal.Rasterize(raster, features, burnValues=[1])
+    if layer.get('cutline'):
+        # Set the cells outside of the polygons back to null
+        gdal.Rasterize(raster, _memory_layer(layer['cutline'], grid['srs']), burnValues=[0], inverse=True)
+    raster = None
+    features = None
+    # The raster is already in the CRS of the location, the projection check is skipped
+    gscript.run_command('r.in.gdal', flags='o', overwrite=True, quiet=True, input=output_file, output=layer['output'])
+    os.remove(output_file)
+    return layer['output']
+
+def _warp_task(task):
+    """Warp (or rasterize) and import a layer (worker function)"""
+    layer = task[0]
+    if layer.get('vector'):
+        return rasterize_vector(*task)
+    return warp_raster(*task)
+
+def warp_rasters(layers, tmpdir, n_jobs=1):
+    """Warp the rasters to the current region and import them, in a pool of 'n_jobs' processes.
+
+    layers --- list of dictionaries describing the rasters (see warp_raster), or the vector layers
+    to rasterize, with 'vector': True (see rasterize_vector).
+    tmpdir --- folder for the temporary GeoTIFF files.
+    Return the list of imported rasters.
+    """
+    if not os.path.exists(tmpdir):
+        os.makedirs(tmpdir)
+    grid = target_grid()
+    tasks = [(layer, grid, tmpdir) for layer in layers]
+    return run_parallel(_warp_task, tasks, n_jobs)
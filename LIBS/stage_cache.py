@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+"""
+Functions for a persistent cache of the outputs of the stages of the processing chain.
+
+Each cache entry is identified by a key computed from the content of the input files of the stage,
+the configuration values used by the stage, the source code of the function implementing the
+stage and the source code of the modules of LIBS it depends on (directly or through other modules),
+so editing a helper of a stage invalidates its entries. The GRASS GIS layers are stored with r.pack/v.pack and restored with r.unpack/v.unpack
+in the current mapset, so a stage whose inputs did not change is not recomputed.
+The least recently used entries are removed when the cache exceeds its maximum size.
+"""
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import sys
+import types
+import inspect
+import grass.script as gscript
+
+# Folder of the modules whose source code is part of the keys (see code_files)
+LIBS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def file_hash(path, cachedir):
+    """Return the SHA-1 of the content of a file (and of its sidecar files, ex: .dbf of a shapefile).
+
+    The hash is memorized in the cache directory according to the path, size and modification
+    time of the files, so large inputs are only read again when they changed.
+    """
+    files = sorted(glob.glob("%s.*" % os.path.splitext(path)[0])) if path.endswith('.shp') else [path]
+    signature = json.dumps([(f, os.path.getsize(f), os.path.getmtime(f)) for f in files])
+    memo_file = os.path.join(cachedir, 'file_hashes.json')
+    memo = {}
+    if os.path.exists(memo_file):
+        with open(memo_file, 'r') as fin:
+            memo = json.load(fin)
+    if memo.get(path, {}).get('signature') == signature:
+        return memo[path]['hash']
+    sha = hashlib.sha1()
+    for f in files:
+        with open(f, 'rb') as fin:
+            for block in iter(lambda: fin.read(1024*1024), b''):
+                sha.update(block)
+    memo[path] = {'signature': signature, 'hash': sha.hexdigest()}
+    # Write to a temporary file first, as several processes can share the cache (see batch.py)
+    tmp_file = "%s.tmp%s" % (memo_file, os.getpid())
+    with open(tmp_file, 'w') as fout:
+        json.dump(memo, fout)
+    os.rename(tmp_file, memo_file)
+    return memo[path]['hash']
+
+def _source_file(module):
+    """Return the source file of a module, None for built-in modules"""
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return os.path.realpath(path)
+
+def _referenced_modules(namespace, names):
+    """Return the modules of the values of 'names' in a namespace (modules, or functions and
+    classes imported from a module)"""
+    modules = []
+    for name in names:
+        value = namespace.get(name)
+        if isinstance(value, types.ModuleType):
+            modules.append(value)
+        elif isinstance(value, (types.FunctionType, type, types.ClassType)) and value.__module__ in sys.modules:
+            modules.append(sys.modules[value.__module__])
+    return modules
+
+def _code_names(code):
+    """Return the global names used by a code object and its nested code objects"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_code_names(const))
+    return names
+
+def code_files(stage_function, code_dirs=(LIBS_DIR,)):
+    """Return the sorted source files of the modules of 'code_dirs' used by a stage function,
+    directly or through the modules they import"""
+    code_dirs = [os.path.realpath(folder) for folder in code_dirs]
+    pending = _referenced_modules(stage_function.__globals__, _code_names(stage_function.__code__))
+    files = set()
+    while pending:
+        module = pending.pop()
+        path = _source_file(module)
+        if path is None or path in files or os.path.dirname(path) not in code_dirs:
+            continue
+        files.add(path)
+        pending.extend(_referenced_modules(vars(module), list(vars(module))))
+    return sorted(files)
+
+def stage_key(stage_function, input_files, params, cachedir, code=(), code_dirs=(LIBS_DIR,)):
+    """Return the key of a stage from its input files, its parameters (any json serializable
+    object), the source code of the function implementing it and the source code of the modules
+    it depends on (see code_files, plus the optional list of modules 'code')"""
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    content = {}
+    content['code'] = inspect.getsource(stage_function)
+    modules = set(code_files(stage_function, code_dirs)) | set(_source_file(module) for module in code)
+    content['modules'] = []
+    for path in sorted(modules):
+        with open(path, 'rb') as fin:
+            content['modules'].append([os.path.basename(path), hashlib.sha1(fin.read()).hexdigest()])
+    content['files'] = [file_hash(path, cachedir) for path in input_files]
+    content['params'] = params
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+def lazy_stage_key(stage_function, input_files, params, cachedir, **kwargs):
+    """Return a function returning the key of a stage (see stage_key), computed at its first call,
+    so the input files are only hashed when the stage is run or its completion checked"""
+    key = []
+    def compute():
+        if not key:
+            key.append(stage_key(stage_function, input_files, params, cachedir, **kwargs))
+        return key[0]
+    return compute
+
+def _entry_size(entry):
+    """Return the size of a cache entry (in bytes)"""
+    return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+def evict(cachedir, max_size):
+    """Remove the least recently used entries until the cache is smaller than 'max_size' (in MB)"""
+    entries = []
+    for name in os.listdir(cachedir):
+        manifest = os.path.join(cachedir, name, 'manifest.json')
+        if os.path.exists(manifest):
+            entries.append((os.path.getmtime(manifest), os.path.join(cachedir, name)))
+    entries.sort()
+    total = sum(_entry_size(entry) for last_used, entry in entries)
+    while entries and total > max_size*1024*1024:
+        last_used, entry = entries.pop(0)
+        total -= _entry_size(entry)
+        shutil.rmtree(entry)
+        print "Cache entry '%s' removed (least recently used)" % os.path.basename(entry)
+
+def restore_stage(cachedir, key):
+    """Restore the outputs of a stage in the current mapset. Return False if not in the cache"""
+    entry = os.path.join(cachedir, key)
+    manifest_file = os.path.join(entry, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return False
+    with open(manifest_file, 'r') as fin:
+        manifest = json.load(fin)
+    for name in manifest['rasters']:
+        gscript.run_command('r.unpack', overwrite=True, quiet=True, input=os.path.join(entry, '%s.rpack' % name), output=name)
+    for name in manifest['vectors']:
+        gscript.run_command('v.unpack', overwrite=True, quiet=True, input=os.path.join(entry, '%s.vpack' % name), output=name)
+    for path in manifest['files']:
+        shutil.copy(os.path.join(entry, os.path.basename(path)), path)
+    # Update the time of last use (for the eviction of least recently used entries)
+    os.utime(manifest_file, None)
+    return True
+
+def store_stage(cachedir, key, rasters=[], vectors=[], files=[], max_size=None):
+    """Store the outputs of a stage (layers of the current mapset and files) in the cache"""
+    entry = os.path.join(cachedir, key)
+    tmp_entry = "%s.tmp%s" % (entry, os.getpid())
+    if os.path.exists(tmp_entry):
+        shutil.rmtree(tmp_entry)
+    os.makedirs(tmp_entry)
+    for name in rasters:
+        gscript.run_command('r.pack', overwrite=True, quiet=True, input=name, output=os.path.join(tmp_entry, '%s.rpack' % name))
+    for name in vectors:
+        gscript.run_command('v.pack', overwrite=True, quiet=True, input=name, output=os.path.join(tmp_entry, '%s.vpack' % name))
+    files = [path for path in files if os.path.exists(path)]
+    for path in files:
+        shutil.copy(path, tmp_entry)
+    manifest = {'rasters': list(rasters), 'vectors': list(vectors), 'files': files, 'created': time.time()}
+    with open(os.path.join(tmp_entry, 'manifest.json'), 'w') as fout:
+        json.dump(manifest, fout)
+    # Make the entry visible only once complete
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.rename(tmp_entry, entry)
+    if max_size is not None:
+        evict(cachedir, max_size)
+
+def cached_stage(stage_function, key, cachedir, rasters=[], vectors=[], files=[], max_size=None, use_cache=True):
+    """Run a stage function, or restore its outputs from the cache if available.
+
+    The output files of a previous run are removed first, so an optional output (ex: the file of
+    the errors) which is not created by the stage, or not in the cache entry, does not remain.
+    Return True if the outputs have been restored from the cache.
+    """
+    for path in files:
+        if os.path.exists(path):
+            os.remove(path)
+    if use_cache and restore_stage(cachedir, key):
+        print "Stage '%s' restored from cache (%s)" % (stage_function.__name__, key)
+        return True
+    stage_function()
+    if use_cache:
+        store_stage(cachedir, key, rasters, vectors, files, max_size)
+    return False
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Function extracting the stream network from the elevation raster.
+
+The elevation is warped directly to the grid of the current region (the analysis resolution),
+extended by a hydrological buffer around the area of interest, so the streams flowing into the
+area from upstream are extracted too and no reprojection of the streams is needed. The stream
+network is then enlarged and recoded, and cropped to the current region. The output depends only
+on the elevation, the grid and the parameters, so it is cached as a stage of its own (see
+stage_cache.py) and reused as long as they do not change.
+"""
+
+import math
+import grass.script as gscript
+from reproject import warp_rasters
+from tiling import tiled_command
+
+
+def extract_streams(elevation_file, output, recode_rules, tmpdir, threshold=1000, stream_length=10,
+                    grow_radius=1.01, buffer_size=0, memory=300, tile_size=0, n_jobs=1):
+    """Extract the stream network from an elevation file, over the current region plus a buffer.
+
+    elevation_file --- input elevation raster (any CRS, warped to the grid of the current region).
+    output --- name of the output raster (cropped to the current region).
+    recode_rules --- rules of r.recode applied to the enlarged streams (ex: recode them to 1).
+    tmpdir --- folder for the temporary GeoTIFF file of the warped elevation.
+    threshold, stream_length --- parameters of r.stream.extract (in cells).
+    grow_radius --- radius of r.grow enlarging the streams (in cells).
+    buffer_size --- hydrological buffer around the current region (in map units, ex: meters).
+    tile_size, n_jobs --- options of the tiled processing of r.grow and r.recode (see tiling.py).
+    """
+    region = gscript.region()
+    buffer_cells = int(math.ceil(float(buffer_size) / min(region['nsres'], region['ewres'])))
+    elevation = gscript.tempname(20)
+    streams = gscript.tempname(20)
+    grown = gscript.tempname(20)
+    # Work on the region extended by the buffer (same resolution and alignment)
+    gscript.use_temp_region()
+    try:
+        gscript.run_command('g.region', grow=buffer_cells)
+        warp_rasters([{'input': elevation_file, 'output': elevation, 'resampling': 'cubic'}], tmpdir)
+        gscript.run_command('r.stream.extract', overwrite=True, elevation=elevation, threshold=threshold,
+                            stream_length=stream_length, memory=memory, stream_raster=streams)
+        # r.grow uses a neighbourhood of 'grow_radius' cells: tiles get a halo of one more cell
+        tiled_command('r.grow', output=grown, halo=int(math.ceil(grow_radius))+1, input=streams, new=1,
+                      radius=grow_radius, tile_size=tile_size, n_jobs=n_jobs)
+    finally:
+        gscript.del_temp_region()
+    # Recode the streams in the current region, which crops them to the area of interest
+    tiled_command('r.recode', output=output, input=grown, rules=recode_rules, tile_size=tile_size, n_jobs=n_jobs)
+    gscript.run_command('g.remove', flags='f', type='raster', name=','.join([elevation, streams, grown]))
+    return output
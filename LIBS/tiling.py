@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Functions for the tiled processing of large regions.
+
+The current region is split in tiles which are processed in parallel by worker processes. Each
+worker works on its tile with the GRASS_REGION environment variable, which overrides the region
+of the mapset for the process only, so the workers share the mapset without changing its region.
+Cell-local operations (r.mapcalc without neighbourhood, r.recode, ...) are computed on the tile
+only; operations using a neighbourhood get a halo of extra cells around the tile, which is cut
+before the tiles are patched together. The memory used by each worker is bounded by the size of
+a tile (plus its halo).
+"""
+
+import os
+import re
+import contextlib
+import grass.script as gscript
+from grass_commands import remove_layers
+from grass_tasks import run_parallel
+
+
+def region_tiles(region, tile_size, halo=0):
+    """Split a region (dictionary of gscript.region()) in tiles of at most 'tile_size' rows and columns.
+
+    Return a list of tiles, as dictionaries with the bounds of the tile ('n','s','e','w','rows','cols',
+    'row','col' indices of its first cell) and the bounds of the tile with its halo ('halo' dictionary,
+    limited to the region).
+    """
+    tiles = []
+    for row in range(0, region['rows'], tile_size):
+        for col in range(0, region['cols'], tile_size):
+            tile = {'row': row, 'col': col,
+                    'rows': min(tile_size, region['rows']-row), 'cols': min(tile_size, region['cols']-col)}
+            tile['n'] = region['n'] - row*region['nsres']
+            tile['s'] = tile['n'] - tile['rows']*region['nsres']
+            tile['w'] = region['w'] + col*region['ewres']
+            tile['e'] = tile['w'] + tile['cols']*region['ewres']
+            tile['halo'] = {'n': min(region['n'], tile['n'] + halo*region['nsres']),
+                            's': max(region['s'], tile['s'] - halo*region['nsres']),
+                            'w': max(region['w'], tile['w'] - halo*region['ewres']),
+                            'e': min(region['e'], tile['e'] + halo*region['ewres'])}
+            tiles.append(tile)
+    return tiles
+
+def _region_env(bounds, region):
+    """Return the value of GRASS_REGION for the given bounds, with the resolution of 'region'"""
+    return gscript.region_env(n=bounds['n'], s=bounds['s'], e=bounds['e'], w=bounds['w'],
+                              nsres=region['nsres'], ewres=region['ewres'])
+
+def _run_tile(task):
+    """Call a function for a tile (worker function)"""
+    function, index, tile, args = task
+    return function(index, tile, *args)
+
+def run_tiles(function, tiles, n_jobs=1, args=()):
+    """Call 'function(index, tile, *args)' for each tile in a pool of 'n_jobs' processes.
+
+    The tiles get the GRASS_REGION of the tile ('env') and of the tile with its halo ('halo_env').
+    'function' must be defined at the top level of a module. Return the list of results, in the
+    order of the tiles (see grass_tasks.run_parallel).
+    """
+    region = gscript.region()
+    for tile in tiles:
+        tile['env'] = _region_env(tile, region)
+        tile['halo_env'] = _region_env(tile['halo'], region)
+    tasks = [(function, index, tile, args) for index, tile in enumerate(tiles)]
+    return run_parallel(_run_tile, tasks, n_jobs)
+
+def _environ(region_value):
+    """Return a copy of the environment variables with another GRASS_REGION"""
+    env = dict(os.environ)
+    env['GRASS_REGION'] = region_value
+    return env
+
+@contextlib.contextmanager
+def tile_region(region_value):
+    """Context manager setting GRASS_REGION in the current process (ex: for raster_io.py)"""
+    previous = os.environ.get('GRASS_REGION')
+    os.environ['GRASS_REGION'] = region_value
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ['GRASS_REGION']
+        else:
+            os.environ['GRASS_REGION'] = previous
+
+def tile_name(name, index):
+    """Return the name of the part of a raster for a tile"""
+    return "%s__tile%s" % (name, index)
+
+def _crop_tile(index, tile, outputs):
+    """Cut the halo of the outputs of a tile (the tile outputs are computed with the halo)"""
+    halo_outputs = ["%s_halo" % tile_name(output, index) for output in outputs]
+    gscript.run_command('r.mapcalc', overwrite=True, quiet=True, env=_environ(tile['env']),
+                        expression='\n'.join("%s = %s" % (tile_name(output, index), halo_output)
+                                              for output, halo_output in zip(outputs, halo_outputs)))
+    remove_layers('raster', halo_outputs)
+
+def _mapcalc_tile(index, tile, expressions, outputs, halo):
+    """Compute the expressions of r.mapcalc on a tile (worker function)"""
+    tile_expressions = []
+    for output, expression in zip(outputs, expressions):
+        name = "%s_halo" % tile_name(output, index) if halo else tile_name(output, index)
+        tile_expressions.append("%s = %s" % (name, expression))
+    gscript.run_command('r.mapcalc', overwrite=True, quiet=True,
+                        env=_environ(tile['halo_env'] if halo else tile['env']),
+                        expression='\n'.join(tile_expressions))
+    if halo:
+        _crop_tile(index, tile, outputs)
+
+def _command_tile(index, tile, module, output, halo, kwargs):
+    """Run a GRASS GIS module with one output raster on a tile (worker function)"""
+    name = "%s_halo" % tile_name(output, index) if halo else tile_name(output, index)
+    gscript.run_command(module, overwrite=True, quiet=True, output=name,
+                        env=_environ(tile['halo_env'] if halo else tile['env']), **kwargs)
+    if halo:
+        _crop_tile(index, tile, [output])
+
+def patch_tiles(outputs, nb_tiles):
+    """Patch the parts of the output rasters in the current region and remove them"""
+    parts = []
+    for output in outputs:
+        output_parts = [tile_name(output, index) for index in range(nb_tiles)]
+        gscript.run_command('r.patch', overwrite=True, quiet=True, input=','.join(output_parts), output=output)
+        parts.extend(output_parts)
+    # All the parts are removed with a single command
+    remove_layers('raster', parts)
+
+def _split_expressions(expression):
+    """Return the output names and the expressions of a (multi-line) r.mapcalc expression"""
+    outputs, expressions = [], []
+    for line in re.split(r'[\n;]', expression):
+        if not line.strip():
+            continue
+        output, value = line.split('=', 1)
+        outputs.append(output.strip())
+        expressions.append(value.strip())
+    return outputs, expressions
+
+def tiled_mapcalc(expression, tile_size=0, n_jobs=1, halo=0, overwrite=True):
+    """Same as gscript.mapcalc(expression) in the current region, computed per tile in parallel.
+
+    expression --- r.mapcalc expression(s), one 'output = value' per line.
+    tile_size --- number of rows and columns of the tiles (0 to compute the whole region at once).
+    halo --- number of extra cells around the tiles, for expressions using neighbours (ex: 'a[1,0]').
+    """
+    region = gscript.region()
+    if not tile_size or (region['rows'] <= tile_size and region['cols'] <= tile_size):
+        gscript.mapcalc(expression, overwrite=overwrite)
+        return
+    outputs, expressions = _split_expressions(expression)
+    tiles = region_tiles(region, tile_size, halo)
+    run_tiles(_mapcalc_tile, tiles, n_jobs, (expressions, outputs, halo))
+    patch_tiles(outputs, len(tiles))
+
+def tiled_command(module, output, tile_size=0, n_jobs=1, halo=0, **kwargs):
+    """Same as gscript.run_command(module, output=output, **kwargs) in the current region, computed per
+    tile in parallel, for modules with a single output raster (ex: r.recode, r.grow with a halo)"""
+    region = gscript.region()
+    if not tile_size or (region['rows'] <= tile_size and region['cols'] <= tile_size):
+        gscript.run_command(module, overwrite=True, output=output, **kwargs)
+        return
+    tiles = region_tiles(region, tile_size, halo)
+    run_tiles(_command_tile, tiles, n_jobs, (module, output, halo, kwargs))
+    patch_tiles([output], len(tiles))
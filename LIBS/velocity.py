@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+Functions building the velocity rasters of all the scenarios (with/without car x wet/dry season)
+in a single pass.
+
+The land cover, roads and streams rasters are read once. The seasonal reclassification of the
+land cover (rules of r.reclass) and the velocity of the land cover classes (rules of r.recode) are
+combined in a lookup table per season, applied in memory, and the velocity rasters are written
+directly, without the intermediate rasters of the former chain of r.reclass, r.recode and r.mapcalc.
+"""
+
+import numpy as np
+import grass.script as gscript
+from tiling import region_tiles, run_tiles, patch_tiles, tile_name, tile_region
+from raster_io import read_raster, new_raster, write_raster, blocks
+
+
+def _rule_lines(rule_file):
+    """Return the lines of a rules file, without comments, empty lines and the final 'end'"""
+    lines = []
+    with open(rule_file, 'r') as fin:
+        for line in fin:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            if line.lower() == 'end':
+                break
+            lines.append(line)
+    return lines
+
+def reclass_table(rule_file, values):
+    """Apply the rules of r.reclass ('1 2 5 thru 9 = 3 label', '* = NULL') to an array of categories.
+
+    Return the new categories as floats (NaN for NULL and categories without rule). When several
+    rules are given for a category, the last one is used.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(values.shape, np.nan)
+    done = np.zeros(values.shape, dtype=bool)
+    default = None
+    for line in _rule_lines(rule_file):
+        left, right = line.split('=', 1)
+        new = right.split()[0]
+        new = np.nan if new.upper() == 'NULL' else float(new)
+        tokens = left.split()
+        if tokens == ['*']:
+            default = new
+            continue
+        selected = np.zeros(values.shape, dtype=bool)
+        i = 0
+        while i < len(tokens):
+            if i+2 < len(tokens) and tokens[i+1].lower() == 'thru':
+                selected |= (values >= float(tokens[i])) & (values <= float(tokens[i+2]))
+                i += 3
+            else:
+                selected |= values == float(tokens[i])
+                i += 1
+        # The last rule given for a category is used
+        result[selected] = new
+        done |= selected
+    if default is not None:
+        result[~done & ~np.isnan(values)] = default
+    return result
+
+def recode_table(rule_file, values):
+    """Apply the rules of r.recode ('old_low:old_high:new_low:new_high' or 'old_low:old_high:new',
+    '*' for an open bound) to an array of values.
+
+    Return the new values as floats (NaN for null values and values without rule). When several
+    rules match a value, the last one is used.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(values.shape, np.nan)
+    for line in _rule_lines(rule_file):
+        fields = line.split(':')
+        old_low = -np.inf if fields[0] == '*' else float(fields[0])
+        old_high = np.inf if fields[1] == '*' else float(fields[1])
+        new_low = float(fields[2])
+        new_high = float(fields[3]) if len(fields) > 3 else new_low
+        with np.errstate(invalid='ignore'):
+            selected = (values >= old_low) & (values <= old_high)
+        if old_high > old_low and np.isfinite(old_high - old_low):
+            result[selected] = new_low + (values[selected] - old_low)*(new_high - new_low)/(old_high - old_low)
+        else:
+            result[selected] = new_low
+    return result
+
+def velocity_tables(lulc_min, lulc_max, reclass_rules, recode_rules):
+    """Return the lookup table (velocity per land cover class from lulc_min to lulc_max) of each season.
+
+    reclass_rules --- dictionary with the r.reclass rules file of each season (land cover classes to seasonal classes).
+    recode_rules --- r.recode rules file (seasonal classes to velocity).
+    """
+    classes = np.arange(lulc_min, lulc_max+1)
+    tables = {}
+    for season, rule_file in reclass_rules.items():
+        tables[season] = recode_table(recode_rules, reclass_table(rule_file, classes))
+    return tables
+
+def _velocity_block(lulc, roads, streams, tables, lulc_min, roads_veloc, streams_veloc, water_class, scenarios):
+    """Return the velocity of each scenario (car, season) for a block of cells"""
+    valid = ~np.isnan(lulc)
+    index = np.where(valid, lulc - lulc_min, 0).astype(np.int64)
+    on_roads = roads == 1
+    on_streams = (streams == 1) & valid & (lulc != water_class)
+    velocities = {}
+    for car, season in scenarios:
+        veloc = np.where(valid, tables[season][index], np.nan)
+        if season == "WS":
+            # For the wet season only, streams layer is also used (except on water)
+            veloc = np.where(on_streams, float(streams_veloc["WS"]), veloc)
+        velocities[(car, season)] = np.where(on_roads, float(roads_veloc[car]), veloc)
+    return velocities
+
+def _build_velocity(outputs, lulc_map, roads_map, streams_map, tables, lulc_min, roads_veloc, streams_veloc,
+                    water_class, block_rows=512):
+    """Build the velocity rasters in the current region ('outputs' = dictionary (car, season) -> raster name)"""
+    lulc = read_raster(lulc_map)
+    roads = read_raster(roads_map)
+    streams = read_raster(streams_map)
+    velocities = dict((scenario, new_raster()) for scenario in outputs)
+    for row, lulc_block in blocks(lulc, block_rows):
+        block = _velocity_block(np.asarray(lulc_block), np.asarray(roads[row:row+block_rows]),
+                                np.asarray(streams[row:row+block_rows]), tables, lulc_min, roads_veloc,
+                                streams_veloc, water_class, outputs.keys())
+        for scenario, veloc in block.items():
+            velocities[scenario][row:row+block_rows] = np.where(np.isnan(veloc), -1, veloc)
+    for scenario, output in outputs.items():
+        write_raster(velocities[scenario], output, null=-1)
+
+def _build_velocity_tile(index, tile, outputs, *args):
+    """Build the velocity rasters on a tile (worker function)"""
+    with tile_region(tile['env']):
+        tile_outputs = dict((scenario, tile_name(output, index)) for scenario, output in outputs.items())
+        _build_velocity(tile_outputs, *args)
+
+def build_velocity_rasters(lulc_map, roads_map, streams_map, reclass_rules, recode_rules, roads_veloc, streams_veloc,
+                           cars=("WC","NC"), seasons=("WS","DS"), water_class=210, tile_size=0, n_jobs=1):
+    """Build the velocity rasters 'velocity_<car>_<season>' of all the scenarios in the current region.
+
+    lulc_map, roads_map, streams_map --- land cover raster, roads raster (1 on roads) and streams raster (1 on streams).
+    reclass_rules --- dictionary with the r.reclass rules file of each season.
+    recode_rules --- r.recode rules file giving the velocity of the seasonal land cover classes.
+    roads_veloc --- dictionary with the velocity on roads of each car scenario.
+    streams_veloc --- dictionary with the velocity on streams ("WS" only).
+    water_class --- land cover class on which the streams are not used.
+    tile_size, n_jobs --- tiled processing of the region (see tiling.py), disabled if tile_size is 0.
+
+    The velocity is the one of the roads where there are roads; otherwise, for the wet season,
+    the one of the streams where there are streams (except on water); otherwise the one of the land
+    cover class. Return the list of velocity rasters.
+    """
+    lulc_range = gscript.parse_command('r.info', flags='r', map=lulc_map)
+    lulc_min, lulc_max = int(float(lulc_range['min'])), int(float(lulc_range['max']))
+    tables = velocity_tables(lulc_min, lulc_max, reclass_rules, recode_rules)
+    outputs = {}
+    for season in seasons:
+        for car in cars:
+            outputs[(car, season)] = "velocity_%s_%s" % (car,season)
+    args = (lulc_map, roads_map, streams_map, tables, lulc_min, roads_veloc, streams_veloc, water_class)
+    region = gscript.region()
+    if not tile_size or (region['rows'] <= tile_size and region['cols'] <= tile_size):
+        _build_velocity(outputs, *args)
+    else:
+        tiles = region_tiles(region, tile_size)
+        run_tiles(_build_velocity_tile, tiles, n_jobs, (outputs,) + args)
+        patch_tiles(outputs.values(), len(tiles))
+    return [outputs[(car, season)] for season in seasons for car in cars]
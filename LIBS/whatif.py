@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+Functions for the incremental ("what-if") update of the accessibility when health facilities are
+added or removed, without recomputing the whole cost distance rasters.
+
+Only the cells whose nearest health facility or travel time can change are recomputed with the
+in-memory engine of cost_engine.py:
+- for added facilities, the search is bounded to a window around the new facilities, which is
+  enlarged until no improved cell is in its border band, as wide as the longest move (the improved
+  cells are connected to the new facilities, so the result is then exact);
+- for removed facilities, the catchment of the removed facilities is recomputed from the cells at
+  its border, starting with their current cost.
+The population per health facility and per isochrone band is updated from the changed cells only.
+For the walking cost of the no car scenarios, the elevation is given with the same slope model
+as the run (see cost_engine.slope_factor).
+"""
+
+import numpy as np
+import pandas as pd
+from cost_engine import cost_distance, stencil
+from zonal_stats import band_values
+
+
+def _band_index(cost, bands):
+    """Return the index of the isochrone band of each cell (len(bands) for null or out of the bands)"""
+    with np.errstate(invalid='ignore'):
+        index = np.searchsorted(bands, np.where(np.isnan(cost), np.inf, cost), side='left')
+    return index
+
+def _dilate(mask, moves):
+    """Return the cells reachable in one move from the cells of the mask"""
+    rows, cols = mask.shape
+    dilated = mask.copy()
+    for drow, dcol, intermediate, fac in moves:
+        dilated[max(0,drow):rows+min(0,drow), max(0,dcol):cols+min(0,dcol)] |= \
+            mask[max(0,-drow):rows+min(0,-drow), max(0,-dcol):cols+min(0,-dcol)]
+    return dilated
+
+def _record(changes, window, cost, nearest):
+    """Save a copy of the cost and nearest values of a window before it is modified"""
+    r0, r1, c0, c1 = window
+    changes.append((window, np.array(cost[r0:r1,c0:c1]), np.array(nearest[r0:r1,c0:c1])))
+
+def _window_elevation(elevation, window):
+    """Return the elevation of a window as floats (None without elevation)"""
+    if elevation is None:
+        return None
+    r0, r1, c0, c1 = window
+    return np.asarray(elevation[r0:r1,c0:c1], dtype=np.float64)
+
+def remove_facilities(friction, cost, nearest, cats, ns_res=1.0, ew_res=1.0, changes=None, elevation=None,
+                      slope_model='tobler'):
+    """Remove health facilities from the cost and nearest arrays (modified in place).
+
+    The catchment of the removed facilities is recomputed from the cells surrounding it, which
+    keep their (optimal) cost and nearest facility.
+    elevation, slope_model --- elevation array and slope model of a walking cost (see cost_engine.build_graph).
+    Return the list of modified windows with their previous values (see restore()).
+    """
+    if changes is None:
+        changes = []
+    removed = np.in1d(np.asarray(nearest).ravel(), cats).reshape(nearest.shape)
+    if not removed.any():
+        return changes
+    rows, cols = np.nonzero(removed)
+    window = (max(0, rows.min()-2), min(removed.shape[0], rows.max()+3),
+              max(0, cols.min()-2), min(removed.shape[1], cols.max()+3))
+    r0, r1, c0, c1 = window
+    _record(changes, window, cost, nearest)
+    removed = removed[r0:r1,c0:c1]
+    old_cost = np.array(cost[r0:r1,c0:c1])
+    old_nearest = np.array(nearest[r0:r1,c0:c1])
+    seeds = _dilate(removed, stencil(ns_res, ew_res)) & ~removed & ~np.isnan(old_cost) & (old_nearest > 0)
+    seed_rows, seed_cols = np.nonzero(seeds)
+    # Paths are only searched through the removed catchment and its border
+    window_friction = np.where(removed | seeds, np.asarray(friction[r0:r1,c0:c1], dtype=np.float64), np.nan)
+    new_cost, new_nearest = cost_distance(window_friction, seed_rows, seed_cols, old_nearest[seeds],
+                                          ns_res=ns_res, ew_res=ew_res, start_costs=old_cost[seeds],
+                                          elevation=_window_elevation(elevation, window), slope_model=slope_model)
+    cost[r0:r1,c0:c1] = np.where(removed, new_cost, old_cost)
+    nearest[r0:r1,c0:c1] = np.where(removed, new_nearest, old_nearest)
+    return changes
+
+def add_facilities(friction, cost, nearest, rows, cols, cats, ns_res=1.0, ew_res=1.0, margin=64, changes=None,
+                   elevation=None, slope_model='tobler'):
+    """Add health facilities (row and column indices, categories) to the cost and nearest arrays (modified in place).
+
+    elevation, slope_model --- elevation array and slope model of a walking cost (see cost_engine.build_graph).
+    Return the list of modified windows with their previous values (see restore()).
+    """
+    if changes is None:
+        changes = []
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    nb_rows, nb_cols = cost.shape
+    # Largest row or column offset of a move (2 with the knight moves)
+    radius = max(max(abs(drow), abs(dcol)) for drow, dcol, intermediate, fac in stencil(ns_res, ew_res))
+    while True:
+        window = (max(0, rows.min()-margin), min(nb_rows, rows.max()+margin+1),
+                  max(0, cols.min()-margin), min(nb_cols, cols.max()+margin+1))
+        r0, r1, c0, c1 = window
+        window_friction = np.asarray(friction[r0:r1,c0:c1], dtype=np.float64)
+        old_cost = np.array(cost[r0:r1,c0:c1])
+        old_cost = np.where(np.isnan(old_cost), np.inf, old_cost)
+        # Cells further than the largest current cost can not be improved
+        limit = np.inf
+        if np.isfinite(old_cost).any() and not (np.isinf(old_cost) & np.isfinite(window_friction)).any():
+            limit = old_cost[np.isfinite(old_cost)].max()
+        new_cost, new_nearest = cost_distance(window_friction, rows-r0, cols-c0, cats,
+                                              ns_res=ns_res, ew_res=ew_res, limit=limit,
+                                              elevation=_window_elevation(elevation, window), slope_model=slope_model)
+        with np.errstate(invalid='ignore'):
+            improved = new_cost < old_cost
+        # A move of the stencil can leave the window from any of its 'radius' outer rows and columns
+        touches = ((r0 > 0 and improved[:radius].any()) or (r1 < nb_rows and improved[-radius:].any()) or
+                   (c0 > 0 and improved[:,:radius].any()) or (c1 < nb_cols and improved[:,-radius:].any()))
+        if not touches:
+            break
+        margin *= 2
+    _record(changes, window, cost, nearest)
+    cost[r0:r1,c0:c1] = np.where(improved, new_cost, cost[r0:r1,c0:c1])
+    nearest[r0:r1,c0:c1] = np.where(improved, new_nearest, nearest[r0:r1,c0:c1])
+    return changes
+
+def restore(cost, nearest, changes):
+    """Restore the cost and nearest arrays as they were before the changes"""
+    for window, old_cost, old_nearest in reversed(changes):
+        r0, r1, c0, c1 = window
+        cost[r0:r1,c0:c1] = old_cost
+        nearest[r0:r1,c0:c1] = old_nearest
+
+def _original_state(cost, nearest, changes):
+    """Return the union window of the changes (bounding box) with the cost and nearest values it
+    had before all the changes (the first saved value of each cell)"""
+    r0 = min(window[0] for window, old_cost, old_nearest in changes)
+    r1 = max(window[1] for window, old_cost, old_nearest in changes)
+    c0 = min(window[2] for window, old_cost, old_nearest in changes)
+    c1 = max(window[3] for window, old_cost, old_nearest in changes)
+    original_cost = np.array(cost[r0:r1,c0:c1])
+    original_nearest = np.array(nearest[r0:r1,c0:c1])
+    for (w_r0, w_r1, w_c0, w_c1), old_cost, old_nearest in reversed(changes):
+        original_cost[w_r0-r0:w_r1-r0,w_c0-c0:w_c1-c0] = old_cost
+        original_nearest[w_r0-r0:w_r1-r0,w_c0-c0:w_c1-c0] = old_nearest
+    return (r0, r1, c0, c1), original_cost, original_nearest
+
+def update_facility_stats(stats, pops, cost, nearest, changes, time_limits, removed_cats=()):
+    """Update the population per health facility and per isochrone band after some changes.
+
+    stats --- dictionary with a table (columns 'HF_cat', 'ISO_cat' and 'sum') per population layer,
+    as returned by zonal_stats.facility_population_stats() for the same scenario.
+    pops --- dictionary with the array of each population layer.
+    removed_cats --- categories of the removed health facilities, dropped from the tables.
+    The windows of the changes can overlap (ex: a facility removed next to an added one): the
+    state before all the changes is compared once with the final state, cell by cell.
+    Return the updated tables (the input tables are not modified).
+    """
+    bands = band_values(time_limits)
+    nb_bands = len(bands)
+    deltas = dict((layer, []) for layer in stats)
+    if changes:
+        window, old_cost, old_nearest = _original_state(cost, nearest, changes)
+        r0, r1, c0, c1 = window
+        new_cost = np.asarray(cost[r0:r1,c0:c1])
+        new_nearest = np.asarray(nearest[r0:r1,c0:c1])
+        old_index = _band_index(old_cost, bands)
+        new_index = _band_index(new_cost, bands)
+        # Only the cells whose facility or band changed contribute
+        changed = (old_nearest != new_nearest) | (old_index != new_index)
+        for sign, index, cats in ((-1, old_index, old_nearest), (1, new_index, new_nearest)):
+            valid = changed & (cats > 0) & (index < nb_bands)
+            for layer in stats:
+                pop = np.asarray(pops[layer][r0:r1,c0:c1], dtype=np.float64)
+                pop = np.where(np.isnan(pop), 0, pop)
+                deltas[layer].append(pd.DataFrame({'HF_cat': cats[valid].astype(np.int64),
+                                                   'ISO_cat': bands[index[valid]],
+                                                   'sum': sign*pop[valid]}))
+    updated = {}
+    for layer, table in stats.items():
+        table = pd.concat([table[['HF_cat','ISO_cat','sum']]] + deltas[layer])
+        table = table.groupby(['HF_cat','ISO_cat'], as_index=False)['sum'].sum()
+        # Remove the rounding residuals of the subtractions and the removed facilities
+        table.loc[table['sum'].abs() < 1e-9, 'sum'] = 0
+        updated[layer] = table[~table['HF_cat'].isin(removed_cats)].reset_index(drop=True)
+    return updated
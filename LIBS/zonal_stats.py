@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+Functions computing population statistics per zone directly from the rasters, without vectorizing
+the zones and without going through the attribute tables of GRASS GIS vector maps.
+The rasters are exported once as memory-mapped arrays and reduced block of rows by block of rows,
+so that the memory used does not depend on the size of the region.
+For very large regions, the tiled_* functions compute the partial sums of each tile in parallel
+(see tiling.py) and add them.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import grass.script as gscript
+from tiling import region_tiles, run_tiles, tile_region
+from raster_io import read_raster
+
+
+def band_values(time_limits):
+    """Return the sorted values of the isochrone bands (the time limits) as integers"""
+    return np.array(sorted(int(float(t)) for t in time_limits), dtype=np.int64)
+
+def _zone_index(values, bands, band_index=False):
+    """Return the index of the band of each cell (len(bands) for null cells and other values).
+
+    values --- values of an isochrone raster (time limit of the band of each cell), or of a band
+    index raster (1 for the first band) if 'band_index' is True.
+    """
+    nb_bands = len(bands)
+    if band_index:
+        index = values.astype(np.int64) - 1
+        index[(index < 0) | (index >= nb_bands)] = nb_bands
+        return index
+    index = np.minimum(np.searchsorted(bands, values), nb_bands-1)
+    index[bands[index] != values] = nb_bands
+    return index
+
+def _isochrone_sums(isochrone_layers, layers_stats, time_limits, study_area, block_rows=512, band_layers=None):
+    """Return the counts and population sums per isochrone band and the total population of the
+    study area, in the current region (see isochrone_population_stats())"""
+    bands = band_values(time_limits)
+    nb_bands = len(bands)
+    pops = [read_raster(layer) for layer in layers_stats]
+    isochrones = [read_raster(zone, np.int32) for zone in (band_layers or isochrone_layers)]
+    area = read_raster(study_area)
+    totals = np.zeros(len(layers_stats))
+    # Last bin of each count / sum is used for the null cells
+    counts = np.zeros((len(isochrone_layers), nb_bands+1), dtype=np.int64)
+    sums = np.zeros((len(isochrone_layers), len(layers_stats), nb_bands+1))
+    for row in range(0, area.shape[0], block_rows):
+        in_area = ~np.isnan(area[row:row+block_rows]).ravel()
+        weights = []
+        for i, pop in enumerate(pops):
+            block = np.asarray(pop[row:row+block_rows], dtype=np.float64).ravel()
+            block = np.where(np.isnan(block), 0, block)
+            totals[i] += block[in_area].sum()
+            weights.append(block)
+        for j, isochrone in enumerate(isochrones):
+            index = _zone_index(np.asarray(isochrone[row:row+block_rows]).ravel(), bands, bool(band_layers))
+            counts[j] += np.bincount(index, minlength=nb_bands+1)
+            for i, block in enumerate(weights):
+                sums[j, i] += np.bincount(index, weights=block, minlength=nb_bands+1)
+    return counts, sums, totals
+
+def _isochrone_tables(counts, sums, totals, isochrone_layers, layers_stats, time_limits):
+    """Return the tables of isochrone_population_stats() from the counts and sums per band"""
+    bands = band_values(time_limits)
+    nb_bands = len(bands)
+    stats = {}
+    for j, isochrone in enumerate(isochrone_layers):
+        present = counts[j, :nb_bands] > 0
+        table = pd.DataFrame(index=pd.Index(bands[present], name='zone'))
+        for i, layer in enumerate(layers_stats):
+            table['%s_SUM' % layer] = sums[j, i, :nb_bands][present]
+            table['%s_TOT' % layer] = totals[i]
+            table['%s_PROP' % layer] = (table['%s_SUM' % layer]/totals[i])*100
+        stats[isochrone] = table
+    return stats
+
+def isochrone_population_stats(isochrone_layers, layers_stats, time_limits, study_area='Study_area', block_rows=512,
+                               band_layers=None):
+    """Compute the population of each isochrone band, for all the isochrone rasters in one pass.
+
+    isochrone_layers --- list of isochrone rasters (cells with the value of the time limit of their band).
+    layers_stats --- list of population rasters (ex: ["POP_PPP","WOCBA_PPP"]).
+    time_limits --- time limits of the isochrones bands.
+    study_area --- raster of the study area, used for the total population.
+    band_layers --- optional band index rasters (1 for the first band) of the isochrone rasters,
+    read instead of the isochrone rasters (see isochrones.py).
+
+    Return a dictionary with a table per isochrone raster. The tables have one row per band (indexed
+    by the time limit, as the categories of 'r.to.vect -v') and, for each population layer, the
+    columns '<layer>_SUM', '<layer>_TOT' (total of the study area) and '<layer>_PROP' (in percent).
+    """
+    counts, sums, totals = _isochrone_sums(isochrone_layers, layers_stats, time_limits, study_area, block_rows, band_layers)
+    return _isochrone_tables(counts, sums, totals, isochrone_layers, layers_stats, time_limits)
+
+def _isochrone_sums_tile(index, tile, *args):
+    """Compute the sums of isochrone_population_stats() on a tile (worker function)"""
+    with tile_region(tile['env']):
+        return _isochrone_sums(*args)
+
+def tiled_isochrone_population_stats(isochrone_layers, layers_stats, time_limits, study_area='Study_area',
+                                     band_layers=None, tile_size=0, n_jobs=1):
+    """Same as isochrone_population_stats(), with the tiles of the current region computed in parallel"""
+    if not tile_size:
+        return isochrone_population_stats(isochrone_layers, layers_stats, time_limits, study_area, band_layers=band_layers)
+    tiles = region_tiles(gscript.region(), tile_size)
+    results = run_tiles(_isochrone_sums_tile, tiles, n_jobs,
+                        (isochrone_layers, layers_stats, time_limits, study_area, 512, band_layers))
+    counts, sums, totals = [sum(values) for values in zip(*results)]
+    return _isochrone_tables(counts, sums, totals, isochrone_layers, layers_stats, time_limits)
+
+def write_stats_csv(table, csv_file):
+    """Write a table of statistics as csv, with a .csvt file so that OGR (db.in.ogr) gets the column types"""
+    table.to_csv(csv_file, sep=',')
+    with open("%s.csvt" % os.path.splitext(csv_file)[0], 'w') as fout:
+        fout.write(','.join(['Integer'] + ['Real']*len(table.columns)))
+
+def _grow(array, size):
+    """Return 'array' extended with zeros along its last axis up to 'size'"""
+    if array.shape[-1] >= size:
+        return array
+    extension = np.zeros(array.shape[:-1] + (size-array.shape[-1],), dtype=array.dtype)
+    return np.concatenate([array, extension], axis=-1)
+
+def _facility_sums(nearest_layers, isochrone_layers, layers_stats, time_limits, block_rows=512, band_layers=None):
+    """Return the counts and population sums per key (health facility, band) of each scenario,
+    in the current region (see facility_population_stats())"""
+    bands = band_values(time_limits)
+    nb_bands = len(bands)
+    nb_scenarios = len(nearest_layers)
+    pops = [read_raster(layer) for layer in layers_stats]
+    nearests = [read_raster(nearest, np.int32) for nearest in nearest_layers]
+    isochrones = [read_raster(zone, np.int32) for zone in (band_layers or isochrone_layers)]
+    counts = [np.zeros(0, dtype=np.int64) for scenario in range(nb_scenarios)]
+    sums = [np.zeros((len(layers_stats), 0)) for scenario in range(nb_scenarios)]
+    for row in range(0, pops[0].shape[0], block_rows):
+        weights = []
+        for pop in pops:
+            block = np.asarray(pop[row:row+block_rows], dtype=np.float64).ravel()
+            weights.append(np.where(np.isnan(block), 0, block))
+        for j in range(nb_scenarios):
+            cats = np.asarray(nearests[j][row:row+block_rows], dtype=np.int64).ravel()
+            index = _zone_index(np.asarray(isochrones[j][row:row+block_rows]).ravel(), bands, bool(band_layers))
+            valid = (cats > 0) & (index < nb_bands)
+            keys = cats[valid]*nb_bands + index[valid]
+            if not len(keys):
+                continue
+            size = int(keys.max())+1
+            counts[j] = _grow(counts[j], size)
+            sums[j] = _grow(sums[j], size)
+            counts[j][:size] += np.bincount(keys, minlength=size)
+            for i, block in enumerate(weights):
+                sums[j][i, :size] += np.bincount(keys, weights=block[valid], minlength=size)
+    return counts, sums
+
+def _facility_tables(counts, sums, layers_stats, time_limits):
+    """Return the tables of facility_population_stats() from the counts and sums per key"""
+    bands = band_values(time_limits)
+    nb_bands = len(bands)
+    nb_scenarios = len(counts)
+    stats = []
+    for j in range(nb_scenarios):
+        keys = np.nonzero(counts[j])[0]
+        scenario_stats = {}
+        for i, layer in enumerate(layers_stats):
+            scenario_stats[layer] = pd.DataFrame({'HF_cat': keys // nb_bands,
+                                                  'ISO_cat': bands[keys % nb_bands],
+                                                  'sum': sums[j][i, keys]})[['HF_cat','ISO_cat','sum']]
+        stats.append(scenario_stats)
+    return stats
+
+def facility_population_stats(nearest_layers, isochrone_layers, layers_stats, time_limits, block_rows=512,
+                              band_layers=None):
+    """Compute the population per health facility and per isochrone band, for all the scenarios in one pass.
+
+    nearest_layers --- list of catchment rasters (category of the nearest health facility, from r.cost).
+    isochrone_layers --- list of isochrone rasters, in the same order than 'nearest_layers'.
+    layers_stats --- list of population rasters (ex: ["POP_PPP","WOCBA_PPP"]).
+    time_limits --- time limits of the isochrones bands.
+    band_layers --- optional band index rasters, read instead of the isochrone rasters.
+
+    Each pair (health facility, band) is encoded as an integer key (cat * number of bands + band index)
+    and the population of all the layers is summed per key with bincount, which replaces r.cross
+    and r.univar -t on the crossed map.
+    Return a list (one item per scenario) of dictionaries with, for each population layer, a table
+    with the columns 'HF_cat', 'ISO_cat' (time limit of the band) and 'sum'.
+    """
+    counts, sums = _facility_sums(nearest_layers, isochrone_layers, layers_stats, time_limits, block_rows, band_layers)
+    return _facility_tables(counts, sums, layers_stats, time_limits)
+
+def _facility_sums_tile(index, tile, *args):
+    """Compute the sums of facility_population_stats() on a tile (worker function)"""
+    with tile_region(tile['env']):
+        return _facility_sums(*args)
+
+def tiled_facility_population_stats(nearest_layers, isochrone_layers, layers_stats, time_limits, band_layers=None,
+                                    tile_size=0, n_jobs=1):
+    """Same as facility_population_stats(), with the tiles of the current region computed in parallel"""
+    if not tile_size:
+        return facility_population_stats(nearest_layers, isochrone_layers, layers_stats, time_limits,
+                                         band_layers=band_layers)
+    tiles = region_tiles(gscript.region(), tile_size)
+    results = run_tiles(_facility_sums_tile, tiles, n_jobs,
+                        (nearest_layers, isochrone_layers, layers_stats, time_limits, 512, band_layers))
+    counts, sums = results[0]
+    for tile_counts, tile_sums in results[1:]:
+        for j in range(len(counts)):
+            size = max(counts[j].shape[-1], tile_counts[j].shape[-1])
+            counts[j] = _grow(counts[j], size) + _grow(tile_counts[j], size)
+            sums[j] = _grow(sums[j], size) + _grow(tile_sums[j], size)
+    return _facility_tables(counts, sums, layers_stats, time_limits)
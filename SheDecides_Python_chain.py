@@ -32,6 +32,7 @@
 # Import libraries needed for setting parameters of operating system 
 import os
 import sys
+import argparse
 
 # Add folder with python libs to path
 script_path = os.path.dirname(os.path.realpath(__file__))
@@ -43,8 +44,20 @@ if src not in sys.path:
 # Please edit the file in `../SRC/config.py`, containing the configuration parameters
 # according to your own computer setup.
 
+# When run by the batch runner (see batch.py), the configuration file of the country is given by
+# the SHEDECIDES_CONFIG environment variable, and the cores and memory allocated to the country
+# by SHEDECIDES_NJOBS and SHEDECIDES_MEMORY.
+if 'SHEDECIDES_CONFIG' in os.environ:
+    import imp
+    imp.load_source('config', os.environ['SHEDECIDES_CONFIG'])
+
 from config import config_parameters, data, outputs, hc_rules, rule_file, roads_veloc, streams_veloc
 
+if 'SHEDECIDES_NJOBS' in os.environ:
+    config_parameters['njobs'] = int(os.environ['SHEDECIDES_NJOBS'])
+if 'SHEDECIDES_MEMORY' in os.environ:
+    config_parameters['memory'] = int(os.environ['SHEDECIDES_MEMORY'])
+
 # Import functions that setup the environmental variables
 import environ_variables as envi
 
@@ -64,240 +77,204 @@ import grass.script.core
 # Import functions that check existence and create GRASS GIS database folder if needed
 from grass_database import check_gisdb, check_location, check_mapset, working_mapset
 
-# Import functions for processing time information
-from processing_time import start_processing, print_processing_time
-
-# Import function that clips multiple raster according to extention of a vector layer
-from clip_multiple_raster import clip_multiple_raster
-
-# Import function that checks and create folder
-from mkdir import check_create_dir
-
-# Import functions for handling json input
-from import_json import get_groupsets, get_groups, get_units, create_pointmap
+# Import functions for the profiling of the stages and of the GRASS GIS commands
+from profiling import start_profiling, start_stage, end_stage, stop_profiling
 
-# Import function that checks if GRASS GIS add-on is installed and install it if needed
-from gextension import check_install_addon
+# Import functions that warp the input rasters to the grid of the location
+from reproject import warp_rasters, coordinate_transform
 
-# BEGINNING OF CODE
+# Import functions that compute the cost distance scenarios in parallel
+from parallel_cost import cost_scenarios, run_cost_scenarios
 
-# Create list for storing name of intermediates layers
-TMP_rast = []
-TMP_vect = []
+# Import functions for the cache of the outputs of the stages
+from stage_cache import lazy_stage_key, cached_stage
 
-# Create temporary directory to hold all temporary files that will be erased at
-# the end
-check_create_dir(config_parameters['workingdir'])
+# Import function building the velocity rasters of all the scenarios
+from velocity import build_velocity_rasters
 
-# Create directory to hold final outputs
-check_create_dir(config_parameters['outputdir'])
+# Import function extracting the stream network from the elevation
+from streams import extract_streams
 
-# # Preprocessing
+# Import function classifying the cost rasters in isochrone bands
+from isochrones import isochrone_bands
 
-# Create a GRASSDATA, create a location in WGS84 (lat/long) and start working in that location
+# Import functions computing zonal statistics directly from the rasters
+from zonal_stats import tiled_isochrone_population_stats, tiled_facility_population_stats, write_stats_csv
 
-gisrc = gscript.setup.init(config_parameters['GISBASE'],
-                           config_parameters["gisdb"],
-                           "Worldpop_transform", config_parameters['mapset'])
+# Import functions reducing the overhead of the GRASS GIS commands
+from grass_commands import command_session, session_report, remove_layers, rename_layers
 
-# Check if the GRASS GIS database exists and create it if not
-check_gisdb(config_parameters["gisdb"])
-# Check if the location exists and create it if not, with the CRS defined by the epsg code 
-check_location(config_parameters["gisdb"],"Worldpop_transform","4326")
-# Change the current working GRASS GIS session mapset
-working_mapset(config_parameters["gisdb"],"Worldpop_transform",config_parameters['mapset'])
+# Import functions writing the isochrone maps
+from isochrone_maps import requested_isochrones, write_isochrone_maps
 
-# Make sure that all the input datasets are in WGS84
+# Import function that checks and create folder
+from mkdir import check_create_dir
 
-# WOCBA
+# Import functions running the stages of the chain with checkpoints
+from pipeline import pipeline_stage, run_pipeline, pipeline_status, stage_index
 
-# Import raster
-gscript.run_command('r.in.gdal', overwrite=True, input=data['WOCBA_PPP'][1], output=data['WOCBA_PPP'][0])
+# Import functions exporting the population per health facility of all the scenarios in one table
+from export_results import facility_attributes, results_table, write_results, write_results_gpkg
 
-# Define region based on this layer
-gscript.run_command('g.region', flags='s', raster=data['WOCBA_PPP'][0])
+# Import function reading the categories of the health facilities
+from cost_engine import read_start_points
 
-# Compute density - Population per hectare (pph)
-formula = "%s=%s/(area()/10000)" % (data['WOCBA_PPH'],data['WOCBA_PPP'][0])
-gscript.mapcalc(formula, overwrite=True)
+# Import functions for handling json input
+from import_json import get_groupsets, get_groups, get_units, create_facility_map, rules_need_sql
 
-# POPULATION
+# BEGINNING OF CODE
 
-# Import raster
-gscript.run_command('r.in.gdal', overwrite=True, input=data['POP_PPP'][1], output=data['POP_PPP'][0])
+# Check the rules classifying the health facilities before any processing: the rules outside of the
+# grammar evaluated in memory (see import_json.evaluate_rule) are evaluated by the database
+if rules_need_sql(hc_rules):
+    print "Some rules of hc_rules are evaluated by the database"
 
-# Define region based on this layer
-gscript.run_command('g.region', raster=data['POP_PPP'][0])
+# Create the working directory, holding the GRASS GIS database and the completion markers of the
+# stages. Its path is stable, so an interrupted run can be resumed; it is erased at the end of a
+# complete run (unless the temporary files are kept)
+check_create_dir(config_parameters['workingdir'])
 
-# Compute density - Population per hectare (pph)
-formula = "%s=%s/(area()/10000)" % (data['POP_PPH'],data['POP_PPP'][0])
-gscript.mapcalc(formula, overwrite=True)
+# Create directory to hold final outputs
+check_create_dir(config_parameters['outputdir'])
 
-# HEALTH CENTERS
+# Parse command line options
+parser = argparse.ArgumentParser(description="Accessibility to health facilities")
+parser.add_argument('--no-cache', action='store_true', help="Recompute all the stages without using the stage cache")
+parser.add_argument('--resume', action='store_true', help="Skip the stages completed by a previous run (restart from the first incomplete stage)")
+parser.add_argument('--from', dest='first', metavar='STAGE', help="First stage to run (the previous stages must be completed)")
+parser.add_argument('--until', dest='last', metavar='STAGE', help="Last stage to run")
+parser.add_argument('--status', action='store_true', help="Print the stages completed by the previous runs and exit")
+args = parser.parse_args()
+use_cache = not args.no_cache
 
-# Import points directly from the json files
-groupsets = get_groupsets(data['GROUPSETS'])
-groups = get_groups(data['GROUPS'])
-units = get_units(data['HC'][1])
-temppointmap = gscript.tempname(20)
-create_pointmap(units, groups, groupsets, temppointmap, overwrite=True)
+# Options of the tiled processing of the cell-local stages (see tiling.py), disabled if tile_size is 0
+tile_options = {'tile_size': config_parameters['tile_size'], 'n_jobs': config_parameters['njobs']}
 
-# Check if points fall outside of current computational region.
-# If yes, emit a warning
-gscript.run_command('g.region', flags='d')
+# Parameters of the extraction of the stream network (see streams.py)
+stream_options = {'threshold': config_parameters['stream_threshold'], 'stream_length': config_parameters['stream_length'],
+                  'grow_radius': config_parameters['stream_grow_radius'], 'buffer_size': config_parameters['stream_buffer'],
+                  'tile_size': config_parameters['tile_size'], 'n_jobs': config_parameters['njobs']}
 
-tempregion = gscript.tempname(20)
-gscript.run_command('v.in.region',
-                    output=tempregion,
-                    quiet=True)
+# Folder of the completion markers of the stages (see pipeline.py)
+statedir = os.path.join(config_parameters['workingdir'], 'checkpoints')
 
-error_map = gscript.tempname(20)
+# # Preprocessing
 
-gscript.run_command('v.select',
-                    ain=temppointmap,
-                    bin_=tempregion,
-                    output=data['HC'][0],
-                    operator='within',
-                    quiet=True)
+def import_layers():
+    """Import the layers directly in the projected location: the rasters are warped and the roads
+    rasterized to the grid of the study area in parallel, and the health facilities are prepared"""
 
-topoinfo_tempmap = gscript.vector_info_topo(temppointmap)
-topoinfo_finalmap = gscript.vector_info_topo(data['HC'][0])
+    # ## Administrative units
 
+    start_stage("Study area")
+    # Import and reproject the study area on the fly
+    gscript.run_command('v.import', overwrite=True, input=data['admin'][1], output="Study_area")
 
-# Check if some points fall outside the working region
-if topoinfo_tempmap['points'] != topoinfo_finalmap['points']:
+    # Define and save the default computational region based on the Study_area vector layer.
+    # This grid (extent, resolution and alignment) is the target of all the rasters.
+    gscript.run_command('g.region', flags='as', vector="Study_area", res=config_parameters['resolution'])
 
-    # Get points that fall outside
-    gscript.run_command('v.select',
-                        ain=temppointmap,
-                        bin_=tempregion,
-                        output=error_map,
-                        operator='within',
-                        flags='r',
-                        quiet=True)
-    topoinfo = gscript.vector_info_topo(error_map)
+    # Define MASK and get a copy
+    gscript.run_command('r.mask', overwrite=True, vector='Study_area')
+    gscript.run_command('g.copy', overwrite=True, raster='MASK,Study_area')
+    gscript.run_command('r.mask', flags='r')
+    end_stage()
 
-    error_file_name = data['HC'][0] + '_errors.csv'
-    error_file = os.path.join(config_parameters['outputdir'], error_file_name)
-    
-    warning_message = '%s points are outside the working region, please check !\n' % topoinfo['points']
-    warning_message += 'Only those points falling into the working region will be considered.\n'
-    warning_message += 'The working region is determined by the WOCBA input file.\n'
-    warning_message += 'The offending points have been saved in the file %s' % error_file_name
-    warning_message += ' in the output directory.\n'
-    gscript.warning(warning_message)
-
-    gscript.run_command('v.db.select',
-                        map_=temppointmap,
-                        separator='comma',
-                        file_=error_file,
-                        overwrite=True,
-                        quiet=True)
-    gscript.run_command('g.remove',
-                        type_='vector',
-                        name=error_map,
-                        flags='f',
-                        quiet=True)
-
-gscript.run_command('g.remove',
-                    type_='vector',
-                    name=[tempregion,temppointmap],
-                    flags='f',
-                    quiet=True)
-
-# Determine health center hierarchical level
-gscript.run_command('v.db.addcolumn',
-                    map_=data['HC'][0],
-                    column='level integer',
-                    quiet=True)
-
-for hc_level, rule in hc_rules.iteritems():
-    gscript.run_command('v.db.update',
-                        map_=data['HC'][0],
-                        column='level',
-                        value=hc_level,
-                        where=rule,
-                        quiet=True)
-
-
-# **LULC**
-
-
-# Import raster
-gscript.run_command('g.region', flags='d')
-gscript.run_command('r.in.gdal', flags='r', overwrite=True, input=data['LULC'][1], output=data['LULC'][0])
-
-# **ROADS**
-
-# For OSM roads, in a future version, the roads could be imported directly from the OSM database. Here, they were downloaded in QGIS with Quick OSM.
-
-if data['ROADS'][0] <> "OSM":
-    # Import vector with roads (not osm)
-    gscript.run_command('v.in.ogr', overwrite=True, input=data['ROADS'][1], output=data['ROADS'][0])
-else:
-    # Import vector with OSM roads
-    tmp_layer = gscript.tempname(20) # Create a name for temporary layer
-    gscript.run_command('v.in.ogr', overwrite=True, input=data['ROADS'][1], output=tmp_layer)
-    # Extract features of interest from OSM data
-    where_condition = "highway IN ('motorway','motorway_link','primary','primary_link','road','secondary','secondary_link','tertiary','tertiary_link','trunk','trunk_link')"
-    gscript.run_command('v.extract', overwrite=True, input=tmp_layer, where=where_condition, output=data['ROADS'][0])
-    # Remove temporary layer
-    gscript.run_command('g.remove', flags='f', type='vector', name=tmp_layer)
 
-# **ADMINISTRATIVE UNITS**
+    # ## Rasters (WOCBA, POPULATION, LULC, SRTM) and roads
 
-# Import administrative units
-gscript.run_command('v.in.ogr', overwrite=True, input=data['admin'][1], output=data['admin'][0])
+    # Each raster is warped by GDAL from its own CRS to the grid of the study area in one step, the
+    # cells outside of the study area being null, and imported. The population rasters (people per
+    # pixel) are resampled as densities so the population is preserved (see reproject.py).
+    layers = [{'input': data['WOCBA_PPP'][1], 'output': data['WOCBA_PPP'][0], 'resampling': 'cubic', 'population': True},
+              {'input': data['POP_PPP'][1], 'output': data['POP_PPP'][0], 'resampling': 'cubic', 'population': True},
+              {'input': data['LULC'][1], 'output': data['LULC'][0], 'resampling': 'near'},
+              {'input': data['SRTM'][1], 'output': data['SRTM'][0], 'resampling': 'cubic'}]
 
+    # **ROADS**
 
-# **SRTM (ELEVATION)**
+    # For OSM roads, in a future version, the roads could be imported directly from the OSM database. Here, they were downloaded in QGIS with Quick OSM.
 
-# TODO ?
-#In a future version, the SRTM tiles could be imported on the fly and mosaicked to create the elevation layer. 
-# r.in.srtm.region should be used for that. This requires creating a login and
-# password at https://urs.earthdata.nasa.gov/users/new
+    # The roads are read with the filter on the highway classes (OSM roads only) and on the bounding
+    # box of the study area, and burnt directly in the grid of the study area (1 on roads)
+    roads = {'input': data['ROADS'][1], 'output': data['ROADS'][0], 'vector': True}
+    if data['ROADS'][0] == "OSM":
+        # Features of interest of OSM data
+        roads['where'] = "highway IN ('motorway','motorway_link','primary','primary_link','road','secondary','secondary_link','tertiary','tertiary_link','trunk','trunk_link')"
+    layers.append(roads)
 
-#For the moment, this is performed outside the script. Here are the commands used:
-#Download the SRTM tiles for the AOI and store them (zip files) in the same directory. Unzip them.
-# In a Grass location with SRS 4326 (WGS84), import all the SRTM .hgt files (tiles) that cover the AOI. Source type: Directory. Source input: SRTMHGT. File Format Extension: hgt
-#r.import input=E:\Sabine\my_shedecides_datasets\senegal\Data\Elevation\N12W012.hgt output=N12W012
-#Print a list containing the name of the files that will be used to define the region. 
-#g.list type=raster mapset=PERMANENT
+    # The layers are independent and are processed in parallel
+    start_stage("Reprojection and clip")
+    for layer in layers:
+        layer['cutline'] = data['admin'][1]
+    warp_rasters(layers, os.path.join(config_parameters['workingdir'], 'warp'), n_jobs=config_parameters['njobs'])
+    end_stage()
 
-#Copy-paste it to a text editor and replace the paragraph mark with a comma.
-#Copy-paste the file list into g.region to define the computational region (Option: set region to match raster map(s))
-#g.region raster=N13W015,N13W016,N13W017,N14W012,N14W013,N14W014,N14W015,N14W016,N14W017,N14W018,N15W012,N15W013,N15W014,N15W015,N15W016,N15W017,N15W018,N16W012,N16W013,N16W014,N16W015,N16W016,N16W017
-#Copy-paste the list into r.patch to mosaic all the SRTM tiles.
-#r.patch input=N12W012,N12W013,N12W014,N12W015,N12W016,N12W017,N13W012,N13W013,N13W014,N13W015,N13W016,N13W017,N14W012,N14W013,N14W014,N14W015,N14W016,N14W017,N14W018,N15W012,N15W013,N15W014,N15W015,N15W016,N15W017,N15W018,N16W012,N16W013,N16W014,N16W015,N16W016,N16W017 output=senegal_srtm_4326
 
-# Import SRTM elevation raster
-gscript.run_command('r.in.gdal', overwrite=True, input=data['SRTM'][1], output=data['SRTM'][0])
+    # ## Health facilities (HC)
 
-# **STREAMS**
-# Import TCI raster (this was replaced with the extraction of the stream network with r.stream.extract)
-#gscript.run_command('r.in.gdal', overwrite=True, input=data['TCI'][1], output=data['TCI'][0])
+    start_stage("Health facilities")
+    # Import points directly from the json files
+    groupsets = get_groupsets(data['GROUPSETS'])
+    groups = get_groups(data['GROUPS'])
+    units = get_units(data['HC'][1])
 
+    # Keep the points falling into the current computational region (coordinates converted from
+    # WGS84 to the location) and determine health center hierarchical level. If some points fall
+    # outside, emit a warning
+    gscript.run_command('g.region', flags='d')
 
+    error_file_name = data['HC'][0] + '_errors.csv'
+    error_file = os.path.join(config_parameters['outputdir'], error_file_name)
+    tmp_layer = gscript.tempname(20)
+    nb_outside = create_facility_map(units, groups, groupsets, hc_rules, tmp_layer,
+                                     gscript.region(), error_file, overwrite=True,
+                                     transform=coordinate_transform(4326))
+
+    # Check if some points fall outside the working region
+    if nb_outside:
+        warning_message = '%s points are outside the working region, please check !\n' % nb_outside
+        warning_message += 'Only those points falling into the working region will be considered.\n'
+        warning_message += 'The working region is determined by the administrative units input file.\n'
+        warning_message += 'The offending points have been saved in the file %s' % error_file_name
+        warning_message += ' in the output directory.\n'
+        gscript.warning(warning_message)
+
+    # Select point into study area (create new layer)
+    gscript.run_command('v.select', overwrite=True, ainput=tmp_layer, binput="Study_area", output=data['HC'][0], operator="within")
 
-# Extract the stream network using the elevation layer, enlarge the streams and recode them to 1
-tmp_layer1 = gscript.tempname(20) # Create a name for temporary layer
-tmp_layer2 = gscript.tempname(20) # Create a name for temporary layer
-gscript.run_command('r.stream.extract', overwrite=True, elevation=data['SRTM'][0], threshold=1000, stream_length=10, memory=config_parameters['memory'], stream_raster=tmp_layer1)
-gscript.run_command('r.grow', overwrite=True, input=tmp_layer1, new=1, output=tmp_layer2)
-gscript.run_command('r.recode', overwrite=True, input=tmp_layer2, output=data['STREAMS'], rules=rule_file['Recode_streams'])
-gscript.run_command('g.remove', flags='f', type='raster', name=','.join([tmp_layer1,tmp_layer2])) # Delete temporary layers
+    # Remove temporary layer
+    remove_layers('vector', [tmp_layer])
 
+    # Create two new sub-layer based on level of HC (HCL1 ; HCL2)
+    for hc_level in hc_rules.keys():
+        gscript.run_command('v.extract',
+                            overwrite=True,
+                            input=data['HC'][0],
+                            where="level=%s" % str(hc_level),
+                            output='%sL%s' % (data['HC'][0], str(hc_level)))
 
+    # Rename HC layer that contain both levels
+    rename_layers('vector', [(data['HC'][0], "%sall" % data['HC'][0])])
+    end_stage()
 
+def prepare_streams():
+    """Extract the stream network from the elevation, over the study area plus a hydrological buffer"""
+    extract_streams(data['SRTM'][1], data['STREAMS'], rule_file['Recode_streams'],
+                    os.path.join(config_parameters['workingdir'], 'streams'), memory=config_parameters['memory'],
+                    **stream_options)
 
-# # Processing : Computation of accessibility to health centers
 
-# ## Launch GRASS GIS session
+# ## Launch GRASS GIS sessions
 
-# **Create a location in a projected system (UTM or other) and start working in that location**
 
-# In GRASS GIS, original data are usually imported and stored in the config_parameters['mapset'] mapset (automatically created when creating a new location).
+# Create a GRASSDATA, create a location in a projected system (UTM or other) and start working
+# in that location. The input layers are reprojected on the fly when they are imported, so no
+# location in WGS84 (lat/long) is needed.
 
+gisrc = gscript.setup.init(config_parameters['GISBASE'],
+                           config_parameters["gisdb"],
+                           config_parameters['location'], config_parameters['mapset'])
 
 # Check if the GRASS GIS database exists and create it if not
 check_gisdb(config_parameters["gisdb"])
@@ -307,531 +284,254 @@ check_location(config_parameters["gisdb"], config_parameters['location'], config
 working_mapset(config_parameters["gisdb"], config_parameters['location'], config_parameters['mapset'])
 
 
-# # Import data / Preparation of data
-
-
-# Saving current time for processing time management
-begintime_importdata=start_processing()
-
-
-# ## Administrative units
-
-# Reproject layer from location in WGS84
-gscript.run_command('v.proj', overwrite=True, location="Worldpop_transform",
-                    input=data['admin'][0], output="Study_area")
-
-
-# Define computational region based on the Study_area vector layer
-gscript.run_command('g.region', vector="Study_area",
-        res=config_parameters['resolution'], flags='a')
-
-
-# **WOCBA**
-
-
-# Reproject layer from location in WGS84
-gscript.run_command('r.proj', overwrite=True, location="Worldpop_transform", method='bicubic',
-                    input=data['WOCBA_PPH'], output=data['WOCBA_PPH'],
-                    resolution=config_parameters['resolution'])
-
-# Save default computational region (CR) based on the WOCBA
-gscript.run_command('g.region', flags='s', raster=data['WOCBA_PPH'])
-
-# Compute Population per pixel (ppp) by multiplying population per ha by number
-# of ha in a pixel
-formula = "%s=(%s * area()/10000)" % (data['WOCBA_PPP'][0], data['WOCBA_PPH'])
-gscript.mapcalc(formula, overwrite=True)
-
-# Remove pph raster
-gscript.run_command('g.remove', flags='f', type='raster', name=data['WOCBA_PPH'])
-
-
-# **POPULATION**
-
-# Reproject layer from location in WGS84
-gscript.run_command('r.proj', overwrite=True, location="Worldpop_transform", method='bicubic',
-                    input=data['POP_PPH'], output=data['POP_PPH'],
-                    resolution=config_parameters['resolution'])
-
-# Save default computational region (CR) based on the WOCBA
-gscript.run_command('g.region', raster=data['POP_PPH'])
-
-# Compute Population per pixel (ppp)
-formula = "%s= (%s * area()/10000)" % (data['POP_PPP'][0], data['POP_PPH'])
-gscript.mapcalc(formula, overwrite=True)
-
-# Remove pph raster
-gscript.run_command('g.remove', flags='f', type='raster', name=data['POP_PPH'])
-
-
-# **LULC**
-
-# Reproject layer from location in WGS84
-gscript.run_command('r.proj', overwrite=True, location="Worldpop_transform", method='nearest',
-                    input=data['LULC'][0], output=data['LULC'][0],
-                    resolution=config_parameters['resolution'])
-TMP_rast.append(data['LULC'][0])
-
-
-# **ELEVATION**
-
-# Reproject layer from location in WGS84
-gscript.run_command('r.proj', overwrite=True, location="Worldpop_transform", method='bicubic',
-                    input=data['SRTM'][0], output=data['SRTM'][0],
-                    resolution=config_parameters['resolution'])
-TMP_rast.append(data['SRTM'][0])
-
+# # Stages of the processing chain
 
-# **STREAMS**
+# Each stage is a function receiving the results of the previous stages ('context') and returning
+# its own results. The stages are declared at the end with the stages they require, the
+# configuration values they depend on and their outputs, and run by run_pipeline (see pipeline.py):
+# a completion marker is written in the working directory after each stage, so a run can be
+# resumed (--resume) or a part of the stages run again (--from, --until).
 
-# Reproject layer from location in WGS84
-gscript.run_command('r.proj', overwrite=True, location="Worldpop_transform", method='nearest',
-                    input=data['STREAMS'], output=data['STREAMS'],
-                    resolution=config_parameters['resolution'])
-TMP_rast.append(data['STREAMS']) 
-
-
-# ## Import vector layer (roads) and clip to the extent of the study area
-
-# Install required add-on if not yet installed
-check_install_addon("v.clip")
-
-# **ROADS**
-
-# Create a name for temporary layer
-tmp_layer = gscript.tempname(20)
-# Reproject layer from location in WGS84
-gscript.run_command('v.proj', overwrite=True, location="Worldpop_transform",
-                    input=data['ROADS'][0], output=tmp_layer)
-
-# Clip vector layer
-gscript.run_command('v.clip', overwrite=True, input=tmp_layer, clip="Study_area", output=data['ROADS'][0])
-TMP_vect.append(data['ROADS'][0])
-# Remove temporary layer
-gscript.run_command('g.remove', flags='f', type='vector', name=tmp_layer)
-
-
-# ## Clip rasters to AOI
-
-# Please notice that WOCBA is used as a reference for the following steps (spatial extent and pixel alignement).
-
-# Install required add-on if not yet installed
-check_install_addon("r.clip")
-
-# Define the list with names of raster layers to clip
-raster_to_clip = [data['WOCBA_PPP'][0],data['POP_PPP'][0],data['LULC'][0],data['SRTM'][0],data['STREAMS']]
-print "\n".join(raster_to_clip)
-
-# Define computational region based default region
-gscript.run_command('g.region', flags='d')
-# Define MASK and get a copy
-gscript.run_command('r.mask', overwrite=True, vector='Study_area')
-gscript.run_command('g.copy', overwrite=True, raster='MASK,Study_area')
-# Clip multiple rasters
-clip_multiple_raster(raster_to_clip, overwrite=True, resample=True, n_jobs=config_parameters['njobs'])
-# Rename raster to overwrite the original one
-[gscript.run_command('g.rename', overwrite=True, raster='%s_clip,%s' % (name,name)) for name in raster_to_clip]
-# Remove MASK
-gscript.run_command('r.mask', flags='r')
-
-# Define computational region
-gscript.run_command('g.region', raster=raster_to_clip[0])
-# Define MASK and get a copy
-gscript.run_command('r.mask', overwrite=True, vector='Study_area')
-gscript.run_command('g.copy', overwrite=True, raster='MASK,Study_area')
-
-for rast in raster_to_clip:
-    gscript.run_command('r.clip', flags='r', overwrite=True, input=rast, output='%s_clip'%rast)  # With resampling
-
-# Rename raster to overwrite the original one
-[gscript.run_command('g.rename', overwrite=True, raster='%s_clip,%s' % (name,name)) for name in raster_to_clip]
-# Remove MASK
-gscript.run_command('r.mask', flags='r')
-
-
-# ## Health facilities (HC)
-
-# Create a name for temporary layer
-tmp_layer = gscript.tempname(20)
-# Reproject layer from location in WGS84
-gscript.run_command('v.proj', overwrite=True, location="Worldpop_transform", input=data['HC'][0], output=tmp_layer)
-
-# Select point into study area (create new layer)
-gscript.run_command('v.select', overwrite=True, ainput=tmp_layer, binput="Study_area", output=data['HC'][0], operator="within")
-TMP_vect.append(data['HC'][0])
-
-# Remove temporary layer
-gscript.run_command('g.remove', flags='f', type='vector', name=tmp_layer)
-
-# Create two new sub-layer based on level of HC (HCL1 ; HCL2)
-for hc_level in hc_rules.keys():
-    gscript.run_command('v.extract',
-                        overwrite=True,
-                        input=data['HC'][0],
-                        where="level=%s" % str(hc_level),
-                        output='%sL%s' % (data['HC'][0], str(hc_level)))
-
-# Rename HC layer that contain both levels
-gscript.run_command('g.rename', overwrite=True, vector="%s,%sall" % (data['HC'][0],data['HC'][0]))
-
-
-# ## Convert roads into raster
-
-# Define computational region based default region
-gscript.run_command('g.region', flags='d')
-# Rasterize roads layer
-gscript.run_command('v.to.rast', overwrite=True, input=data['ROADS'][0], output=data['ROADS'][0], use='val')
 
+# # Import data / Preparation of data
 
-# ## Reclassify LULC
+# Both stages are cached (see stage_cache.py): their outputs are restored if the input files, the
+# relevant configuration values and the code of the stage did not change. The stream network only
+# depends on the elevation, the grid and its own parameters, so it is reused when other inputs change.
 
+# File with the health facilities outside of the working region (created by the stage if needed)
+hc_error_file = os.path.join(config_parameters['outputdir'], data['HC'][0] + '_errors.csv')
 
+# Keys of the cached stages, computed when the stage is run or its completion checked (not with --status)
+import_inputs = [data['WOCBA_PPP'][1], data['POP_PPP'][1], data['HC'][1], data['GROUPS'], data['GROUPSETS'],
+                 data['LULC'][1], data['ROADS'][1], data['admin'][1], data['SRTM'][1]]
+import_params = {'data': data, 'hc_rules': hc_rules, 'resolution': config_parameters['resolution'],
+                 'locationepsg': config_parameters['locationepsg']}
+import_key = lazy_stage_key(import_layers, import_inputs, import_params, config_parameters['cachedir'])
+streams_inputs = [data['SRTM'][1], data['admin'][1], rule_file['Recode_streams']]
+streams_params = {'resolution': config_parameters['resolution'], 'locationepsg': config_parameters['locationepsg'],
+                  'options': dict((name, stream_options[name]) for name in ('threshold', 'stream_length', 'grow_radius', 'buffer_size'))}
+streams_key = lazy_stage_key(prepare_streams, streams_inputs, streams_params, config_parameters['cachedir'])
 
+# Layers created by the import
+import_rasters = [data['WOCBA_PPP'][0], data['POP_PPP'][0], data['LULC'][0], data['SRTM'][0], 'Study_area', data['ROADS'][0]]
+import_vectors = ['Study_area', '%sall' % data['HC'][0]] + ['%sL%s' % (data['HC'][0], hc_level) for hc_level in hc_rules.keys()]
 
-for season in ("WS","DS"):
-    # Create a name for temporary layer
-    tmp_layer = gscript.tempname(20) 
-    # Define computational region based default region
-    gscript.run_command('g.region', flags='d')
-    # Reclassify raster
-    gscript.run_command('r.reclass', overwrite=True, input=data['LULC'][0], 
-                        output=tmp_layer, rules=rule_file['ESACCI_%s'%season])
-    # Create hard copy of the reclassified raster
-    formula = "%s_%s=%s" % (data['LULC'][0],season,tmp_layer)
-    gscript.mapcalc(formula, overwrite=True)
-    TMP_rast.append(tmp_layer)
+def data_import(context):
+    """Import the layers (or restore them from the cache) and save the default region"""
+    cached_stage(import_layers, import_key(), config_parameters['cachedir'], rasters=import_rasters,
+                 vectors=import_vectors, files=[hc_error_file], max_size=config_parameters['cache_size'],
+                 use_cache=use_cache)
 
+    # Save default computational region (CR) based on the study area (also when restored from the cache)
+    gscript.run_command('g.region', flags='s', raster='Study_area')
 
-## Print processing time
-print_processing_time(begintime_importdata ,"Data imported in ")
+def streams(context):
+    """Extract the stream network (or restore it from the cache)"""
+    cached_stage(prepare_streams, streams_key(), config_parameters['cachedir'], rasters=[data['STREAMS']],
+                 max_size=config_parameters['cache_size'], use_cache=use_cache)
 
 
 # # Methodology
 
-# Saving current time for processing time management
-begintime_processing=start_processing()
-
 # ## Create velocity rasters
 
-# **LULC**
-
-
-# Create velocity raster
-for season in ("WS","DS"):
-    # Define computational region based default region
-    gscript.run_command('g.region', flags='d')
-    # Reclassify raster
-    gscript.run_command('r.recode', overwrite=True, input="%s_%s" % (data['LULC'][0],season), 
-                        output="velocity_%s_%s" % (data['LULC'][0],season), 
-                        rules=rule_file['Velocity_LULC'])
-
+# The velocity rasters of the four scenarios (with/without car x wet/dry season) are built in one
+# pass (see velocity.py): the velocity is the one of the roads where there are roads; otherwise,
+# for the wet season only, the one of the streams (except on water, class 210); otherwise the one
+# of the land cover, reclassified per season (rules of r.reclass) and converted to velocity
+# (rules of r.recode).
 
-# **ROADS**
-
-# Create velocity raster 
-for car in ("WC","NC"):
+def velocity_rasters(context):
+    """Create the velocity rasters of the scenarios"""
     # Define computational region based default region
     gscript.run_command('g.region', flags='d')
-    # Create velocity raster
-    formula = "velocity_%s_%s = if(%s==1,%s,null())" % (data['ROADS'][0],car,data['ROADS'][0],roads_veloc[car])
-    gscript.mapcalc(formula, overwrite=True)
-
-
-# **STREAMS**
-
-# Create velocity raster 
-# Define computational region based default region
-gscript.run_command('g.region', flags='d')
-# Create velocity raster
-formula = "velocity_%s = if(%s==1,%s,null())" % (data['STREAMS'],data['STREAMS'],streams_veloc["WS"])
-gscript.mapcalc(formula, overwrite=True)
-
-# ## Combine three rasters of velocity together
-
-# Create a list for saving layer name
-veloc_raster = []
-
-# Create all possible combinations
-for season in ("WS","DS"):
-    for car in ("WC","NC"):
-        # Define computational region based default region
-        gscript.run_command('g.region', flags='d')
-        # Create velocity raster
-        veloc_LULC = "velocity_%s_%s" % (data['LULC'][0],season)
-        veloc_ROADS = "velocity_%s_%s" % (data['ROADS'][0],car)
-        veloc_STREAMS = "velocity_%s"%data['STREAMS']
-        veloc_combined = "velocity_%s_%s" % (car,season)
-        if season == "WS":
-            #For the wet season only, streams layer is also used in the final velocity map.
-            formula = "{combi}=if(isnull({vel_roads}),if({lulc}!=210,if(isnull({vel_streams}),{vel_lulc},{vel_streams}),{vel_lulc}),{vel_roads})".format(combi=veloc_combined,vel_roads=veloc_ROADS,lulc=data['LULC'][0],vel_lulc=veloc_LULC,vel_streams=veloc_STREAMS)
-        else:
-            #For the dry season, streams layer is not used.
-            formula = "{combi}=if(isnull({vel_roads}),{vel_lulc},{vel_roads})".format(combi=veloc_combined,vel_roads=veloc_ROADS,vel_lulc=veloc_LULC)
-        gscript.mapcalc(formula, overwrite=True)
-        # Add the combined veloc in list of velocity rasters
-        veloc_raster.append(veloc_combined)
-        # Add individual velocity layers in list of temp files
-        TMP_rast.append(veloc_LULC)
-        TMP_rast.append(veloc_ROADS)    
-        TMP_rast.append(veloc_STREAMS)
-        TMP_rast.append(veloc_combined)
+    # Create the velocity rasters
+    veloc_raster = build_velocity_rasters(data['LULC'][0], data['ROADS'][0], data['STREAMS'],
+                                          {"WS": rule_file['ESACCI_WS'], "DS": rule_file['ESACCI_DS']},
+                                          rule_file['Velocity_LULC'], roads_veloc, streams_veloc, **tile_options)
+    return {'veloc_raster': veloc_raster}
 
 
 # ## Calculate cost distance raster
 
-# The computation of cost distance raster is performed here using [r.cost](https://grass.osgeo.org/grass76/manuals/r.cost.html). For NO CAR scenarios, [r.walk](https://grass.osgeo.org/grass76/manuals/r.walk.html) is used as it takes into account the cost of moving uphill and downhill. 
+# The computation of cost distance raster is performed here using [r.cost](https://grass.osgeo.org/grass76/manuals/r.cost.html). For NO CAR scenarios, the cost of moving uphill and downhill can be taken into account (walking_slope, off by default): the walking time towards the health facilities and the nearest health facility are computed in one pass from the elevation (see cost_engine.py), which [r.walk](https://grass.osgeo.org/grass76/manuals/r.walk.html) can not do as it has no allocation output.
 
-# Possible improvement: parallelize the loops
+# The scenarios are computed in parallel, each one in its own temporary mapset (see parallel_cost.py).
 
+def cost_distance(context):
+    """Compute the cost distance and nearest health facility rasters of all the scenarios"""
+    # Define all the scenarios (velocity raster x health facility level)
+    cost_scenarios_list = cost_scenarios(context['veloc_raster'], ("all","L2"), data['HC'][0])
+    # Compute all cost distance rasters
+    run_cost_scenarios(cost_scenarios_list, n_jobs=config_parameters['njobs'], memory=config_parameters['memory'],
+                       backend=config_parameters['cost_backend'], elevation=data['SRTM'][0],
+                       slope_model=config_parameters['walking_slope'])
+    # Create a list for saving layer name
+    cost_raster = [scenario['output'] for scenario in cost_scenarios_list]
+    nearest_raster = [scenario['nearest'] for scenario in cost_scenarios_list]
+    return {'cost_raster': cost_raster, 'nearest_raster': nearest_raster}
 
-# Create a list for saving layer name
-cost_raster = []
-nearest_raster = []
-# Create all cost distance raster
-for veloc_rast in veloc_raster:
-    for hclevel in ("all","L2"):
-        printlist = []
-        # Determine the car status
-        car = veloc_rast[-5:-3]
-        # Define name of the output layers
-        output_costlayer = "CostDist_HC%s_%s" % (hclevel,veloc_rast[-5:])
-        output_nearestlayer = "Nearest_HC%s_%s" % (hclevel,veloc_rast[-5:])
-        # Define computational region based default region
-        gscript.run_command('g.region', flags='d')
-        # Compute cost distance raster -'k' for Knight's move
-        gscript.run_command('r.cost', flags='k', overwrite=True,
-                            input=veloc_rast, output=output_costlayer, nearest=output_nearestlayer,
-                            start_points="%s%s" % (data['HC'][0],hclevel), memory=config_parameters['memory'])
-        # Add to list of output
-        cost_raster.append(output_costlayer)
-        nearest_raster.append(output_nearestlayer)
-        # Add to temp layers
-        TMP_rast.append(output_costlayer)
-        TMP_rast.append(output_nearestlayer)
-        # Add to printlist
-        printlist.append(output_costlayer)
-        printlist.append(output_nearestlayer)
-
-        print "Layers created: %s"%','.join(printlist)
-
-
-# Possible improvement: For NO CAR scenarios, use r.walk instead of r.cost, as r.walk takes into account the cost of moving uphill and downhill. The code in the cell below outputs the cost distance with r.walk, but it does not output a cost allocation raster based on the nearest starting point (whereas r.cost does it with 'nearest').
-# Create a list for saving layer name
-cost_raster = []
-nearest_raster = []
-# Create all cost distance raster
-for veloc_rast in veloc_raster:
-    for hclevel in ("all","L2"):
-        printlist = []
-        # Determine the car status
-        car = veloc_rast[-5:-3]
-        # Define name of the output layers
-        output_costlayer = "CostDist_HC%s_%s" % (hclevel,veloc_rast[-5:])
-        output_nearestlayer = "Nearest_HC%s_%s" % (hclevel,veloc_rast[-5:])
-        # Define computational region based default region
-        gscript.run_command('g.region', flags='d')
-        # Compute cost distance raster -'k' for Knight's move
-        gscript.run_command('r.cost', flags='k', overwrite=True,
-                            input=veloc_rast, output=output_costlayer, nearest=output_nearestlayer,
-                            start_points="%s%s" % (data['HC'][0],hclevel), memory=config_parameters['memory'])
-        # Add to list of output
-        cost_raster.append(output_costlayer)
-        nearest_raster.append(output_nearestlayer)
-        # Add to temp layers
-        TMP_rast.append(output_costlayer)
-        TMP_rast.append(output_nearestlayer)
-        # Add to printlist
-        printlist.append(output_costlayer)
-        printlist.append(output_nearestlayer)
 
 # ## Calculate isochrones
 
-# Create a list for saving layer name
-isochrone_layers = []
+# The cells of all the cost rasters are classified in the isochrone bands in one r.mapcalc
+# invocation, with a binary search on the time limits (see isochrones.py). The band index rasters
+# (1 for the first band) are used by the zonal statistics.
 
-# Create isochrones rasters
-for cost_rast in cost_raster:
-    # Define name of the output layer
-    output_layer = "Isochrones_%s"%cost_rast[9:]
+def isochrones(context):
+    """Classify the cost rasters in isochrone bands"""
+    cost_raster = context['cost_raster']
+    # Define name of the output layers
+    isochrone_layers = ["Isochrones_%s" % cost_rast[9:] for cost_rast in cost_raster]
+    band_layers = ["Bands_%s" % cost_rast[9:] for cost_rast in cost_raster] if config_parameters['band_index_maps'] else None
     # Define computational region based default region
     gscript.run_command('g.region', flags='d')
-    # Create accessibility raster (time to travel)
-    formula_prefix = "%s="%output_layer
-    formula_suffix = "null()"
-    for time in config_parameters['time_limits']:
-        formula_prefix += "if(%s<=%s,%s," % (cost_rast,time,time)
-        formula_suffix += ")"
-    gscript.mapcalc(formula_prefix+formula_suffix, overwrite=True)
-    print "Layer '%s' created."%output_layer
-    isochrone_layers.append(output_layer)
-    
-# Convert the next cell to code for vectorizing isochrones (requested for statistics of pop. per isochrone)
-# Convert isochrone rasters to vector layers
-for isochrone in isochrone_layers:
-    gscript.run_command('g.region', flags='d')
-    gscript.run_command('r.to.vect', flags='v', overwrite=True,
-                        input=isochrone, output=isochrone, type="area")
-# ## Overlay isochrones with population and calculate population statistics (per isochrone)
+    # Create accessibility rasters (time to travel)
+    isochrone_bands(cost_raster, config_parameters['time_limits'], isochrone_layers, band_layers, **tile_options)
+    print "Layers created: %s" % ','.join(isochrone_layers + (band_layers or []))
+    return {'isochrone_layers': isochrone_layers, 'band_layers': band_layers}
 
 
+# ## Overlay isochrones with population and calculate population statistics (per isochrone)
+
 # Layers to be used for computing statistics (zonal statistics)
 layers_stats = ["POP_PPP","WOCBA_PPP"]
 
-
-# **Get sum for the study area (total population)**
-
-# Initialize a dictionnary for saving total
-TOT={}
-# Compute sum for the whole study area
-for layer in layers_stats:
-    TOT["%s"%layer] = float(gscript.parse_command('r.univar', flags='g', map=layer, zones="Study_area")["sum"])
-#print "Total population of the study area = %s"%TOT["POP_PPP"]
-#print "Total Women of Child-Bearing Age (WOCBA) of the study area = %s"%TOT["WOCBA_PPP"]
-
-
-# **Get sum for each isochrone and compute proportion**
-
-# Convert the next cell to code for calculating statistics of population per isochrones (requires isochrones in vector format).
-# Compute proportions for each isochrone layer
-for isochrone in isochrone_layers:
-    print "Start working on layer '%s'"%isochrone
-    for layer in layers_stats:
-        print "        Working with %s"%layer
-        # Create temp .csv file
-        head, tail = os.path.split(gscript.tempfile())
-        table = 'tmp_table_%s'%tail.replace(".","_")
-        tmp_csv = os.path.join(head,'%s.csv'%table)
-        print "        1"
-        # Compute sum for each isochrone zone
-        gscript.run_command('r.univar', flags='t', overwrite=True, map=layer, 
-                            zones=isochrone, output=tmp_csv, separator="comma")
-        print "        2"
-        # Import .csv and join
-        gscript.run_command('db.in.ogr', overwrite=True, input=tmp_csv, output=table)
-        print "        3"
-        gscript.run_command('v.db.join', map=isochrone, column='cat', 
-                            other_table=table, other_column='zone', subset_columns='sum')
-        gscript.run_command('v.db.renamecolumn', map=isochrone, column='sum,%s_SUM'%layer)
-        print "        4"
-        # Add TOTAL count
-        gscript.run_command('v.db.addcolumn', map=isochrone, columns='%s_TOT double precision'%layer)
-        gscript.run_command('v.db.update', map=isochrone, column='%s_TOT'%layer, value=TOT["%s"%layer])
-        print "        5"
-        # Compute proportion
-        gscript.run_command('v.db.addcolumn', map=isochrone, columns='%s_PROP double precision'%layer)
-        gscript.run_command('v.db.update', map=isochrone, column='%s_PROP'%layer, 
-                            value='({layer}_SUM/{layer}_TOT)*100'.format(layer=layer))
-        print "        6"
-    print "Proportion computed for layer '%s'"%isochrone
-
-
-# # Cross catchment areas with isochrones and calculate population statistics
-
-# Create a list for saving layer names
-cross_layers = []
-
-# Cross catchment areas with isochrones
-for isochrone in isochrone_layers:
-    # Define computational region based default region
-    gscript.run_command('g.region', flags='d')  
-    # Define name of the output layer
-    output_layer = "Cross_%s"%isochrone[11:]
-    #Define name of the catchment area layer
-    nearest_layer = "Nearest_%s"%isochrone[11:]
-    # Cross catchement areas and isochrones
-    gscript.run_command('r.cross', overwrite=True, input=(nearest_layer,isochrone), output=output_layer)
-    print "Layer '%s' created."%output_layer
-    cross_layers.append(output_layer)
-
-
-# Calculate population statistics per health facility per isochrone
-
-
 # Create a folder for storing the output
 outputdir_stats = os.path.join(config_parameters['workingdir'],"Stats")
-# Check and create folder if needed
-check_create_dir(outputdir_stats)
-
-
-# Create a list for saving csv names
-catchpop_csv = []
-# Calculate catchment population statistics per health facility and per isochrone
-for cross in cross_layers:
-     for layer in layers_stats:
-        # Define name of the output csv
-        stats_csv = os.path.join(outputdir_stats,"stats_%s_%s.csv" % (cross,layer))
-        gscript.run_command('r.univar', flags='t', overwrite=True, map=layer, zones=cross, output=stats_csv, separator="comma")
-        catchpop_csv.append(stats_csv)
-
-
-# **Pivot and join to the table of health facilities**
-# If user needs cumulative figures, please use "GetCatchmentCumulPopByISO"
-
-# Import function from script
-from csv_pivotingtable_catchmentpop import GetCatchmentPopByISO, GetCatchmentCumulPopByISO
-
-# Create a list for saving csv names
-pivot_csv = []
-# Extract the relevant fields and pivot to have one line per health facility
-for catchpop in catchpop_csv:
-    # Define name of the output csv
-    path, ext = os.path.splitext(catchpop)
-    pivot = "%s_pivot%s" % (path,ext)
-    # Define colum prefix according to file name
-    stat_prefix = os.path.split(catchpop)[1].split("_")[-2]
-    GetCatchmentPopByISO(catchpop,out_file=pivot,in_sep=',',col_prefix=stat_prefix)
-    pivot_csv.append(pivot)
-
-
-
-# Create a list for saving HC layers
-HC_layers = []
-# Join to the table of health facilities
-for csv in pivot_csv:
-    scenario = "_".join(os.path.split(csv)[1].split("_")[2:-1])
-    HC_level = os.path.split(csv)[1].split("_")[2]
-    pivot_scenario = "pivot_%s"%scenario
-    HC_layers.append(scenario)
-    # Copy HC layer corresponding to current scenario
-    gscript.run_command('g.copy', overwrite=True, vector='%s,%s' % (HC_level,scenario))
-    # Join with health facility csv
-    gscript.run_command('db.in.ogr', overwrite=True, input=csv, output=pivot_scenario)
-    # Join both tables
-    gscript.run_command('v.db.join', map=scenario, column='cat', other_table=pivot_scenario, other_column='HF_cat')
-    # Drop column
-    gscript.run_command('v.db.dropcolumn', map=scenario, columns='HF_cat')
-
-
-# # Export and clean mapset
-
-# **Export output to csv**
-
-if outputs['csv_per_healthfacility']:
-    # Create a folder for storing the csv files, ie. the population per health facility per isochrone
-    outputdir_final = os.path.join(config_parameters['outputdir'],"Pop_per_health_facility")
-    # Check and create folder if needed
-    check_create_dir(outputdir_final)
-    for layer in HC_layers:
-        output_csv = os.path.join(outputdir_final,"%s.csv" % layer)
-        gscript.run_command('v.db.select', overwrite=True, map=layer, separator="comma", file=output_csv)
-
-if outputs['isochrone_maps']:
-    # Output the isochrone maps
-    # # Create a folder for storing the csv files, ie. the population per isochrone
-    outputdir_isochrones = os.path.join(config_parameters['outputdir'],"Isochrone_maps")
-    # Check and create folder if needed
-    check_create_dir(outputdir_isochrones)# Export isochrone layers as GeoPackage and attribute table as .csv
-    for isochrone in isochrone_layers:
-        output_gpkg = os.path.join(outputdir_isochrones,"%s.gpkg" % isochrone)
-        gscript.run_command('v.out.ogr', flags='m', overwrite=True,
-                            input=isochrone, output=output_gpkg, format="GPKG")
 
+# **Get sum for each isochrone and compute proportion**
 
-## Print processing time
-print_processing_time(begintime_processing ,"All processing terminated in ")
+def population_per_isochrone(context):
+    """Compute the population per isochrone band of all the scenarios"""
+    # Check and create folder if needed
+    check_create_dir(outputdir_stats)
+    # The sum, the total of the study area and the proportion are computed directly from the rasters
+    # for all the isochrone layers and population layers in one pass (see zonal_stats.py)
+    isochrone_stats = tiled_isochrone_population_stats(context['isochrone_layers'], layers_stats,
+                                                       config_parameters['time_limits'],
+                                                       band_layers=context['band_layers'], **tile_options)
+    isochrone_stats_csv = {}
+    for isochrone in context['isochrone_layers']:
+        isochrone_stats_csv[isochrone] = os.path.join(outputdir_stats,"stats_%s.csv" % isochrone)
+        write_stats_csv(isochrone_stats[isochrone], isochrone_stats_csv[isochrone])
+        print "Proportion computed for layer '%s'"%isochrone
+    return {'isochrone_stats': isochrone_stats, 'isochrone_stats_csv': isochrone_stats_csv}
+
+
+# # Calculate population statistics per health facility per isochrone
+
+# The catchment areas (nearest health facility) are crossed with the isochrones and the population
+# is summed per health facility and per isochrone band directly from the rasters, for all the
+# scenarios and population layers in one pass (see zonal_stats.py)
+
+def population_per_health_facility(context):
+    """Compute the population per health facility and per isochrone band of all the scenarios"""
+    scenarios = [isochrone[11:] for isochrone in context['isochrone_layers']]
+    facility_stats = tiled_facility_population_stats(["Nearest_%s" % scenario for scenario in scenarios],
+                                                     context['isochrone_layers'], layers_stats,
+                                                     config_parameters['time_limits'],
+                                                     band_layers=context['band_layers'], **tile_options)
+    return {'scenarios': scenarios, 'facility_stats': facility_stats}
+
+
+# # Export
+
+# The population per health facility, per scenario, per population layer and per isochrone band is
+# written in one long-format table, in a single write (see export_results.py). The attributes of
+# the health facilities are read from the json files, not from the attribute tables.
+
+def export(context):
+    """Write the results table and the isochrone maps"""
+    export_files = []
+    if outputs['results_table'] or outputs['results_gpkg']:
+        facilities = facility_attributes(get_units(data['HC'][1]), get_groups(data['GROUPS']),
+                                         get_groupsets(data['GROUPSETS']), hc_rules, vector="%sall" % data['HC'][0])
+        # Categories of the health facilities of each level (points of the start point maps)
+        start_points = dict((hclevel, read_start_points("%s%s" % (data['HC'][0], hclevel))[2]) for hclevel in ("all","L2"))
+        start_stage("Results table")
+        results = results_table(context['facility_stats'], context['scenarios'], layers_stats,
+                                config_parameters['time_limits'], facilities, start_points)
+        end_stage()
+        if outputs['results_table']:
+            results_file = os.path.join(config_parameters['outputdir'], "Pop_per_health_facility.%s" % outputs['results_table'])
+            export_files.append(write_results(results, results_file, outputs['results_table']))
+            print "Results written in '%s'" % results_file
+        if outputs['results_gpkg']:
+            results_gpkg = os.path.join(config_parameters['outputdir'], "Pop_per_health_facility.gpkg")
+            export_files.append(write_results_gpkg(results, facilities, results_gpkg))
+            print "Results written in '%s'" % results_gpkg
+
+    # The isochrones are only vectorized when the isochrone maps are requested, and only for the
+    # requested scenarios: the polygons of each scenario are written by GDAL directly in a GeoPackage
+    # with the statistics of the bands, the scenarios in parallel (see isochrone_maps.py)
+    map_layers = requested_isochrones(context['isochrone_layers'], outputs['isochrone_maps'])
+    if map_layers:
+        start_stage("Isochrone maps")
+        gscript.run_command('g.region', flags='d')
+        outputdir_isochrones = os.path.join(config_parameters['outputdir'],"Isochrone_maps")
+        export_files.extend(write_isochrone_maps(map_layers, outputdir_isochrones,
+                                                 os.path.join(config_parameters['workingdir'], 'polygons'),
+                                                 stats=context['isochrone_stats'],
+                                                 simplify=outputs['isochrone_simplify'],
+                                                 dissolve=outputs['isochrone_dissolve'],
+                                                 n_jobs=config_parameters['njobs']))
+        print "Isochrone maps written in '%s'" % outputdir_isochrones
+        end_stage()
+    return {'export_files': export_files}
+
+
+# # Stage graph
+
+# Each stage declares the stages whose results it uses, the configuration values it depends on (a
+# completed stage is run again if they changed) and its outputs (a completed stage is run again if
+# they were removed)
+stages = [
+    pipeline_stage("Data import", data_import, params=lambda: {'key': import_key()},
+                   rasters=import_rasters, vectors=import_vectors),
+    pipeline_stage("Streams", streams, requires=["Data import"], params=lambda: {'key': streams_key()},
+                   rasters=[data['STREAMS']]),
+    pipeline_stage("Velocity rasters", velocity_rasters, requires=["Data import", "Streams"],
+                   params={'rule_file': rule_file, 'roads_veloc': roads_veloc, 'streams_veloc': streams_veloc},
+                   rasters=lambda results: results['veloc_raster']),
+    pipeline_stage("Cost distance", cost_distance, requires=["Data import", "Velocity rasters"],
+                   params={'backend': config_parameters['cost_backend'], 'walking_slope': config_parameters['walking_slope']},
+                   rasters=lambda results: results['cost_raster'] + results['nearest_raster']),
+    pipeline_stage("Isochrones", isochrones, requires=["Cost distance"],
+                   params={'time_limits': config_parameters['time_limits'], 'band_index_maps': config_parameters['band_index_maps']},
+                   rasters=lambda results: results['isochrone_layers'] + (results['band_layers'] or [])),
+    pipeline_stage("Population per isochrone", population_per_isochrone, requires=["Data import", "Isochrones"],
+                   params={'layers_stats': layers_stats},
+                   files=lambda results: results['isochrone_stats_csv'].values()),
+    pipeline_stage("Population per health facility", population_per_health_facility,
+                   requires=["Data import", "Cost distance", "Isochrones"], params={'layers_stats': layers_stats}),
+    pipeline_stage("Export", export, requires=["Isochrones", "Population per isochrone", "Population per health facility"],
+                   params=dict((name, value) for name, value in outputs.items() if name != 'keep_temporary_files'),
+                   files=lambda results: results['export_files']),
+]
+
+# Print the stages completed by the previous runs
+if args.status:
+    for name, completed in pipeline_status(stages, statedir):
+        print "%-32s %s" % (name, "completed on %s" % completed if completed else "not completed")
+    sys.exit(0)
+
+# Record the timings and resources of every stage and GRASS GIS command (see profiling.py)
+start_profiling(config_parameters['outputdir'], config_parameters['gisdb'])
+
+# Run the stages (all of them, the incomplete ones with --resume, or the stages from --from until --until),
+# memorizing the region in the session and skipping the redundant region resets (see grass_commands.py)
+with command_session():
+    run_pipeline(stages, statedir, resume=args.resume, first=args.first, last=args.last)
+
+# End of the processing, write the profiling trace in the output folder
+session_report()
+stop_profiling()
 
 # CLEANUP
-if not outputs['keep_temporary_files']:
-    # Delete the temporary working directory
+# The working directory is kept until the last stage is completed, so the run can be resumed
+if not outputs['keep_temporary_files'] and not (args.last and stage_index(stages, args.last) < len(stages) - 1):
+    # Delete the working directory
     import shutil
     shutil.rmtree(config_parameters['workingdir'])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Run the processing chain for several countries concurrently
+
+# Each country is described by its own configuration file (a copy of LIBS/config.py with the paths,
+# EPSG code, outputdir, njobs and memory of the country) and is run in a separate process with its
+# own GRASSDATA and GISRC file (see LIBS/batch.py). Extra options are passed to the processing chain,
+# ex: python SheDecides_batch.py configs/*.py --cores 32 --memory 120000 --no-cache
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+# Add folder with python libs to path
+script_path = os.path.dirname(os.path.realpath(__file__))
+src = os.path.join(script_path, 'LIBS')
+if src not in sys.path:
+    sys.path.append(src)
+
+from batch import country_jobs, run_batch, write_summary
+from profiling import format_duration
+
+# Processing chain script (copied as shedecides.py in the image)
+CHAIN = os.path.join(script_path, 'SheDecides_Python_chain.py')
+if not os.path.exists(CHAIN):
+    CHAIN = os.path.join(script_path, 'shedecides.py')
+
+def available_memory():
+    """Return the available memory in MB (from /proc/meminfo)"""
+    with open('/proc/meminfo', 'r') as fin:
+        for line in fin:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    return 8000
+
+parser = argparse.ArgumentParser(description="Accessibility to health facilities, for several countries")
+parser.add_argument('configs', nargs='+', help="configuration files of the countries")
+parser.add_argument('--cores', type=int, default=multiprocessing.cpu_count(), help="number of cores for all the countries")
+parser.add_argument('--memory', type=int, default=available_memory(), help="memory (MB) for all the countries")
+parser.add_argument('--summary', default='batch_summary.json', help="json file with the summary of the run (and a .csv)")
+parser.add_argument('--chain', default=CHAIN, help="processing chain script")
+args, chain_args = parser.parse_known_args()
+if not os.path.isfile(args.chain):
+    parser.error("processing chain script '%s' not found (see --chain)" % args.chain)
+
+# Saving current time for processing time management
+begintime_batch = time.time()
+
+# Define the countries, biggest first
+jobs = country_jobs(args.configs, args.cores, args.memory)
+# Run all the countries within the budget of cores and memory
+run_batch(jobs, args.chain, args.cores, args.memory, chain_args)
+# Write the summary of timings and outputs
+write_summary(jobs, args.summary)
+print "Summary written in '%s'" % args.summary
+
+## Print processing time
+print "Batch processing terminated in %s" % format_duration(time.time() - begintime_batch)
+
+# Exit with an error if a country failed
+sys.exit(1 if [job for job in jobs if job['returncode'] != 0] else 0)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# What-if analysis: population per health facility when health facilities are added or removed
+
+# This script reuses the GRASS GIS database of a previous run of the processing chain (run with
+# outputs['keep_temporary_files'] = True, or with a --gisdb outside of the temporary working dir)
+# and updates the cost distance and the population per health facility of each candidate
+# configuration incrementally (see LIBS/whatif.py), without recomputing the whole chain.
+#
+# The candidates are read from a json file with a list of configurations, ex:
+# [{"name": "new_hc_kolda", "add": [{"x": 412350, "y": 1423870, "level": 2}], "remove": [12, 57]}]
+# The coordinates are in the CRS of the projected location. The categories of the new health
+# facilities are the next free ones (after the largest category of the existing ones), unless
+# given with "cat". New facilities are added to the scenarios of their level and to the 'all' scenarios.
+
+# Import libraries needed for setting parameters of operating system
+import os
+import sys
+import json
+import argparse
+
+# Add folder with python libs to path
+script_path = os.path.dirname(os.path.realpath(__file__))
+src = os.path.join(script_path, 'LIBS')
+if src not in sys.path:
+    sys.path.append(src)
+
+# Import configuration parameters
+from config import config_parameters, data
+
+# Import functions that setup the environmental variables
+import environ_variables as envi
+
+# Set environmental variables
+envi.setup_environmental_variables()
+
+# Import libraries needed to launch GRASS GIS and to call GRASS using Python
+import grass.script.setup as gsetup
+import grass.script as gscript
+
+import numpy as np
+
+# Import other local libraries
+from mkdir import check_create_dir
+from profiling import start_profiling, start_stage, end_stage, stop_profiling
+from grass_commands import command_session, session_report
+from parallel_cost import cost_scenarios
+from cost_engine import read_start_points
+from raster_io import read_raster
+from zonal_stats import facility_population_stats
+from whatif import add_facilities, remove_facilities, restore, update_facility_stats
+from csv_pivotingtable_catchmentpop import GetCatchmentPopByISO
+
+# Parse command line options
+parser = argparse.ArgumentParser(description="What-if analysis of the accessibility to health facilities")
+parser.add_argument('candidates', help="json file with the list of candidate configurations")
+parser.add_argument('--gisdb', default=config_parameters['gisdb'], help="GRASSDATA folder of a previous run")
+parser.add_argument('--location', default=config_parameters['location'], help="projected location of a previous run")
+parser.add_argument('--mapset', default=config_parameters['mapset'], help="mapset with the outputs of a previous run")
+parser.add_argument('--levels', default="all,L2", help="health facility levels of the scenarios (comma separated)")
+parser.add_argument('--outputdir', default=os.path.join(config_parameters['outputdir'], "Whatif"),
+                    help="folder for the pivot tables of the candidates")
+args = parser.parse_args()
+
+with open(args.candidates, 'r') as fin:
+    candidates = json.load(fin)
+
+# Record the timings and resources of every scenario and GRASS GIS command (see profiling.py)
+start_profiling(args.outputdir, args.gisdb)
+
+# Start a GRASS GIS session in the mapset of the previous run
+check_create_dir(config_parameters['workingdir'])
+gisrc = gsetup.init(config_parameters['GISBASE'], args.gisdb, args.location, args.mapset)
+gscript.run_command('g.region', flags='d')
+region = gscript.region()
+
+# Define the scenarios of the previous run (velocity raster x health facility level)
+veloc_raster = ["velocity_%s_%s" % (car,season) for car in ("WC","NC") for season in ("DS","WS")]
+scenarios = cost_scenarios(veloc_raster, args.levels.split(','), data['HC'][0])
+isochrone_layers = ["Isochrones_%s" % scenario['name'] for scenario in scenarios]
+layers_stats = ["POP_PPP","WOCBA_PPP"]
+
+# Population per health facility of the current configuration (computed once for all the candidates)
+base_stats = facility_population_stats([scenario['nearest'] for scenario in scenarios], isochrone_layers,
+                                       layers_stats, config_parameters['time_limits'])
+pops = dict((layer, read_raster(layer)) for layer in layers_stats)
+# Elevation of the walking cost of the no car scenarios (see cost_engine.py)
+elevation = read_raster(data['SRTM'][0]) if config_parameters['walking_slope'] else None
+
+# Categories of the existing health facilities
+next_cat = max(read_start_points("%sall" % data['HC'][0])[2]) + 1
+
+# Define the row, column, category and level of the added health facilities of each candidate
+for candidate in candidates:
+    for facility in candidate.get('add', []):
+        facility['row'] = int((region['n'] - facility['y'])/region['nsres'])
+        facility['col'] = int((facility['x'] - region['w'])/region['ewres'])
+        if not (0 <= facility['row'] < region['rows'] and 0 <= facility['col'] < region['cols']):
+            raise ValueError("Health facility (%s, %s) of '%s' is outside of the region" % (facility['x'],facility['y'],candidate['name']))
+        if 'cat' not in facility:
+            facility['cat'] = next_cat
+            next_cat += 1
+
+# Memorize the region in the session and skip the redundant region resets (see grass_commands.py)
+with command_session():
+    for scenario, stats in zip(scenarios, base_stats):
+        start_stage("Scenario %s" % scenario['name'])
+        hclevel = scenario['start_points'][len(data['HC'][0]):]
+        friction = read_raster(scenario['input'])
+        # The cost and nearest rasters are updated in memory (copy-on-write)
+        cost = read_raster(scenario['output'], writable=True)
+        nearest = read_raster(scenario['nearest'], np.int32, writable=True)
+        walking = {'elevation': elevation if scenario['car'] == 'NC' else None,
+                   'slope_model': config_parameters['walking_slope']}
+        for candidate in candidates:
+            removed = candidate.get('remove', [])
+            added = [f for f in candidate.get('add', []) if hclevel == 'all' or hclevel == "L%s" % f.get('level')]
+            # Update the cost distance and the nearest health facility
+            changes = remove_facilities(friction, cost, nearest, removed, region['nsres'], region['ewres'], **walking)
+            if added:
+                add_facilities(friction, cost, nearest, [f['row'] for f in added], [f['col'] for f in added],
+                               [f['cat'] for f in added], region['nsres'], region['ewres'], changes=changes, **walking)
+            candidate_stats = update_facility_stats(stats, pops, cost, nearest, changes,
+                                                    config_parameters['time_limits'], removed)
+            # Export the pivot tables of the candidate (one csv per scenario and population layer)
+            outputdir_candidate = os.path.join(args.outputdir, candidate['name'])
+            check_create_dir(outputdir_candidate)
+            for layer in layers_stats:
+                pivot = os.path.join(outputdir_candidate, "stats_Cross_%s_%s_pivot.csv" % (scenario['name'],layer))
+                GetCatchmentPopByISO(candidate_stats[layer],out_file=pivot,out_sep=',',col_prefix=layer.split("_")[0])
+            print "Candidate '%s' done (%s modified windows)" % (candidate['name'], len(changes))
+            # Go back to the current configuration for the next candidate
+            restore(cost, nearest, changes)
+        end_stage()
+
+# Write the profiling trace in the output folder
+session_report()
+stop_profiling()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the stages of the processing chain on synthetic countries.
+
+The input layers of a synthetic country are generated (see synthetic_country.py, only once per
+size), the whole chain is run on them without the stage cache, and the wall time of each stage is
+read from the profile of the run (profile.jsonl, see LIBS/profiling.py). The import, reprojection
+and clipping of the layers are one step of the chain (the rasters are warped and clipped to the
+grid of the study area at once), timed as the 'Study area', 'Reprojection and clip' and 'Health
+facilities' stages of the 'Data import'; the pivot of the results is the 'Results table' stage of
+the 'Export'.
+
+The times are compared with the baselines stored in a json file for the same size: the run fails
+if a stage is slower than its baseline by more than the tolerance (relative, plus a few seconds
+for the short stages). The baselines depend on the machine: store them with --update-baseline
+(on an idle machine) before using the benchmark to detect regressions.
+
+Presets: small (10^6 cells, 100 facilities), medium (10^7, 1000), large (10^8, 10000) and
+xlarge (10^9, 50000). Everything runs offline.
+
+Usage: python bench_chain.py [--preset small] [--cells 1e6 --facilities 100] [--runs 1]
+                             [--baseline baselines.json] [--update-baseline] [--tolerance 0.25]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import multiprocessing
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_path, '..', 'LIBS'))
+from profiling import read_events, format_duration
+from synthetic_country import country_model, generate_country, write_config
+
+# Processing chain script (copied as shedecides.py in the image)
+CHAIN = os.path.join(script_path, '..', 'SheDecides_Python_chain.py')
+if not os.path.exists(CHAIN):
+    CHAIN = os.path.join(script_path, '..', 'shedecides.py')
+PRESETS = {'small': (1e6, 100), 'medium': (1e7, 1000), 'large': (1e8, 10000), 'xlarge': (1e9, 50000)}
+# Stages of the chain, in the order of the report (stages of the run with other names are reported after)
+STAGES = ['Data import', 'Study area', 'Reprojection and clip', 'Health facilities', 'Streams',
+          'Velocity rasters', 'Cost distance', 'Isochrones', 'Population per isochrone',
+          'Population per health facility', 'Export', 'Results table', 'Isochrone maps']
+
+
+def run_chain(chain_script, config_file, outputdir, njobs=None, memory=None):
+    """Run the processing chain on a configuration without the stage cache, return the wall time
+    of each stage (dictionary name -> seconds)"""
+    if os.path.exists(outputdir):
+        shutil.rmtree(outputdir)
+    os.makedirs(outputdir)
+    env = dict(os.environ)
+    env['SHEDECIDES_CONFIG'] = config_file
+    if njobs:
+        env['SHEDECIDES_NJOBS'] = str(njobs)
+    if memory:
+        env['SHEDECIDES_MEMORY'] = str(memory)
+    log_file = os.path.join(outputdir, 'shedecides.log')
+    with open(log_file, 'w') as log:
+        returncode = subprocess.call([sys.executable, chain_script, '--no-cache'], env=env,
+                                     stdout=log, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        sys.exit("ERROR: the processing chain failed (return code %s), see '%s'" % (returncode, log_file))
+    events = read_events(os.path.join(outputdir, 'profile.jsonl'))
+    return dict((event['name'], event['wall']) for event in events if event['type'] == 'stage')
+
+def compare(stages, baseline, tolerance, slack):
+    """Return the report lines and the list of the stages slower than their baseline"""
+    names = [name for name in STAGES if name in stages or name in baseline]
+    names += sorted(name for name in set(stages) | set(baseline) if name not in names)
+    lines = ["%-32s %10s %10s %7s" % ('Stage', 'Time (s)', 'Base (s)', 'Ratio')]
+    regressions = []
+    for name in names:
+        if name not in stages:
+            lines.append("%-32s %10s %10.1f %7s  (missing in the run)" % (name, '-', baseline[name], '-'))
+            continue
+        if name not in baseline:
+            lines.append("%-32s %10.1f %10s %7s" % (name, stages[name], '-', '-'))
+            continue
+        ratio = stages[name]/baseline[name] if baseline[name] > 0 else float('inf')
+        slower = stages[name] > baseline[name]*(1 + tolerance) + slack
+        lines.append("%-32s %10.1f %10.1f %7.2f%s" % (name, stages[name], baseline[name], ratio,
+                                                       '  REGRESSION' if slower else ''))
+        if slower:
+            regressions.append(name)
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small', help="size of the synthetic country")
+    parser.add_argument('--cells', type=float, help="number of cells of the 3 arc-seconds rasters (instead of the preset)")
+    parser.add_argument('--facilities', type=int, help="number of health facilities (instead of the preset)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic country")
+    parser.add_argument('--resolution', type=int, default=100, help="resolution of the analysis (m)")
+    parser.add_argument('--isochrone-maps', action='store_true', help="also vectorize and export the isochrone maps")
+    parser.add_argument('--workdir', default='/tmp/SHE_DECIDES_BENCH', help="folder of the synthetic data and of the outputs")
+    parser.add_argument('--runs', type=int, default=1, help="number of runs (the fastest time of each stage is kept)")
+    parser.add_argument('--njobs', type=int, help="cores used by the chain (default: 'njobs' of LIBS/config.py)")
+    parser.add_argument('--memory', type=int, help="memory (MB) used by the chain (default: 'memory' of LIBS/config.py)")
+    parser.add_argument('--chain', default=CHAIN, help="processing chain script")
+    parser.add_argument('--baseline', default=os.path.join(script_path, 'baselines.json'), help="json file of the baselines")
+    parser.add_argument('--update-baseline', action='store_true', help="store the times of this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="accepted relative slowdown of a stage")
+    parser.add_argument('--slack', type=float, default=5.0, help="accepted absolute slowdown of a stage (s)")
+    args = parser.parse_args()
+
+    cells, facilities = PRESETS[args.preset]
+    cells = args.cells or cells
+    facilities = args.facilities or facilities
+    size_name = "%dcells_%dhf_%dm" % (cells, facilities, args.resolution)
+    datadir = os.path.join(args.workdir, 'data', "%dcells_%dhf_seed%d" % (cells, facilities, args.seed))
+    outputdir = os.path.join(args.workdir, 'output', size_name)
+
+    # Generate the synthetic country (skipped if it exists with the same parameters)
+    begin = time.time()
+    generate_country(datadir, cells, facilities, args.seed)
+    print "Synthetic country (%d cells, %d health facilities) ready in %s" % (cells, facilities, format_duration(time.time() - begin))
+    config_file = os.path.join(args.workdir, "config_%s.py" % size_name)
+    write_config(country_model(cells, facilities, args.seed), datadir, config_file, outputdir,
+                 os.path.join(args.workdir, 'cache'), args.resolution, args.isochrone_maps)
+
+    # Run the chain, keep the fastest time of each stage
+    stages = {}
+    for run in range(args.runs):
+        begin = time.time()
+        run_stages = run_chain(args.chain, config_file, outputdir, args.njobs, args.memory)
+        print "Run %d terminated in %s" % (run+1, format_duration(time.time() - begin))
+        for name, wall in run_stages.items():
+            stages[name] = min(wall, stages.get(name, wall))
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as fin:
+            baselines = json.load(fin)
+    if args.update_baseline:
+        baselines[size_name] = {'stages': stages, 'cells': int(cells), 'facilities': facilities,
+                                'resolution': args.resolution, 'njobs': args.njobs, 'machine': platform.node(),
+                                'cpu_count': multiprocessing.cpu_count(), 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(args.baseline, 'w') as fout:
+            json.dump(baselines, fout, indent=2, sort_keys=True)
+        print "Baseline of '%s' written in '%s'" % (size_name, args.baseline)
+
+    baseline = baselines.get(size_name)
+    lines, regressions = compare(stages, baseline['stages'] if baseline else {}, args.tolerance, args.slack)
+    print '\n'.join(lines)
+    if baseline is None:
+        print "No baseline for '%s' in '%s' (use --update-baseline to store one)" % (size_name, args.baseline)
+    elif baseline.get('machine') != platform.node() or baseline.get('njobs') != args.njobs:
+        print "Warning: the baseline was measured on '%s' with njobs=%s" % (baseline.get('machine'), baseline.get('njobs'))
+    if regressions:
+        sys.exit("ERROR: stages slower than the baseline (tolerance %d %% + %s s): %s" % (
+            args.tolerance*100, args.slack, ', '.join(regressions)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark of the pivot functions of csv_pivotingtable_catchmentpop.
+
+Synthetic 'r.univar -t' outputs (on a r.cross map of health facilities x isochrones) are generated
+for several numbers of health facilities. The vectorized functions are timed and their csv outputs
+are compared with the ones of the previous row-wise implementation (kept below as reference).
+
+Usage: python bench_pivot.py [--sizes 1000,10000,100000] [--legacy-max 10000]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import filecmp
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'LIBS'))
+from csv_pivotingtable_catchmentpop import GetCatchmentPopByISO, GetCatchmentCumulPopByISO
+
+TIME_LIMITS = (30, 60, 120, 240, 360, 480, 9999999)
+
+
+def legacy_GetCatchmentCumulPopByISO(in_file, in_sep=';', out_file='', out_sep='', col_prefix="ISO"):
+    """Reference (row-wise) implementation of GetCatchmentCumulPopByISO"""
+    df = pd.read_csv(in_file, sep=in_sep)
+    df['HF_cat'] = df.apply (lambda row: int(row['label'].split(';')[0].split(" ")[-1]), axis=1)
+    df['ISO_cat'] = df.apply (lambda row: int(row['label'].split(';')[1].split(" ")[-1]), axis=1)
+    df = df[['HF_cat','ISO_cat','sum']]
+    df.sort_values(['HF_cat','ISO_cat'],inplace=True)
+    cumul_by_HF = pd.Series([])
+    list_of_HF = list(set(df['HF_cat'].values))
+    for HF in list_of_HF:
+        df_HF = df.loc[df['HF_cat'] == HF]
+        a = df_HF['sum'].cumsum(axis=0)
+        cumul_by_HF = cumul_by_HF.add(a, fill_value=0)
+    df['cumul_sum'] = cumul_by_HF
+    df_pivot = pd.pivot_table(df, values='cumul_sum', index='HF_cat', columns='ISO_cat', aggfunc=np.min, fill_value=0)
+    df_pivot.rename(columns=lambda x: '%s_%s'%(col_prefix,x), inplace=True)
+    ISO_column_name = [ x for x in list(df_pivot)]
+    df_pivot['%s_TOT'%col_prefix] = df_pivot.iloc[:,-1]
+    ISO_column_name.append('%s_TOT'%col_prefix)
+    for name in ISO_column_name:
+        iso_value = name[len(col_prefix)+1:]
+        df_pivot['%s_prct%s'%(col_prefix,iso_value)] = (df_pivot['%s'%name]/df_pivot['%s_TOT'%col_prefix])*100
+    df_pivot.to_csv(out_file, sep=out_sep or in_sep)
+
+def legacy_GetCatchmentPopByISO(in_file, in_sep=';', out_file='', out_sep='', col_prefix="ISO"):
+    """Reference (row-wise) implementation of GetCatchmentPopByISO"""
+    df = pd.read_csv(in_file, sep=in_sep)
+    df['HF_cat'] = df.apply (lambda row: int(row['label'].split(';')[0].split(" ")[-1]), axis=1)
+    df['ISO_cat'] = df.apply (lambda row: int(row['label'].split(';')[1].split(" ")[-1]), axis=1)
+    df = df[['HF_cat','ISO_cat','sum']]
+    df.sort_values(['HF_cat','ISO_cat'],inplace=True)
+    df_pivot = pd.pivot_table(df, values='sum', index='HF_cat', columns='ISO_cat', aggfunc=np.min, fill_value=0)
+    df_pivot.rename(columns=lambda x: '%s_%s'%(col_prefix,x), inplace=True)
+    ISO_column_name = [ x for x in list(df_pivot)]
+    df_pivot['%s_TOT'%col_prefix] = sum([df_pivot['%s'%name] for name in ISO_column_name])
+    ISO_column_name.append('%s_TOT'%col_prefix)
+    for name in ISO_column_name:
+        iso_value = name[len(col_prefix)+1:]
+        df_pivot['%s_prct%s'%(col_prefix,iso_value)] = (df_pivot['%s'%name]/df_pivot['%s_TOT'%col_prefix])*100
+    df_pivot.to_csv(out_file, sep=out_sep or in_sep)
+
+def synthetic_univar_csv(path, nb_facilities, seed=0):
+    """Write a csv similar to the output of 'r.univar -t' on a r.cross map of facilities x isochrones"""
+    rng = np.random.RandomState(seed)
+    hf = np.repeat(np.arange(1, nb_facilities+1), len(TIME_LIMITS))
+    iso = np.tile(TIME_LIMITS, nb_facilities)
+    # Not all the facilities reach all the isochrones
+    keep = rng.rand(len(hf)) > 0.1
+    hf, iso = hf[keep], iso[keep]
+    order = rng.permutation(len(hf))
+    hf, iso = hf[order], iso[order]
+    df = pd.DataFrame({'zone': np.arange(len(hf)),
+                       'label': ["category %d; category %d" % (h, i) for h, i in zip(hf, iso)],
+                       'non_null_cells': rng.randint(1, 1000, len(hf)),
+                       'sum': np.round(rng.gamma(2.0, 500.0, len(hf)), 6)})
+    df[['zone','label','non_null_cells','sum']].to_csv(path, sep=',', index=False)
+
+def timed(function, *args, **kwargs):
+    """Return the time (in seconds) used by a function call"""
+    begin = time.time()
+    function(*args, **kwargs)
+    return time.time() - begin
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000', help="Numbers of health facilities")
+    parser.add_argument('--legacy-max', type=int, default=10000,
+                        help="Largest size for which the reference implementation is run and compared")
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    failed = False
+    try:
+        print "%10s %16s %10s %10s %10s %s" % ('facilities', 'function', 'new (s)', 'legacy (s)', 'speedup', 'identical')
+        for size in [int(x) for x in args.sizes.split(',')]:
+            in_csv = os.path.join(tmpdir, 'stats_%s.csv' % size)
+            synthetic_univar_csv(in_csv, size)
+            for new, legacy in ((GetCatchmentPopByISO, legacy_GetCatchmentPopByISO),
+                                (GetCatchmentCumulPopByISO, legacy_GetCatchmentCumulPopByISO)):
+                new_csv = os.path.join(tmpdir, 'new.csv')
+                legacy_csv = os.path.join(tmpdir, 'legacy.csv')
+                t_new = timed(new, in_csv, in_sep=',', out_file=new_csv, col_prefix='POP')
+                if size <= args.legacy_max:
+                    t_legacy = timed(legacy, in_csv, in_sep=',', out_file=legacy_csv, col_prefix='POP')
+                    identical = filecmp.cmp(new_csv, legacy_csv, shallow=False)
+                    failed = failed or not identical
+                    print "%10d %16s %10.3f %10.3f %10.1f %s" % (size, new.__name__[len("GetCatchment"):], t_new, t_legacy, t_legacy/t_new, identical)
+                else:
+                    print "%10d %16s %10.3f %10s %10s %s" % (size, new.__name__[len("GetCatchment"):], t_new, '-', '-', 'not checked')
+    finally:
+        shutil.rmtree(tmpdir)
+    if failed:
+        sys.exit("ERROR: the outputs differ from the reference implementation")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+
+"""
+Generator of synthetic countries for the benchmarks of the processing chain.
+
+All the input layers of the chain are generated offline, in the formats and folder layout of the
+demonstration data (see LIBS/config.py):
+- Elevation/srtm.tif: SRTM-like elevation (Int16, 3 arc-seconds, EPSG:4326);
+- LandCover/esacci.tif: ESA-CCI-like land cover classes (Byte, 10 arc-seconds);
+- Population/ppp_POP.tif and ppp_WOCBA.tif: WorldPop-like people per pixel (Float32, 3 arc-seconds);
+- Roads/OSM/osm_roads.shp: OSM-like roads with a 'highway' attribute (also classes filtered out);
+- Admin/study_area.shp: the study area polygon;
+- Health/*.json: DHIS2-like metadata of the health facilities, groups and group sets (a few
+  facilities are outside of the study area, without coordinates or without group);
+- the rules files (land cover to seasonal classes, seasonal classes to velocity, streams);
+and a configuration file of the chain using them (see write_config).
+
+The size of the country is given by the number of cells of the 3 arc-seconds rasters (ex: 10^6 to
+10^9) and the number of health facilities (ex: 100 to 50000). The layers only depend on the sizes
+and the seed. The rasters are generated and written by blocks of rows, so large countries do not
+need more memory than small ones: the terrain, the moisture and the towns are smooth fields defined
+on normalized coordinates (0 to 1) and evaluated for each block.
+
+Usage: python synthetic_country.py DATADIR [--cells 1000000] [--facilities 1000] [--seed 0]
+"""
+
+import os
+import json
+import math
+import string
+import argparse
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+# Resolution of the elevation and population rasters (3 arc-seconds), and of the land cover (10 arc-seconds)
+RESOLUTION = 1/1200.
+LULC_RESOLUTION = 1/360.
+# Rows of the blocks written at once
+BLOCK_ROWS = 512
+# Creation options of the GeoTIFF files
+GTIFF_OPTIONS = ['TILED=YES', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+# Ids of the groups used by the default rules of the health facilities levels (see config.py)
+LEVEL_GROUPS = {1: [('elD2xyvPUxh', 'Hospital')], 2: [('Wx1Z05p1qwW', 'Health centre'), ('QDZvyQQZZN5', 'Health post')]}
+# OSM classes of the roads: (highway, share of the roads); the last ones are filtered out by the chain
+ROAD_CLASSES = [('trunk', 0.05), ('primary', 0.1), ('secondary', 0.15), ('tertiary', 0.2),
+                ('residential', 0.3), ('track', 0.2)]
+
+# Rules files of the chain: land cover classes to seasonal classes (r.reclass) for each season,
+# seasonal classes to the time to cross a 100 m cell in minutes (r.recode) and streams to 1 (r.recode)
+RECLASS_RULES = {'WS': """10 11 12 20 30 40 = 1 cropland (flooded)
+50 thru 100 = 2 forest
+110 120 121 122 130 140 = 3 shrubland and grassland
+150 thru 153 200 201 202 = 4 sparse and bare
+160 170 180 = 5 flooded vegetation
+190 = 6 urban
+210 = 7 water
+220 = 4 snow
+end
+""",
+                 'DS': """10 11 12 20 30 40 = 8 cropland
+50 thru 100 = 2 forest
+110 120 121 122 130 140 = 3 shrubland and grassland
+150 thru 153 200 201 202 = 4 sparse and bare
+160 170 180 = 9 flooded vegetation (dry)
+190 = 6 urban
+210 = 7 water
+220 = 4 snow
+end
+"""}
+VELOCITY_RULES = """1:1:2.4
+2:2:3.0
+3:3:1.7
+4:4:1.5
+5:5:6.0
+6:6:1.2
+7:7:60.0
+8:8:1.5
+9:9:2.5
+"""
+STREAMS_RULES = "1:2147483647:1\n"
+
+
+def country_model(cells, facilities, seed=0, center=(-14.5, 14.5)):
+    """Return the model of a synthetic country: grid of the 3 arc-seconds rasters (square, about
+    'cells' cells, centred on 'center' (longitude, latitude)), smooth fields and towns"""
+    rng = np.random.RandomState(seed)
+    side = int(round(math.sqrt(cells)))
+    size = side*RESOLUTION
+    west = round((center[0] - size/2.)/LULC_RESOLUTION)*LULC_RESOLUTION
+    north = round((center[1] + size/2.)/LULC_RESOLUTION)*LULC_RESOLUTION
+    model = {'seed': seed, 'rows': side, 'cols': side, 'facilities': facilities,
+             'bounds': (west, north - size, west + size, north)}
+    # Octaves of value noise (coarse grids interpolated on the fine grid), from broad to detailed
+    model['terrain'] = [(rng.rand(n, n), 0.5**i) for i, n in enumerate((4, 9, 33, 129, 513))]
+    model['moisture'] = [(rng.rand(n, n), 0.5**i) for i, n in enumerate((5, 17, 65, 257))]
+    # Towns: position and spread (3 to 15 pixels) in normalized coordinates, and population (people
+    # per pixel at the centre)
+    nb_towns = int(min(2000, 20 + math.sqrt(facilities)*3 + cells/5e6))
+    model['towns'] = {'y': rng.uniform(0.08, 0.92, nb_towns), 'x': rng.uniform(0.08, 0.92, nb_towns),
+                      'sigma': rng.uniform(3, 15, nb_towns)/side, 'peak': 50*rng.pareto(1.5, nb_towns) + 10}
+    # Irregular outline of the study area (radius as a function of the angle, normalized)
+    model['outline'] = {'phase': rng.uniform(0, 2*math.pi, 3), 'amplitude': (0.08, 0.05, 0.03)}
+    return model
+
+def _normalized(count, start, nb):
+    """Return the normalized coordinates (0 to 1) of the centres of 'nb' cells from 'start'"""
+    return (np.arange(start, start+nb) + 0.5)/count
+
+def _interpolate(grid, ys, xs):
+    """Bilinear (smoothed) interpolation of a coarse grid at normalized coordinates (rows ys x columns xs)"""
+    n, m = grid.shape
+    y, x = ys*(n-1), xs*(m-1)
+    y0, x0 = np.minimum(y.astype(np.int64), n-2), np.minimum(x.astype(np.int64), m-2)
+    fy, fx = y - y0, x - x0
+    # Smoothstep, so the slopes are continuous between the coarse cells
+    fy, fx = (fy*fy*(3 - 2*fy))[:, np.newaxis], (fx*fx*(3 - 2*fx))[np.newaxis, :]
+    top = grid[y0][:, x0]*(1 - fx) + grid[y0][:, x0+1]*fx
+    bottom = grid[y0+1][:, x0]*(1 - fx) + grid[y0+1][:, x0+1]*fx
+    return top*(1 - fy) + bottom*fy
+
+def field(octaves, ys, xs):
+    """Return a smooth field (0 to 1) at normalized coordinates, as the sum of octaves of value noise"""
+    values = sum(_interpolate(grid, ys, xs)*amplitude for grid, amplitude in octaves)
+    return values/sum(amplitude for grid, amplitude in octaves)
+
+def town_density(towns, ys, xs):
+    """Return the population of the towns (people per 3 arc-seconds pixel) at normalized coordinates.
+
+    Each town is a Gaussian, only evaluated on the cells within 4 spreads of its centre ('ys' and
+    'xs' are increasing).
+    """
+    density = np.zeros((len(ys), len(xs)))
+    for y, x, sigma, peak in zip(towns['y'], towns['x'], towns['sigma'], towns['peak']):
+        r0, r1 = np.searchsorted(ys, [y - 4*sigma, y + 4*sigma])
+        c0, c1 = np.searchsorted(xs, [x - 4*sigma, x + 4*sigma])
+        if r0 == r1 or c0 == c1:
+            continue
+        dy = ((ys[r0:r1] - y)/sigma)[:, np.newaxis]
+        dx = ((xs[c0:c1] - x)/sigma)[np.newaxis, :]
+        density[r0:r1, c0:c1] += peak*np.exp(-0.5*(dy*dy + dx*dx))
+    return density
+
+def outline_radius(model, angles):
+    """Return the normalized radius of the study area for the angles (radians) around the centre"""
+    radius = 0.42
+    for k, (phase, amplitude) in enumerate(zip(model['outline']['phase'], model['outline']['amplitude'])):
+        radius = radius + 0.42*amplitude*np.sin((2*k + 3)*angles + phase)
+    return radius
+
+def inside_outline(model, ys, xs):
+    """Return True for the points (normalized coordinates) inside the study area"""
+    dy, dx = np.asarray(ys) - 0.5, np.asarray(xs) - 0.5
+    return np.hypot(dx, dy) < outline_radius(model, np.arctan2(dy, dx))
+
+def to_lonlat(model, ys, xs):
+    """Convert normalized coordinates (0 at the north-west corner) to longitudes and latitudes"""
+    west, south, east, north = model['bounds']
+    return west + np.asarray(xs)*(east - west), north - np.asarray(ys)*(north - south)
+
+def elevation(model, ys, xs):
+    """Return the elevation (m) at normalized coordinates: hills rising towards one side of the country"""
+    terrain = field(model['terrain'], ys, xs)
+    return 800*terrain**2 + 150*ys[:, np.newaxis]
+
+def land_cover(model, ys, xs):
+    """Return the ESA-CCI classes at normalized coordinates, from the elevation, the moisture and the towns"""
+    height = elevation(model, ys, xs)
+    moisture = field(model['moisture'], ys, xs)
+    towns = town_density(model['towns'], ys, xs)
+    classes = np.select([moisture > 0.68, moisture > 0.6, moisture > 0.52, moisture > 0.44, moisture > 0.36,
+                         moisture > 0.3, moisture > 0.25],
+                        [50, 60, 30, 10, 130, 120, 110], 200).astype(np.uint8)
+    classes[height > 650] = 150
+    # Low and wet areas: flooded vegetation and water bodies
+    classes[(height < 150) & (moisture > 0.58)] = 180
+    classes[(height < 130) & (moisture > 0.62)] = 210
+    classes[towns > 200] = 190
+    return classes
+
+def population(model, ys, xs, rng):
+    """Return the people per 3 arc-seconds pixel at normalized coordinates: rural population
+    depending on the moisture, with random variations, plus the towns"""
+    moisture = field(model['moisture'], ys, xs)
+    rural = (0.05 + 0.5*moisture**2)*rng.lognormal(0, 0.6, (len(ys), len(xs)))
+    return (rural + town_density(model['towns'], ys, xs)).astype(np.float32)
+
+def _create_raster(path, model, resolution, data_type, nodata):
+    """Create a GeoTIFF file in EPSG:4326 covering the bounds of the model, return the dataset and its size"""
+    west, south, east, north = model['bounds']
+    cols = int(round((east - west)/resolution))
+    rows = int(round((north - south)/resolution))
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    dataset = gdal.GetDriverByName('GTiff').Create(path, cols, rows, 1, data_type, GTIFF_OPTIONS)
+    dataset.SetGeoTransform((west, resolution, 0, north, 0, -resolution))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).SetNoDataValue(nodata)
+    return dataset, rows, cols
+
+def _write_blocks(datasets, rows, cols, function):
+    """Write the rasters of the same grid block by block: function(ys, xs, block_index) returns the
+    arrays of the block (one per dataset)"""
+    xs = _normalized(cols, 0, cols)
+    for index, row in enumerate(range(0, rows, BLOCK_ROWS)):
+        ys = _normalized(rows, row, min(BLOCK_ROWS, rows - row))
+        for dataset, array in zip(datasets, function(ys, xs, index)):
+            dataset.GetRasterBand(1).WriteArray(array, 0, row)
+    for dataset in datasets:
+        dataset.FlushCache()
+
+def write_elevation(model, path):
+    """Write the elevation raster (Int16, nodata -32768)"""
+    dataset, rows, cols = _create_raster(path, model, RESOLUTION, gdal.GDT_Int16, -32768)
+    _write_blocks([dataset], rows, cols, lambda ys, xs, index: [np.round(elevation(model, ys, xs)).astype(np.int16)])
+    dataset = None
+    return path
+
+def write_land_cover(model, path):
+    """Write the land cover raster (Byte, ESA-CCI classes, nodata 0)"""
+    dataset, rows, cols = _create_raster(path, model, LULC_RESOLUTION, gdal.GDT_Byte, 0)
+    _write_blocks([dataset], rows, cols, lambda ys, xs, index: [land_cover(model, ys, xs)])
+    dataset = None
+    return path
+
+def write_population(model, pop_path, wocba_path, wocba_share=0.24):
+    """Write the population and women of child bearing age rasters (Float32, nodata -99999)"""
+    pop, rows, cols = _create_raster(pop_path, model, RESOLUTION, gdal.GDT_Float32, -99999)
+    wocba = _create_raster(wocba_path, model, RESOLUTION, gdal.GDT_Float32, -99999)[0]
+
+    def population_blocks(ys, xs, index):
+        # One random generator per block, so the rasters do not depend on the size of the blocks read
+        rng = np.random.RandomState([model['seed'], index])
+        people = population(model, ys, xs, rng)
+        people[land_cover(model, ys, xs) == 210] = 0
+        share = wocba_share*rng.uniform(0.9, 1.1, people.shape)
+        return [people, (people*share).astype(np.float32)]
+    _write_blocks([pop, wocba], rows, cols, population_blocks)
+    pop = wocba = None
+    return pop_path, wocba_path
+
+def _create_layer(path, geometry_type, fields):
+    """Create a shapefile in EPSG:4326 with string fields, return the data source and the layer"""
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    datasource = driver.CreateDataSource(path)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = datasource.CreateLayer(os.path.splitext(os.path.basename(path))[0], srs, geometry_type)
+    for name in fields:
+        layer.CreateField(ogr.FieldDefn(name, ogr.OFTString))
+    return datasource, layer
+
+def write_study_area(model, path, vertices=720):
+    """Write the study area polygon (one feature, attributes of a GADM level 0 file)"""
+    datasource, layer = _create_layer(path, ogr.wkbPolygon, ['GID_0', 'NAME_0'])
+    angles = np.linspace(0, 2*math.pi, vertices, endpoint=False)
+    radius = outline_radius(model, angles)
+    lons, lats = to_lonlat(model, 0.5 + radius*np.sin(angles), 0.5 + radius*np.cos(angles))
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for lon, lat in zip(lons, lats) + [(lons[0], lats[0])]:
+        ring.AddPoint_2D(float(lon), float(lat))
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetField('GID_0', 'SYN')
+    feature.SetField('NAME_0', 'Synthetic country')
+    feature.SetGeometry(polygon)
+    layer.CreateFeature(feature)
+    datasource = None
+    return path
+
+def _wiggly_line(rng, y0, x0, y1, x1, segments):
+    """Return the normalized coordinates of a road between two points, with random bends"""
+    t = np.linspace(0, 1, segments+1)
+    length = math.hypot(y1 - y0, x1 - x0)
+    offset = np.concatenate([[0], np.cumsum(rng.normal(0, 0.15*length/segments, segments-1)), [0]])
+    offset -= t*offset[-1]
+    ys = y0 + t*(y1 - y0) + offset*(x1 - x0)/max(length, 1e-12)
+    xs = x0 + t*(x1 - x0) - offset*(y1 - y0)/max(length, 1e-12)
+    return np.clip(ys, 0, 1), np.clip(xs, 0, 1)
+
+def write_roads(model, path):
+    """Write the OSM-like roads: the towns are linked to their nearest towns by main roads (the
+    largest towns by trunks), and local roads and tracks spread around the towns"""
+    rng = np.random.RandomState([model['seed'], 1])
+    towns = model['towns']
+    order = np.argsort(-towns['peak'])
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    datasource, layer = _create_layer(path, ogr.wkbLineString, ['osm_id', 'highway'])
+    definition = layer.GetLayerDefn()
+    layer.StartTransaction()
+    roads = []
+    for i in range(len(towns['y'])):
+        distances = np.hypot(towns['y'] - towns['y'][i], towns['x'] - towns['x'][i])
+        for j in np.argsort(distances)[1:3]:
+            best = min(rank[i], rank[j])
+            highway = 'trunk' if best < 5 else 'primary' if best < 20 else 'secondary' if best < 100 else 'tertiary'
+            roads.append((highway, towns['y'][i], towns['x'][i], towns['y'][j], towns['x'][j]))
+    # Local roads around the towns, including the classes which are not used by the chain
+    local = [name for name, share in ROAD_CLASSES[3:]]
+    shares = np.array([share for name, share in ROAD_CLASSES[3:]])
+    nb_local = 10*len(towns['y']) + model['facilities']
+    for i in rng.randint(0, len(towns['y']), nb_local):
+        y0, x0 = towns['y'][i], towns['x'][i]
+        angle, length = rng.uniform(0, 2*math.pi), rng.uniform(1, 6)*towns['sigma'][i]
+        roads.append((local[rng.choice(len(local), p=shares/shares.sum())], y0, x0,
+                      y0 + length*math.sin(angle), x0 + length*math.cos(angle)))
+    for osm_id, (highway, y0, x0, y1, x1) in enumerate(roads):
+        ys, xs = _wiggly_line(rng, y0, x0, y1, x1, 12)
+        lons, lats = to_lonlat(model, ys, xs)
+        line = ogr.Geometry(ogr.wkbLineString)
+        for lon, lat in zip(lons, lats):
+            line.AddPoint_2D(float(lon), float(lat))
+        feature = ogr.Feature(definition)
+        feature.SetField('osm_id', str(100000 + osm_id))
+        feature.SetField('highway', highway)
+        feature.SetGeometry(line)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    datasource = None
+    return path
+
+def _dhis2_ids(rng, count):
+    """Return unique DHIS2-like ids (11 characters, starting with a letter)"""
+    letters = np.array(list(string.ascii_letters))
+    characters = np.array(list(string.ascii_letters + string.digits))
+    ids = set()
+    while len(ids) < count:
+        for i in range(count - len(ids)):
+            ids.add(rng.choice(letters) + ''.join(rng.choice(characters, 10)))
+    return sorted(ids)
+
+def write_facilities(model, units_path, groups_path, groupsets_path, outside_share=0.02, missing_share=0.01):
+    """Write the DHIS2-like json files of the health facilities, their groups and group sets.
+
+    The facilities are located near the towns (60 %) or anywhere in the study area; 'outside_share'
+    of them are outside of the study area and 'missing_share' have no coordinates. About 15 % of
+    the facilities are hospitals (level 1), the others are health centres or posts (level 2),
+    except a few facilities without group.
+    """
+    rng = np.random.RandomState([model['seed'], 2])
+    count = model['facilities']
+    towns = model['towns']
+    ys, xs = np.empty(count), np.empty(count)
+    near = rng.rand(count) < 0.6
+    weights = towns['peak']/towns['peak'].sum()
+    chosen = rng.choice(len(weights), near.sum(), p=weights)
+    ys[near] = rng.normal(towns['y'][chosen], towns['sigma'][chosen])
+    xs[near] = rng.normal(towns['x'][chosen], towns['sigma'][chosen])
+    # The other facilities (and the ones near the towns falling outside) anywhere in the study area
+    todo = ~near | ~inside_outline(model, ys, xs)
+    while todo.any():
+        ys[todo], xs[todo] = rng.rand(todo.sum()), rng.rand(todo.sum())
+        todo &= ~inside_outline(model, ys, xs)
+    outside = rng.rand(count) < outside_share
+    while True:
+        redo = outside & inside_outline(model, ys, xs)
+        if not redo.any():
+            break
+        ys[redo], xs[redo] = rng.uniform(-0.05, 1.05, redo.sum()), rng.uniform(-0.05, 1.05, redo.sum())
+    lons, lats = to_lonlat(model, ys, xs)
+    ids = _dhis2_ids(rng, count + 5)
+    rng.shuffle(ids)
+    group_ids = ids[count:]
+    ids = ids[:count]
+    missing = rng.rand(count) < missing_share
+    units = []
+    for i in range(count):
+        unit = {'id': ids[i], 'name': 'Facility %d' % (i+1), 'shortName': 'HF %d' % (i+1), 'level': 4}
+        if missing[i]:
+            unit['featureType'] = 'NONE'
+        else:
+            unit['featureType'] = 'POINT'
+            unit['coordinates'] = '[%.6f,%.6f]' % (lons[i], lats[i])
+        units.append(unit)
+    # Administrative units (not health facilities, skipped by the chain)
+    units.append({'id': group_ids[3], 'name': 'Synthetic country', 'shortName': 'SYN', 'level': 1, 'featureType': 'NONE'})
+    with open(units_path, 'w') as fout:
+        json.dump({'system': {'version': '2.30'}, 'organisationUnits': units}, fout)
+    level = np.where(rng.rand(count) < 0.15, 1, 2)
+    level[rng.rand(count) < 0.01] = 0
+    groups = []
+    for hc_level, level_groups in sorted(LEVEL_GROUPS.items()):
+        members = np.flatnonzero(level == hc_level)
+        for k, (group_id, name) in enumerate(level_groups):
+            groups.append({'id': group_id, 'name': name,
+                           'organisationUnits': [{'id': ids[i]} for i in members[k::len(level_groups)]]})
+    groups.append({'id': group_ids[0], 'name': 'Empty group', 'organisationUnits': []})
+    with open(groups_path, 'w') as fout:
+        json.dump({'organisationUnitGroups': groups}, fout)
+    groupsets = [{'id': group_ids[1], 'name': 'Facility Type',
+                  'organisationUnitGroups': [{'id': group['id']} for group in groups]},
+                 {'id': group_ids[2], 'name': 'Empty group set', 'organisationUnitGroups': []}]
+    with open(groupsets_path, 'w') as fout:
+        json.dump({'organisationUnitGroupSets': groupsets}, fout)
+    return units_path, groups_path, groupsets_path
+
+def utm_epsg(longitude, latitude):
+    """Return the EPSG code of the WGS84 UTM zone of a point"""
+    zone = int((longitude + 180)//6) % 60 + 1
+    return (32600 if latitude >= 0 else 32700) + zone
+
+def write_config(model, datadir, config_file, outputdir, cachedir, resolution=100, isochrone_maps=False):
+    """Write a configuration file of the chain (LIBS/config.py with the synthetic layers)"""
+    west, south, east, north = model['bounds']
+    base_config = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'LIBS', 'config.py')
+    lines = ["# Configuration of a synthetic country (generated by synthetic_country.py)",
+             "import os",
+             "execfile(%r)" % os.path.realpath(base_config),
+             "datadir = %r" % os.path.abspath(datadir),
+             "config_parameters['outputdir'] = %r" % os.path.abspath(outputdir),
+             "config_parameters['cachedir'] = %r" % os.path.abspath(cachedir),
+             "config_parameters['workingdir'] = %r" % os.path.join(os.path.abspath(outputdir), 'work'),
+             "config_parameters['gisdb'] = os.path.join(config_parameters['workingdir'], 'GRASSDATA')",
+             "config_parameters['locationepsg'] = '%d'" % utm_epsg((west + east)/2, (south + north)/2),
+             "config_parameters['resolution'] = '%s'" % resolution,
+             "outputs['isochrone_maps'] = %r" % bool(isochrone_maps),
+             "data['admin'] = ('admin1', os.path.join(datadir, 'Admin/study_area.shp'))",
+             "data['WOCBA_PPP'] = ('WOCBA_PPP', os.path.join(datadir, 'Population/ppp_WOCBA.tif'))",
+             "data['POP_PPP'] = ('POP_PPP', os.path.join(datadir, 'Population/ppp_POP.tif'))",
+             "data['LULC'] = ('LULC', os.path.join(datadir, 'LandCover/esacci.tif'))",
+             "data['HC'] = ('HC', os.path.join(datadir, 'Health/metadata.json'))",
+             "data['GROUPS'] = os.path.join(datadir, 'Health/Groups.json')",
+             "data['GROUPSETS'] = os.path.join(datadir, 'Health/Groups_Sets.json')",
+             "data['SRTM'] = ('SRTM', os.path.join(datadir, 'Elevation/srtm.tif'))",
+             "data['ROADS'] = ('OSM', os.path.join(datadir, 'Roads/OSM/osm_roads.shp'))",
+             "rule_file['Velocity_LULC'] = os.path.join(datadir, 'Velocity_LULC')",
+             "rule_file['ESACCI_WS'] = os.path.join(datadir, 'LandCover/reclass_ESACCI_WS')",
+             "rule_file['ESACCI_DS'] = os.path.join(datadir, 'LandCover/reclass_ESACCI_DS')",
+             "rule_file['Recode_streams'] = os.path.join(datadir, 'Recode_streams')"]
+    with open(config_file, 'w') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    return config_file
+
+def write_rules(datadir):
+    """Write the rules files of the chain"""
+    if not os.path.exists(os.path.join(datadir, 'LandCover')):
+        os.makedirs(os.path.join(datadir, 'LandCover'))
+    for season, rules in RECLASS_RULES.items():
+        with open(os.path.join(datadir, 'LandCover', 'reclass_ESACCI_%s' % season), 'w') as fout:
+            fout.write(rules)
+    with open(os.path.join(datadir, 'Velocity_LULC'), 'w') as fout:
+        fout.write(VELOCITY_RULES)
+    with open(os.path.join(datadir, 'Recode_streams'), 'w') as fout:
+        fout.write(STREAMS_RULES)
+
+def generate_country(datadir, cells, facilities, seed=0, center=(-14.5, 14.5)):
+    """Generate all the input layers of a synthetic country in 'datadir' (see the module documentation).
+
+    The parameters are written in 'datadir'/synthetic.json; if this file exists with the same
+    parameters, the layers are not generated again. Return the parameters.
+    """
+    manifest_file = os.path.join(datadir, 'synthetic.json')
+    manifest = {'cells': int(cells), 'facilities': int(facilities), 'seed': int(seed), 'center': list(center)}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as fin:
+            if json.load(fin) == manifest:
+                return manifest
+        os.remove(manifest_file)
+    model = country_model(cells, facilities, seed, center)
+    write_elevation(model, os.path.join(datadir, 'Elevation', 'srtm.tif'))
+    write_land_cover(model, os.path.join(datadir, 'LandCover', 'esacci.tif'))
+    write_population(model, os.path.join(datadir, 'Population', 'ppp_POP.tif'),
+                     os.path.join(datadir, 'Population', 'ppp_WOCBA.tif'))
+    write_study_area(model, os.path.join(datadir, 'Admin', 'study_area.shp'))
+    write_roads(model, os.path.join(datadir, 'Roads', 'OSM', 'osm_roads.shp'))
+    if not os.path.exists(os.path.join(datadir, 'Health')):
+        os.makedirs(os.path.join(datadir, 'Health'))
+    write_facilities(model, os.path.join(datadir, 'Health', 'metadata.json'),
+                     os.path.join(datadir, 'Health', 'Groups.json'), os.path.join(datadir, 'Health', 'Groups_Sets.json'))
+    write_rules(datadir)
+    # The manifest is written last: an interrupted generation is started again
+    with open(manifest_file, 'w') as fout:
+        json.dump(manifest, fout)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('datadir', help="folder of the input layers")
+    parser.add_argument('--cells', type=float, default=1e6, help="number of cells of the 3 arc-seconds rasters")
+    parser.add_argument('--facilities', type=int, default=1000, help="number of health facilities")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generators")
+    parser.add_argument('--config', help="also write a configuration file of the chain using the layers")
+    parser.add_argument('--outputdir', default='/tmp/SHE_DECIDES_BENCH/output', help="output folder of the configuration")
+    args = parser.parse_args()
+
+    generate_country(args.datadir, args.cells, args.facilities, args.seed)
+    if args.config:
+        write_config(country_model(args.cells, args.facilities, args.seed), args.datadir, args.config,
+                     args.outputdir, os.path.join(args.outputdir, 'cache'))
+        print "Configuration written in '%s'" % args.config
+    print "Synthetic country written in '%s'" % args.datadir
+
+if __name__ == '__main__':
+    main()
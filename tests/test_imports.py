@@ -0,0 +1,35 @@
+"""
+Tests of the imports of the modules of LIBS the way the scripts do them: LIBS is appended at the
+end of sys.path, so a module of LIBS named like a module of the standard library (ex: 'commands'
+in python 2.7) or of an installed package is never imported.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import imp
+import sys
+import subprocess
+import pytest
+
+LIBS = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'LIBS'))
+MODULES = sorted(os.path.splitext(name)[0] for name in os.listdir(LIBS) if name.endswith('.py'))
+
+
+@pytest.mark.parametrize('name', MODULES)
+def test_module_name_is_not_shadowed(name, monkeypatch):
+    # imp.find_module() searches the built-in modules and sys.path, not the imported modules
+    monkeypatch.setattr(sys, 'path', [path for path in sys.path if os.path.realpath(path or '.') != LIBS])
+    with pytest.raises(ImportError):
+        imp.find_module(name)
+
+def test_import_with_libs_appended():
+    pytest.importorskip('grass.script')
+    pytest.importorskip('scipy')
+    names = ['grass_commands', 'tiling', 'import_json', 'zonal_stats', 'velocity', 'whatif']
+    script = ("import os, sys\nsys.path.append(%r)\n" % LIBS +
+              "".join("import %s\nassert os.path.dirname(os.path.realpath(%s.__file__)) == %r\n" % (name, name, LIBS)
+                      for name in names))
+    process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    assert process.returncode == 0, output
@@ -0,0 +1,104 @@
+"""
+Tests of the stage cache (LIBS/stage_cache.py): editing a helper used by a stage, directly or
+through another module, changes the key of the stage; the keys are only computed when needed; the
+output files of a previous run do not remain when a stage is restored.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'LIBS'))
+pytest.importorskip('grass.script')
+from stage_cache import stage_key, lazy_stage_key, code_files, cached_stage, store_stage
+
+HELPER = '''
+def helper(value):
+    return value + %d
+'''
+WRAPPER = '''
+from stage_helper import helper
+
+def wrapped(value):
+    return helper(value)
+'''
+STAGE = '''
+import stage_wrapper
+from stage_helper import helper
+
+def direct_stage():
+    return helper(1)
+
+def indirect_stage():
+    return stage_wrapper.wrapped(1)
+
+def other_stage():
+    return 1
+'''
+
+
+@pytest.fixture
+def stage_modules(tmpdir, monkeypatch):
+    """Write the modules of the stages in a temporary folder and import them"""
+    folder = str(tmpdir.mkdir('code'))
+    for name, source in (('stage_helper', HELPER % 1), ('stage_wrapper', WRAPPER), ('stage_module', STAGE)):
+        with open(os.path.join(folder, '%s.py' % name), 'w') as fout:
+            fout.write(source)
+    sys.path.insert(0, folder)
+    # No .pyc, so the edited modules are read again
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    try:
+        import stage_module
+        yield folder, stage_module
+    finally:
+        sys.path.remove(folder)
+        for name in ('stage_helper', 'stage_wrapper', 'stage_module'):
+            sys.modules.pop(name, None)
+
+def _keys(folder, module, cachedir):
+    """Return the keys of the stages of the temporary module"""
+    return dict((name, stage_key(getattr(module, name), [], {'resolution': 100}, cachedir, code_dirs=[folder]))
+                for name in ('direct_stage', 'indirect_stage', 'other_stage'))
+
+def test_code_files(stage_modules):
+    folder, module = stage_modules
+    names = lambda files: sorted(os.path.basename(path) for path in files)
+    assert names(code_files(module.direct_stage, [folder])) == ['stage_helper.py']
+    assert names(code_files(module.indirect_stage, [folder])) == ['stage_helper.py', 'stage_wrapper.py']
+    assert code_files(module.other_stage, [folder]) == []
+
+def test_editing_a_helper_invalidates_the_key(stage_modules, tmpdir):
+    folder, module = stage_modules
+    cachedir = str(tmpdir.mkdir('cache'))
+    before = _keys(folder, module, cachedir)
+    assert before == _keys(folder, module, cachedir)
+    with open(os.path.join(folder, 'stage_helper.py'), 'w') as fout:
+        fout.write(HELPER % 2)
+    after = _keys(folder, module, cachedir)
+    assert after['direct_stage'] != before['direct_stage']
+    assert after['indirect_stage'] != before['indirect_stage']
+    assert after['other_stage'] == before['other_stage']
+
+def test_lazy_key(stage_modules, tmpdir):
+    folder, module = stage_modules
+    cachedir = str(tmpdir.mkdir('cache'))
+    input_file = str(tmpdir.join('input.csv'))
+    key = lazy_stage_key(module.direct_stage, [input_file], {'resolution': 100}, cachedir, code_dirs=[folder])
+    # The input file is only hashed at the first call
+    tmpdir.join('input.csv').write('1,2\n')
+    assert key() == stage_key(module.direct_stage, [input_file], {'resolution': 100}, cachedir, code_dirs=[folder])
+    tmpdir.join('input.csv').write('3,4\n')
+    assert key() == key()
+
+def test_restore_removes_previous_files(stage_modules, tmpdir):
+    folder, module = stage_modules
+    cachedir = str(tmpdir.mkdir('cache'))
+    error_file = str(tmpdir.join('HC_errors.csv'))
+    # Entry of a run without errors (no error file)
+    store_stage(cachedir, 'key', files=[error_file])
+    # Error file of another run
+    tmpdir.join('HC_errors.csv').write('cat,id\n')
+    assert cached_stage(module.other_stage, 'key', cachedir, files=[error_file])
+    assert not os.path.exists(error_file)
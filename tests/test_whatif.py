@@ -0,0 +1,73 @@
+"""
+Tests of the incremental ("what-if") update of the accessibility (LIBS/whatif.py): the updated
+rasters and population per health facility are compared with a full recomputation.
+
+Run with: python -m pytest tests
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'LIBS'))
+pytest.importorskip('scipy')
+pytest.importorskip('grass.script')
+from cost_engine import cost_distance
+from whatif import add_facilities, remove_facilities, update_facility_stats, _band_index
+from zonal_stats import band_values
+
+TIME_LIMITS = [5, 10, 20, 40]
+
+
+def _facility_stats(cost, nearest, pop, time_limits):
+    """Return the population per health facility and per band of a full computation"""
+    bands = band_values(time_limits)
+    index = _band_index(cost, bands)
+    valid = (nearest > 0) & (index < len(bands))
+    table = pd.DataFrame({'HF_cat': nearest[valid].astype(np.int64), 'ISO_cat': bands[index[valid]], 'sum': pop[valid]})
+    return table.groupby(['HF_cat','ISO_cat'], as_index=False)['sum'].sum()
+
+def _compare(updated, expected):
+    """Check that two tables of population per health facility and per band are equal"""
+    updated = updated[updated['sum'] != 0].set_index(['HF_cat','ISO_cat'])['sum'].sort_index()
+    expected = expected[expected['sum'] != 0].set_index(['HF_cat','ISO_cat'])['sum'].sort_index()
+    assert list(updated.index) == list(expected.index)
+    assert np.allclose(updated.values, expected.values)
+
+@pytest.fixture
+def landscape():
+    """Random friction (no ties between paths) and population, and three health facilities"""
+    rng = np.random.RandomState(1)
+    friction = rng.uniform(0.5, 1.5, (60, 60))
+    pop = rng.uniform(0, 10, (60, 60))
+    facilities = {1: (10, 10), 2: (50, 45), 3: (30, 30)}
+    return friction, pop, facilities
+
+def _full(friction, facilities):
+    """Full computation of the cost and nearest arrays"""
+    cats = sorted(facilities)
+    rows = np.array([facilities[cat][0] for cat in cats])
+    cols = np.array([facilities[cat][1] for cat in cats])
+    return cost_distance(friction, rows, cols, np.array(cats))
+
+@pytest.mark.parametrize('remove, add', [([3], {}), ([], {4: (32, 33)}), ([3], {4: (32, 33)}),
+                                         ([3, 1], {4: (32, 33), 5: (12, 8)})])
+def test_update_matches_full_recompute(landscape, remove, add):
+    friction, pop, facilities = landscape
+    cost, nearest = _full(friction, facilities)
+    stats = {'POP': _facility_stats(cost, nearest, pop, TIME_LIMITS)}
+    changes = remove_facilities(friction, cost, nearest, remove)
+    if add:
+        cats = sorted(add)
+        add_facilities(friction, cost, nearest, [add[cat][0] for cat in cats], [add[cat][1] for cat in cats],
+                       cats, margin=4, changes=changes)
+    updated = update_facility_stats(stats, {'POP': pop}, cost, nearest, changes, TIME_LIMITS, removed_cats=remove)
+
+    final = dict((cat, position) for cat, position in facilities.items() if cat not in remove)
+    final.update(add)
+    expected_cost, expected_nearest = _full(friction, final)
+    assert np.allclose(cost, expected_cost, equal_nan=True)
+    assert (nearest == expected_nearest).all()
+    _compare(updated['POP'], _facility_stats(expected_cost, expected_nearest, pop, TIME_LIMITS))